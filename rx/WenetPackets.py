@@ -13,6 +13,7 @@ import logging
 import json
 import requests
 import sys
+import numpy as np
 from hashlib import sha256
 from base64 import b64encode
 
@@ -31,9 +32,13 @@ class WENET_PACKET_TYPES:
     GPS_TELEMETRY           = 0x01
     ORIENTATION_TELEMETRY   = 0x02
     SEC_PAYLOAD_TELEMETRY   = 0x03
+    TELEMETRY_CONTAINER     = 0x04
+    GPS_TRACK               = 0x05
+    IMAGE_LINK              = 0x06
     IMAGE_TELEMETRY         = 0x54
     SSDV                    = 0x55
     IDLE                    = 0x56
+    SSDV_REPAIR             = 0x57
 
 
 class WENET_PACKET_LENGTHS:
@@ -59,10 +64,18 @@ def packet_to_string(packet):
         return orientation_telemetry_string(packet)
     elif packet_type == WENET_PACKET_TYPES.SEC_PAYLOAD_TELEMETRY:
         return sec_payload_packet_string(packet)
+    elif packet_type == WENET_PACKET_TYPES.TELEMETRY_CONTAINER:
+        return telemetry_container_string(packet)
+    elif packet_type == WENET_PACKET_TYPES.GPS_TRACK:
+        return gps_track_string(packet)
+    elif packet_type == WENET_PACKET_TYPES.IMAGE_LINK:
+        return image_link_string(packet)
     elif packet_type == WENET_PACKET_TYPES.IMAGE_TELEMETRY:
         return image_telemetry_string(packet)
     elif packet_type == WENET_PACKET_TYPES.SSDV:
         return ssdv_packet_string(packet)
+    elif packet_type == WENET_PACKET_TYPES.SSDV_REPAIR:
+        return ssdv_repair_packet_string(packet)
     else:
         return "Unknown Packet Type: %d" % packet_type
 
@@ -115,6 +128,7 @@ def ssdv_packet_info(packet):
             'packet_id' : (packet[7]<<8) + packet[8],
             'width' : packet[9]*16,
             'height' : packet[10]*16,
+            'eoi' : ((packet[11] >> 2) & 1) == 1,
             'error' : "None"
         }
 
@@ -132,6 +146,16 @@ def ssdv_packet_string(packet):
     else:
         return "SSDV: %s, Callsign: %s, Img:%d, Pkt:%d, %dx%d" % (packet_info['packet_type'],packet_info['callsign'],packet_info['image_id'],packet_info['packet_id'],packet_info['width'],packet_info['height'])
 
+
+def ssdv_repair_packet_string(packet):
+    """ Produce a textual representation of a SSDV erasure coding repair packet (refer ssdv_erasure.py). """
+    packet = bytes(bytearray(packet))
+    try:
+        (_image_id, _group_start, _group_size, _num_repairs, _index) = struct.unpack(">BHBBB", packet[1:7])
+        return "SSDV Repair: Img:%d, Pkts:%d-%d, Repair %d/%d" % (_image_id, _group_start, _group_start + _group_size - 1, _index + 1, _num_repairs)
+    except:
+        return "SSDV Repair: Unable to decode."
+
 #
 # Text Messages
 #
@@ -297,6 +321,81 @@ def gps_telemetry_string(packet):
 
         return gps_data_string
 
+#
+# GPS Track Decoder
+# One absolute fix followed by many delta-encoded fixes. Refer tx/GPSTrack.py for the packet format.
+#
+GPS_TRACK_HEADER_FORMAT = ">BHIBBBiiiB"
+GPS_TRACK_HEADER_LENGTH = struct.calcsize(GPS_TRACK_HEADER_FORMAT)
+GPS_TRACK_DELTA_DTYPE = np.dtype([('dt', '>u1'), ('lat', '>i2'), ('lon', '>i2'), ('alt', '>i2')])
+
+def gps_track_decode(packet):
+    """ Extract the fixes from a GPS track packet, and return them as a dictionary.
+
+    Keyword Arguments:
+    packet: A GPS track packet, as a string or a list of integers.
+
+    Return value:
+            A dictionary containing the packet header fields, and 'track', a (N, 4) numpy array
+            with a row for each fix of: GPS time-of-week (seconds), latitude, longitude (degrees), altitude (m).
+            The field 'error' will be set to 'None' if decoding was successful.
+    """
+    packet = bytes(bytearray(packet))
+
+    if len(packet) < GPS_TRACK_HEADER_LENGTH:
+        return {'error': 'GPS Track Packet has invalid length.'}
+
+    try:
+        (_type, _week, _iTOW, _leapS, _fix, _numSV, _lat, _lon, _alt, _count) = struct.unpack(GPS_TRACK_HEADER_FORMAT, packet[:GPS_TRACK_HEADER_LENGTH])
+
+        _end = GPS_TRACK_HEADER_LENGTH + _count*GPS_TRACK_DELTA_DTYPE.itemsize
+        if len(packet) < _end:
+            return {'error': 'GPS Track Packet has invalid length.'}
+
+        _deltas = np.frombuffer(packet[GPS_TRACK_HEADER_LENGTH:_end], dtype=GPS_TRACK_DELTA_DTYPE)
+
+        # Rebuild the track by integrating the deltas, in integer units so no rounding errors accumulate.
+        _track_int = np.zeros((_count+1, 4), dtype=np.int64)
+        _track_int[0] = (_iTOW, _lat, _lon, _alt)
+        _track_int[1:, 0] = _deltas['dt'].astype(np.int64)*10
+        _track_int[1:, 1] = _deltas['lat'].astype(np.int64)*10
+        _track_int[1:, 2] = _deltas['lon'].astype(np.int64)*10
+        _track_int[1:, 3] = _deltas['alt']
+        _track_int = np.cumsum(_track_int, axis=0)
+
+        _track = _track_int.astype(np.float64) * np.array([1e-3, 1e-7, 1e-7, 1e-2])
+
+        return {
+            'week': _week,
+            'leapS': _leapS,
+            'gpsFix': _fix,
+            'numSV': _numSV,
+            'track': _track,
+            'error': 'None'
+        }
+    except Exception as e:
+        traceback.print_exc()
+        return {'error': 'Could not decode GPS Track packet - %s' % str(e)}
+
+
+def gps_track_string(packet):
+    """ Produce a String representation of a GPS Track packet """
+    track_data = gps_track_decode(packet)
+
+    if track_data['error'] != 'None':
+        return "GPS Track: ERROR Could not decode."
+    else:
+        _track = track_data['track']
+        return "GPS Track: %s - %s, %d fixes, Last Lat/Lon: %.5f,%.5f Alt: %dm, SVs: %d" % (
+            gps_weeksecondstoutc(track_data['week'], _track[0,0], track_data['leapS']),
+            gps_weeksecondstoutc(track_data['week'], _track[-1,0], track_data['leapS']),
+            _track.shape[0],
+            _track[-1,1],
+            _track[-1,2],
+            int(_track[-1,3]),
+            track_data['numSV']
+            )
+
 #
 # Orientation Telemetry Decoder
 #
@@ -589,6 +688,67 @@ def sec_payload_packet_string(packet):
 
 
 
+#
+# Telemetry Container - Several telemetry packets packed into a single packet.
+# Refer tx/TelemetryAggregator.py for the packet format.
+#
+def telemetry_container_decode(packet):
+    """ Split a telemetry container packet into a list of the telemetry packets within it.
+    Each packet can then be passed to the decoder for its own packet type.
+    """
+    # We need the packet as a string, convert to a string in case we were passed a list of bytes.
+    packet = bytes(bytearray(packet))
+    _data = bytearray(packet)
+    _records = []
+
+    _count = _data[1]
+    _offset = 2
+    for i in range(_count):
+        if _offset >= len(_data):
+            break
+        _length = _data[_offset]
+        _record = packet[_offset+1:_offset+1+_length]
+        if len(_record) != _length:
+            # Truncated record.
+            break
+        _records.append(_record)
+        _offset += 1 + _length
+
+    return _records
+
+
+def telemetry_container_string(packet):
+    """ Provide a string representation of a telemetry container packet, and its contents. """
+    _records = telemetry_container_decode(packet)
+
+    return "Telemetry Container (%d packets): " % len(_records) + " | ".join([packet_to_string(_record) for _record in _records])
+
+
+#
+# Image Link - Links a thumbnail SSDV image to the full resolution image of the same capture.
+# Refer tx/PacketTX.py, transmit_image_link, for the packet format.
+#
+def image_link_decode(packet):
+    """ Extract the capture ID and image IDs from an image link packet, and return them as a dictionary. """
+    # We need the packet as a string, convert to a string in case we were passed a list of bytes.
+    packet = bytes(bytearray(packet))
+    try:
+        (_type, _capture_id, _thumbnail_id, _image_id) = struct.unpack(">BHBB", packet[:5])
+        return {'capture_id': _capture_id, 'thumbnail_id': _thumbnail_id, 'image_id': _image_id, 'error': 'None'}
+    except:
+        return {'error': 'Could not decode image link packet.'}
+
+
+def image_link_string(packet):
+    """ Provide a string representation of an image link packet. """
+    _link = image_link_decode(packet)
+
+    if _link['error'] != 'None':
+        return "Image Link: Unable to decode."
+
+    return "Image Link: Capture %d - Thumbnail Img:%d, Full Img:%d" % (_link['capture_id'], _link['thumbnail_id'], _link['image_id'])
+
+
 #
 # Habitat Uploader functions.
 #
@@ -18,7 +18,9 @@ import sys
 import datetime
 import argparse
 import socket
+import time
 from WenetPackets import *
+from ssdv_erasure import recover_packets
 
 # Check if we are running in Python 2 or 3
 PY3 = sys.version_info[0] == 3
@@ -30,6 +32,7 @@ parser.add_argument("--hex", action="store_true", help="Take Hex strings as inpu
 parser.add_argument("--partialupdate", default=0, help="Push partial updates every N packets to GUI.")
 parser.add_argument("-v", "--verbose", action='store_true', default=False, help="Verbose output")
 parser.add_argument("--headless", action='store_true', default=False, help="Headless mode - broadcasts additional data via UDP.")
+parser.add_argument("--image_timeout", default=30.0, type=float, help="Decode an incomplete image once no packets of it have been received for this many seconds. Defaults to 30.")
 args = parser.parse_args()
 
 
@@ -45,10 +48,15 @@ logging.getLogger("urllib3").setLevel(logging.CRITICAL)
 
 
 # GUI updates are only sent locally.
-def trigger_gui_update(filename, text = "None"):
+def trigger_gui_update(filename, text = "None", link = None):
 	message = 	{'filename': filename,
 				'text': text}
 
+	# If this image is part of a progressive (thumbnail + full resolution) capture, say which.
+	if link != None:
+		message['capture_id'] = link['capture_id']
+		message['thumbnail'] = link['thumbnail']
+
 	gui_socket = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
 	gui_socket.sendto(json.dumps(message).encode('ascii'),("127.0.0.1",WENET_IMAGE_UDP_PORT))
 	gui_socket.close()
@@ -87,15 +95,97 @@ def broadcast_telemetry_packet(data, headless=False):
 		gui_socket.close()
 
 
+def write_image_file(packets, filename="rxtemp.bin"):
+	""" Write out the received packets of an image in packet ID order, ready to be decoded.
+	ssdv skips packets which are out of order or repeated, so packets received out of order
+	(i.e. carousel re-transmissions, or recovered packets) must be sorted first.
+	"""
+	_f = open(filename, "wb")
+	for _id in sorted(packets.keys()):
+		_f.write(packets[_id])
+	_f.close()
+
+
+def recover_image(packets, repairs):
+	""" Attempt to rebuild missing packets of an image using erasure coding repair packets,
+	adding any recovered packets to the packets dictionary.
+	"""
+	if len(repairs) == 0:
+		return
+
+	try:
+		recovered = recover_packets(packets, repairs)
+	except Exception as e:
+		logging.error("Error recovering SSDV packets - %s" % str(e))
+		return
+
+	if len(recovered) == 0:
+		return
+
+	logging.info("Recovered %d SSDV packets using %d repair packets." % (len(recovered), len(repairs)))
+	packets.update(recovered)
+
+
+def decode_image(image, packet_as_string):
+	""" Decode a received image into ./rx_images/, and update the live displays. """
+	# Fill in any missing packets, and write out the image in packet ID order.
+	recover_image(image['packets'], image_repairs.get(image['image_id'], []))
+	write_image_file(image['packets'])
+	image['decoded_packets'] = len(image['packets'])
+
+	_filename = "./rx_images/%s_%s_%d" % (image['time'], image['callsign'], image['image_id'])
+	# Run SSDV
+	returncode = os.system("ssdv -d rxtemp.bin %s.jpg 2>/dev/null > /dev/null" % _filename)
+	if returncode == 1:
+		logging.error("ERROR: SSDV Decode failed!")
+	else:
+		logging.debug("SSDV Decoded OK!")
+		# Make a copy of the raw binary data.
+		os.system("mv rxtemp.bin %s.bin" % _filename)
+
+		# Update live displays here.
+		trigger_gui_update(os.path.abspath("%s.jpg" % _filename), packet_as_string, image_links.get(image['image_id']))
+
+		# Trigger upload to habhub here.
+
+
+def image_complete(image):
+	""" Returns True if every packet of an image (up to the one with the EOI flag set) has been received. """
+	return (image['last_packet'] is not None) and (len(image['packets']) > image['last_packet'])
+
+
+def check_image_timeouts(packet_as_string):
+	""" Decode any images which have not received packets for image_timeout seconds, and have packets
+	which have not been decoded yet. Images are forgotten after several timeouts.
+	"""
+	_now = time.time()
+	for _key in list(images.keys()):
+		_image = images[_key]
+		if _now - _image['last_rx'] < args.image_timeout:
+			continue
+
+		if _image['decoded_packets'] < len(_image['packets']):
+			logging.info("Image ID #%d timed out with %d packets." % (_image['image_id'], len(_image['packets'])))
+			decode_image(_image, packet_as_string)
+
+		if _now - _image['last_rx'] > 10*args.image_timeout:
+			# Long finished with this image, and its link and repair packets.
+			images.pop(_key)
+			image_links.pop(_image['image_id'], None)
+			image_repairs.pop(_image['image_id'], None)
+
+
 # State variables
-current_image = -1
-current_callsign = ""
 current_text_message = -1
-current_packet_count = 0
-current_packet_time = datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%SZ")
-
-# Open temporary file for storing data.
-temp_f = open("rxtemp.bin",'wb')
+# Images being received, keyed by (callsign, image ID). Packets of several images may be received at
+# once, i.e. the thumbnail of the next capture is sent in between the packets of the current image.
+# Each image is decoded once all of its packets have been received, or once it times out.
+images = {}
+# Erasure coding repair packets, keyed by image ID.
+image_repairs = {}
+# Capture links of progressively transmitted images, keyed by image ID.
+image_links = {}
+last_timeout_check = time.time()
 
 
 while True:
@@ -117,6 +207,11 @@ while True:
 
 	packet_type = decode_packet_type(data)
 
+	# Look for images which have stopped receiving packets, once a second.
+	if time.time() - last_timeout_check > 1.0:
+		check_image_timeouts("SSDV: Image timed out.")
+		last_timeout_check = time.time()
+
 
 	if packet_type == WENET_PACKET_TYPES.IDLE:
 		continue
@@ -132,6 +227,10 @@ while True:
 		broadcast_telemetry_packet(data, args.headless)
 		logging.info(packet_to_string(data))
 
+	elif packet_type == WENET_PACKET_TYPES.GPS_TRACK:
+		broadcast_telemetry_packet(data)
+		logging.info(packet_to_string(data))
+
 	elif packet_type == WENET_PACKET_TYPES.ORIENTATION_TELEMETRY:
 		broadcast_telemetry_packet(data)
 		logging.info(packet_to_string(data))
@@ -140,6 +239,34 @@ while True:
 		broadcast_telemetry_packet(data)
 		logging.info(packet_to_string(data))
 
+	elif packet_type == WENET_PACKET_TYPES.TELEMETRY_CONTAINER:
+		# Split the container up, and handle each packet as if it had been received on its own.
+		for _record in telemetry_container_decode(data):
+			_record_type = decode_packet_type(_record)
+			broadcast_telemetry_packet(_record, args.headless and (_record_type in [WENET_PACKET_TYPES.TEXT_MESSAGE, WENET_PACKET_TYPES.GPS_TELEMETRY]))
+			logging.info(packet_to_string(_record))
+
+	elif packet_type == WENET_PACKET_TYPES.IMAGE_LINK:
+		# A thumbnail and full resolution image of the same capture are about to be sent.
+		link = image_link_decode(data)
+		if link['error'] == 'None':
+			image_links[link['thumbnail_id']] = {'capture_id': link['capture_id'], 'thumbnail': True}
+			image_links[link['image_id']] = {'capture_id': link['capture_id'], 'thumbnail': False}
+		broadcast_telemetry_packet(data)
+		logging.info(packet_to_string(data))
+
+	elif packet_type == WENET_PACKET_TYPES.SSDV_REPAIR:
+		_image_id = bytearray(data)[1]
+		image_repairs.setdefault(_image_id, []).append(data)
+
+		# If this completes an image which is only missing a few packets, decode it now.
+		for image in list(images.values()):
+			if image['image_id'] == _image_id and image['last_packet'] is not None and not image_complete(image):
+				recover_image(image['packets'], image_repairs[_image_id])
+				if image_complete(image):
+					decode_image(image, "SSDV: Image recovered.")
+		logging.debug(packet_to_string(data))
+
 	elif packet_type == WENET_PACKET_TYPES.SSDV:
 
 		# Extract packet information.
@@ -148,52 +275,40 @@ while True:
 
 		# Only proceed if there are no decode errors.
 		if packet_info['error'] != 'None':
-			logging.error(message['error'])
+			logging.error(packet_info['error'])
 			continue
 
-		if (packet_info['image_id'] != current_image) or (packet_info['callsign'] != current_callsign) :
-			# Attempt to decode current image if we have enough packets.
+		_key = (packet_info['callsign'], packet_info['image_id'])
+		if _key not in images:
 			logging.info("New image - ID #%d" % packet_info['image_id'])
-			if current_packet_count > 0:
-				# Attempt to decode current image, and write out to a file.
-				temp_f.close()
-				# Run SSDV
-				returncode = os.system("ssdv -d rxtemp.bin ./rx_images/%s_%s_%d.jpg 2>/dev/null > /dev/null" % (current_packet_time,current_callsign,current_image))
-				if returncode == 1:
-					logging.error("ERROR: SSDV Decode failed!")
-				else:
-					logging.debug("SSDV Decoded OK!")
-					# Make a copy of the raw binary data.
-					os.system("mv rxtemp.bin ./rx_images/%s_%s_%d.bin" % (current_packet_time,current_callsign,current_image))
-
-					# Update live displays here.
-					trigger_gui_update(os.path.abspath("./rx_images/%s_%s_%d.jpg" % (current_packet_time,current_callsign,current_image)), packet_as_string)
-
-					# Trigger upload to habhub here.
-			else:
-				logging.debug("Not enough packets to decode previous image.")
-
-			# Now set up for the new image.
-			current_image = packet_info['image_id']
-			current_callsign = packet_info['callsign']
-			current_packet_count = 1
-			current_packet_time = datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%SZ")
-			# Open file and write in first packet.
-			temp_f = open("rxtemp.bin" , "wb")
-			temp_f.write(data)
-
-		else:
-			# Write current packet into temp file.
-			temp_f.write(data)
-			current_packet_count += 1
-
-			if args.partialupdate != 0:
-				if current_packet_count % int(args.partialupdate) == 0:
-					# Run the SSDV decoder and push a partial update to the GUI.
-					temp_f.flush()
-					returncode = os.system("ssdv -d rxtemp.bin rxtemp.jpg 2>/dev/null > /dev/null")
-					if returncode == 0:
-						logging.debug("Wrote out partial update of image ID #%d" % current_image)
-						trigger_gui_update(os.path.abspath("rxtemp.jpg"), packet_as_string)
+			images[_key] = {
+				'callsign': packet_info['callsign'],
+				'image_id': packet_info['image_id'],
+				'time': datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%SZ"),
+				'packets': {},
+				'packet_count': 0,
+				'decoded_packets': 0,
+				'last_packet': None,
+				'last_rx': time.time()
+			}
+
+		image = images[_key]
+		image['packets'][packet_info['packet_id']] = data
+		image['packet_count'] += 1
+		image['last_rx'] = time.time()
+		if packet_info['eoi']:
+			image['last_packet'] = packet_info['packet_id']
+
+		if image_complete(image) and image['decoded_packets'] < len(image['packets']):
+			decode_image(image, packet_as_string)
+
+		elif args.partialupdate != 0:
+			if image['packet_count'] % int(args.partialupdate) == 0:
+				# Run the SSDV decoder and push a partial update to the GUI.
+				write_image_file(image['packets'])
+				returncode = os.system("ssdv -d rxtemp.bin rxtemp.jpg 2>/dev/null > /dev/null")
+				if returncode == 0:
+					logging.debug("Wrote out partial update of image ID #%d" % image['image_id'])
+					trigger_gui_update(os.path.abspath("rxtemp.jpg"), packet_as_string, image_links.get(image['image_id']))
 	else:
 		logging.debug("Unknown Packet Format.")
\ No newline at end of file
@@ -0,0 +1 @@
+../tx/ssdv_erasure.py
\ No newline at end of file
@@ -83,7 +83,7 @@ def update_client_display(data):
 
 
 
-def update_image(filename, description):
+def update_image(filename, description, capture_id=None, thumbnail=False):
     global latest_image, latest_image_lock
     try:
         with open(filename, 'rb') as _new_image:
@@ -94,7 +94,12 @@ def update_image(filename, description):
         latest_image_lock.release()
 
         # Trigger the clients to update.
-        flask_emit_event('image_update', data={'text':description})
+        _update = {'text':description}
+        if capture_id != None:
+            # Progressive transmission - the thumbnail and full resolution images share a capture ID.
+            _update['capture_id'] = capture_id
+            _update['thumbnail'] = thumbnail
+        flask_emit_event('image_update', data=_update)
 
         logging.debug("Loaded new image: %s" % filename)
 
@@ -130,7 +135,7 @@ def process_udp(packet):
 
     if 'filename' in packet_dict:
         # New image to load
-        update_image(packet_dict['filename'], packet_dict['text'])
+        update_image(packet_dict['filename'], packet_dict['text'], packet_dict.get('capture_id'), packet_dict.get('thumbnail', False))
 
     elif 'uploader_status' in packet_dict:
         # Information from the uploader process.
@@ -29,6 +29,7 @@ import datetime
 import json
 import serial
 from threading import Thread
+from StateSnapshot import StateSnapshot
 
 
 # I2C addresses
@@ -710,7 +711,8 @@ class BNO055(object):
 class WenetBNO055(object):
     """ Wenet BNO055 Absolute Orientation Sensor Abstraction Layer """
 
-    # Internal state dictionary, which is updated at a user-defined rate.
+    # Initial values of the internal state dictionary, which is updated at a user-defined rate.
+    # The live state is held in a StateSnapshot (refer StateSnapshot.py), and is accessed via read_state().
     state = {
         # BNO055 Status Information
         'sys_status':   0,
@@ -801,6 +803,7 @@ class WenetBNO055(object):
         self.callback_decimation = callback_decimation
         self.debug_ptr = debug_ptr
         self.raw_sensor_data = raw_sensor_data
+        self.state_snapshot = StateSnapshot(self.state)
 
         # Open log file, if one has been given.
         if log_file != None:
@@ -850,32 +853,16 @@ class WenetBNO055(object):
         else:
             print(message)
 
-    # Lock files for writing and reading to the internal state dictionary.
-    state_writelock = False
-    state_readlock = False
-    state_blockwrite = False
-
     # Thread-safe read/write access into the internal state dictionary
-    def write_state(self, value, parameter, block_write=False):
-        """ (Hopefully) thread-safe state dictionary write access """
-        while self.state_readlock:
-            pass
-
-        self.state_writelock = True
-        self.state[value] = parameter
-        if not self.state_blockwrite:
-            self.state_writelock = False
+    def write_state(self, value, parameter):
+        """ Thread-safe state dictionary write access.
+        Within a self.state_snapshot.block_write() block, the value is not visible to readers until the block ends.
+        """
+        self.state_snapshot.write(value, parameter)
 
     def read_state(self):
-        """ Thread-safe state dictionary read access. """
-        while self.state_writelock:
-            pass
-
-        self.state_readlock = True
-        state_copy = self.state.copy()
-        self.state_readlock = False
-
-        return state_copy
+        """ Thread-safe state dictionary read access. Never blocks. """
+        return self.state_snapshot.read()
 
     def bno_callback(self):
         """ Pass the latest state to an external callback function """
@@ -920,46 +907,41 @@ class WenetBNO055(object):
 
 
                 # Write into state dictionary as a block, so users can't request a half-updated state dict.
-                self.state_blockwrite = True # This locks the state writelock on.
-
-                self.write_state('timestamp', start_timestamp)
-                self.write_state('isotime', start_isotime)
-                self.write_state('sys_status',status)
-                self.write_state('sys_error',error)
-                self.write_state('sys_cal', sys)
-                self.write_state('gyro_cal', gyro)
-                self.write_state('accel_cal', accel)
-                self.write_state('magnet_cal', mag)
-                self.write_state('temp', temp)
-                self.write_state('euler_heading', heading)
-                self.write_state('euler_roll', roll)
-                self.write_state('euler_pitch', pitch)
-                self.write_state('quaternion_x', quaternion_x)
-                self.write_state('quaternion_y', quaternion_y)
-                self.write_state('quaternion_z', quaternion_z)
-                self.write_state('quaternion_w', quaternion_w)
-                if self.raw_sensor_data:
-                    self.write_state('magnet_x', magnet_x)
-                    self.write_state('magnet_y', magnet_y)
-                    self.write_state('magnet_z', magnet_z)
-                    self.write_state('accel_x', accel_x)
-                    self.write_state('accel_y', accel_y)
-                    self.write_state('accel_z', accel_z)
-                    self.write_state('gyro_x', gyro_x)
-                    self.write_state('gyro_y', gyro_y)
-                    self.write_state('gyro_z', gyro_z)
-                    self.write_state('linear_accel_x', linear_accel_x)
-                    self.write_state('linear_accel_y', linear_accel_y)
-                    self.write_state('linear_accel_z', linear_accel_z)
-                    self.write_state('gravity_accel_x', gravity_accel_x)
-                    self.write_state('gravity_accel_y', gravity_accel_y)
-                    self.write_state('gravity_accel_z', gravity_accel_z)
-                    self.write_state('raw_sensor_data', True)
-                self.write_state('valid', True)
-
-                # Clear write locks.
-                self.state_blockwrite = False
-                self.state_writelock = False
+                with self.state_snapshot.block_write():
+                    self.write_state('timestamp', start_timestamp)
+                    self.write_state('isotime', start_isotime)
+                    self.write_state('sys_status',status)
+                    self.write_state('sys_error',error)
+                    self.write_state('sys_cal', sys)
+                    self.write_state('gyro_cal', gyro)
+                    self.write_state('accel_cal', accel)
+                    self.write_state('magnet_cal', mag)
+                    self.write_state('temp', temp)
+                    self.write_state('euler_heading', heading)
+                    self.write_state('euler_roll', roll)
+                    self.write_state('euler_pitch', pitch)
+                    self.write_state('quaternion_x', quaternion_x)
+                    self.write_state('quaternion_y', quaternion_y)
+                    self.write_state('quaternion_z', quaternion_z)
+                    self.write_state('quaternion_w', quaternion_w)
+                    if self.raw_sensor_data:
+                        self.write_state('magnet_x', magnet_x)
+                        self.write_state('magnet_y', magnet_y)
+                        self.write_state('magnet_z', magnet_z)
+                        self.write_state('accel_x', accel_x)
+                        self.write_state('accel_y', accel_y)
+                        self.write_state('accel_z', accel_z)
+                        self.write_state('gyro_x', gyro_x)
+                        self.write_state('gyro_y', gyro_y)
+                        self.write_state('gyro_z', gyro_z)
+                        self.write_state('linear_accel_x', linear_accel_x)
+                        self.write_state('linear_accel_y', linear_accel_y)
+                        self.write_state('linear_accel_z', linear_accel_z)
+                        self.write_state('gravity_accel_x', gravity_accel_x)
+                        self.write_state('gravity_accel_y', gravity_accel_y)
+                        self.write_state('gravity_accel_z', gravity_accel_z)
+                        self.write_state('raw_sensor_data', True)
+                    self.write_state('valid', True)
 
                 if self.rx_counter % self.callback_decimation == 0:
                     # Send data to the callback function.
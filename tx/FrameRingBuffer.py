@@ -0,0 +1,499 @@
+#!/usr/bin/env python2.7
+#
+# Wenet Frame Ring Buffer
+#
+#   Copyright (C) 2018  Mark Jessop <vk5qi@rfhead.net>
+#   Released under GNU GPL v3 or later
+#
+# A fixed-slot ring buffer of transmit frames, stored in a single preallocated
+# block of memory. Used in place of a Queue of strings by PacketTX, to avoid
+# allocating (and garbage collecting) thousands of small frame strings.
+#
+# Also contains the FrameCompletion, which callers can wait on until a queued frame has been sent,
+# the FrameCarousel, a cache of recently transmitted SSDV frames
+# which are re-sent when the transmitter would otherwise be idle, and the FrameCache,
+# which stores the frames of repeated packets so they are only encoded once.
+#
+
+import Queue
+import numpy as np
+from threading import Lock, Condition, Event
+from time import time
+from collections import OrderedDict
+
+
+class FrameCompletion(object):
+    """ Completion of a queued frame, which the producer can wait on.
+
+    result is None while the frame is waiting in its queue, and is then one of:
+        'sent' - The frame has been handed to the serial port.
+        'expired' - The frame's deadline passed before it could be sent.
+        'superseded' - A newer frame with the same supersede key replaced it.
+    """
+
+    def __init__(self):
+        self.event = Event()
+        self.result = None
+
+    def set(self, result):
+        self.result = result
+        self.event.set()
+
+    def done(self):
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        """ Wait for the frame to leave its queue. Returns the result, or None on timeout. """
+        self.event.wait(timeout)
+        return self.result
+
+
+class FrameRingBuffer(object):
+    """ Fixed-slot Frame Ring Buffer
+
+    Frames are stored in a (num_slots, frame_length) uint8 array, with head and tail
+    indexes pointing to the next slot to be read and written respectively.
+
+    Producers can either put() a complete frame (which is copied into a slot), or
+    reserve() a slot, frame a packet directly into it, and then commit() it.
+    Slots are only made available to the consumer once committed, so multiple
+    producers can frame into reserved slots at the same time.
+
+    A single consumer reads frames with get(), or writes them straight out of
+    their slot to a serial port (or any object with a write() method) with write_to().
+
+    If the event attribute is set to a threading.Event, it is set every time a frame is
+    committed. This allows a consumer to wait on several buffers at once.
+
+    Frames can optionally be committed with a deadline, after which they are discarded
+    rather than transmitted, and a supersede key. Committing a frame with the same key as a
+    frame still waiting in the buffer discards the older frame.
+
+    Frames can also be committed with a FrameCompletion, which is set when the frame
+    leaves the buffer.
+
+    The put/get functions follow the semantics of Queue.Queue, and raise
+    Queue.Full and Queue.Empty when used in non-blocking mode.
+    """
+
+    def __init__(self, num_slots=4096, frame_length=343):
+        """ Instantiate a FrameRingBuffer.
+
+        Keyword Arguments:
+        num_slots: Number of frame slots in the buffer.
+        frame_length: Maximum length of a frame, in bytes.
+        """
+        self.num_slots = num_slots
+        self.frame_length = frame_length
+
+        # Frame storage, and per-slot state.
+        self.buffer = np.zeros((num_slots, frame_length), dtype=np.uint8)
+        self.lengths = [0]*num_slots
+        self.committed = [False]*num_slots
+        # Time each frame was committed (enqueued), used for latency measurements.
+        self.timestamps = [0.0]*num_slots
+        # Optional per-slot deadline (absolute time) and supersede key.
+        self.deadlines = [None]*num_slots
+        self.keys = [None]*num_slots
+        # Optional per-slot FrameCompletion.
+        self.completions = [None]*num_slots
+        # Slot index of the newest waiting frame for each supersede key.
+        self.key_slots = {}
+
+        # Set while the consumer holds a view of the head slot (between get_slot and release_slot).
+        self.reading = False
+
+        # Number of frames discarded because their deadline passed, or they were superseded.
+        self.expired = 0
+        self.superseded = 0
+
+        # Next slot to be read, next slot to be written, and number of slots in use (reserved or committed).
+        self.head = 0
+        self.tail = 0
+        self.count = 0
+
+        self.lock = Lock()
+        self.not_empty = Condition(self.lock)
+        self.not_full = Condition(self.lock)
+
+        # Optional event, set whenever a frame is committed.
+        self.event = None
+
+
+    def _wait(self, condition, predicate, block, timeout, exception):
+        """ Wait on a condition (with self.lock held) until predicate() is True. """
+        if not block:
+            if not predicate():
+                raise exception
+        elif timeout is None:
+            while not predicate():
+                condition.wait()
+        else:
+            end_time = time() + timeout
+            while not predicate():
+                remaining = end_time - time()
+                if remaining <= 0.0:
+                    raise exception
+                condition.wait(remaining)
+
+
+    def reserve(self, block=True, timeout=None):
+        """ Reserve the next free slot.
+
+        Returns a tuple of (slot index, slot array). The frame should be written into the
+        slot array, and then commit() called with the slot index and frame length.
+        """
+        with self.lock:
+            self._wait(self.not_full, lambda: self.count < self.num_slots, block, timeout, Queue.Full)
+
+            _index = self.tail
+            self.committed[_index] = False
+            self.deadlines[_index] = None
+            self.keys[_index] = None
+            self.completions[_index] = None
+            self.tail = (self.tail + 1) % self.num_slots
+            self.count += 1
+
+        return (_index, self.buffer[_index])
+
+
+    def commit(self, index, length=None, deadline=None, key=None, completion=None):
+        """ Mark a reserved slot as ready for transmission.
+
+        Keyword Arguments:
+        index: The slot index, as returned by reserve().
+        length: The length of the frame in the slot. Defaults to the full slot length.
+                A length of 0 cancels the slot, which will be skipped by the consumer.
+        deadline: Optional time (as per time.time()) after which the frame is discarded instead of transmitted.
+        key: Optional supersede key. Any frame with the same key still waiting in the buffer is discarded.
+        completion: Optional FrameCompletion, set when the frame leaves the buffer.
+        """
+        if length is None:
+            length = self.frame_length
+
+        _now = time()
+
+        with self.lock:
+            self.lengths[index] = length
+            self.timestamps[index] = _now
+            self.deadlines[index] = deadline
+            self.completions[index] = completion
+
+            if key is not None and length > 0:
+                _old = self.key_slots.get(key)
+                if _old is not None and self.keys[_old] == key and self.lengths[_old] > 0 and not (_old == self.head and self.reading):
+                    # Cancel the older frame. It will be skipped when it reaches the head of the buffer.
+                    self.lengths[_old] = 0
+                    self.superseded += 1
+                    if self.completions[_old] is not None:
+                        self.completions[_old].set('superseded')
+                        self.completions[_old] = None
+                self.keys[index] = key
+                self.key_slots[key] = index
+
+            self.committed[index] = True
+            self.not_empty.notify()
+
+        if self.event is not None:
+            self.event.set()
+
+
+    def put(self, frame, block=True, timeout=None):
+        """ Copy a complete frame (a string or uint8 array) into the next free slot. """
+        if isinstance(frame, np.ndarray):
+            data = frame
+        else:
+            data = np.frombuffer(frame, dtype=np.uint8)
+
+        if len(data) > self.frame_length:
+            raise ValueError("Frame is longer than the slot length (%d bytes)" % self.frame_length)
+
+        (_index, _slot) = self.reserve(block=block, timeout=timeout)
+        _slot[:len(data)] = data
+        self.commit(_index, len(data))
+
+
+    def put_nowait(self, frame):
+        return self.put(frame, block=False)
+
+
+    def _skip_cancelled(self):
+        """ Release any cancelled (zero length) or expired slots at the head of the buffer. Called with self.lock held. """
+        _now = None
+        # Never release the slot the consumer is currently reading.
+        while self.count > 0 and self.committed[self.head] and not self.reading:
+            if self.lengths[self.head] == 0:
+                self._release('cancelled')
+                continue
+
+            _deadline = self.deadlines[self.head]
+            if _deadline is not None:
+                if _now is None:
+                    _now = time()
+                if _now > _deadline:
+                    self.expired += 1
+                    self._release('expired')
+                    continue
+
+            break
+
+
+    def _head_ready(self):
+        self._skip_cancelled()
+        return self.count > 0 and self.committed[self.head]
+
+
+    def _release(self, result):
+        """ Free the head slot, setting its completion (if any) to result. Called with self.lock held. """
+        if self.completions[self.head] is not None:
+            self.completions[self.head].set(result)
+            self.completions[self.head] = None
+
+        _key = self.keys[self.head]
+        if _key is not None:
+            if self.key_slots.get(_key) == self.head:
+                del self.key_slots[_key]
+            self.keys[self.head] = None
+
+        self.reading = False
+        self.committed[self.head] = False
+        self.head = (self.head + 1) % self.num_slots
+        self.count -= 1
+        self.not_full.notify()
+
+
+    def get_slot(self, block=True, timeout=None):
+        """ Get a view of the frame in the head slot, without copying it.
+
+        The slot remains owned by the buffer until release_slot() is called, after which
+        the view must no longer be used. Only a single consumer may use this function.
+        """
+        with self.lock:
+            self._wait(self.not_empty, self._head_ready, block, timeout, Queue.Empty)
+            self.reading = True
+            return self.buffer[self.head, :self.lengths[self.head]]
+
+
+    def head_timestamp(self):
+        """ Return the time the frame at the head of the buffer was enqueued.
+        Only valid between get_slot() and release_slot().
+        """
+        return self.timestamps[self.head]
+
+
+    def release_slot(self):
+        """ Release the head slot, after it has been read with get_slot(). """
+        with self.lock:
+            self._release('sent')
+
+
+    def get(self, block=True, timeout=None):
+        """ Remove and return the next frame, as a string. """
+        _frame = self.get_slot(block=block, timeout=timeout).tostring()
+        self.release_slot()
+        return _frame
+
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+
+    def write_to(self, sink, block=True, timeout=None):
+        """ Write the next frame directly from its slot to a sink (i.e. a serial port),
+        then release the slot.
+
+        Returns the number of bytes written. Raises Queue.Empty if no frame is available.
+        """
+        _frame = self.get_slot(block=block, timeout=timeout)
+        try:
+            sink.write(memoryview(_frame))
+        finally:
+            self.release_slot()
+
+        return len(_frame)
+
+
+    def ready(self):
+        """ Return True if a committed frame is waiting at the head of the buffer. """
+        with self.lock:
+            return self._head_ready()
+
+
+    def qsize(self):
+        """ Return the number of frames in the buffer, including slots still being framed. """
+        with self.lock:
+            return self.count
+
+
+    def empty(self):
+        return self.qsize() == 0
+
+
+    def full(self):
+        return self.qsize() == self.num_slots
+
+
+    def discard_stats(self):
+        """ Return a dictionary of the number of frames discarded because they expired or were superseded. """
+        with self.lock:
+            return {'expired': self.expired, 'superseded': self.superseded}
+
+
+class FrameCarousel(object):
+    """ Bounded cache of the most recently transmitted SSDV frames of the latest images.
+
+    When the transmitter would otherwise be idle, frames are re-sent from this cache,
+    least-recently-sent first, so a ground station which missed packets can fill in
+    the holes in the image without needing an uplink.
+
+    Frames are keyed on the SSDV callsign, image ID and packet ID. When the last packet
+    (the one with the EOI flag set) of an image is sent, the frames of any images which
+    finished before it are discarded. Images which are still being sent (i.e. a full resolution
+    image interrupted by the next thumbnail) are kept.
+    """
+
+    def __init__(self, num_slots=1024, frame_length=343, payload_offset=20):
+        """
+        Keyword Arguments:
+        num_slots: Maximum number of frames to cache.
+        frame_length: Maximum length of a frame, in bytes.
+        payload_offset: Offset of the SSDV packet within a frame.
+        """
+        self.num_slots = num_slots
+        self.frame_length = frame_length
+        self.payload_offset = payload_offset
+
+        self.buffer = np.zeros((num_slots, frame_length), dtype=np.uint8)
+        self.lengths = [0]*num_slots
+
+        # Slots of the cached frames, keyed by (image key, packet ID), least-recently-sent first.
+        self.order = OrderedDict()
+        # Cached packet IDs of each image (keyed by callsign + image ID), and the images which have finished.
+        self.images = {}
+        self.finished = set()
+        self.free_slots = range(num_slots)
+
+        self.lock = Lock()
+
+
+    def _discard_image(self, image_key):
+        """ Drop all cached frames of an image. Must be called with the lock held. """
+        for _packet_id in self.images.pop(image_key, ()):
+            self.free_slots.append(self.order.pop((image_key, _packet_id)))
+        self.finished.discard(image_key)
+
+
+    def add(self, frame):
+        """ Add a transmitted SSDV frame to the carousel. Frames which are not SSDV packets
+        (i.e. erasure coding repair packets) are ignored.
+        """
+        _payload = frame[self.payload_offset:]
+        if _payload[0] != 0x55:
+            return
+        _image_key = _payload[2:7].tostring()
+        _packet_id = (int(_payload[7]) << 8) + int(_payload[8])
+        _eoi = (int(_payload[11]) >> 2) & 1
+        _key = (_image_key, _packet_id)
+
+        with self.lock:
+            _slot = self.order.pop(_key, None)
+            if _slot is not None:
+                # Already cached - just mark it as recently sent.
+                self.order[_key] = _slot
+            else:
+                if len(self.free_slots) > 0:
+                    _slot = self.free_slots.pop()
+                else:
+                    # Evict the least-recently-sent frame.
+                    (_old_key, _slot) = self.order.popitem(last=False)
+                    _old_packets = self.images[_old_key[0]]
+                    _old_packets.discard(_old_key[1])
+                    if len(_old_packets) == 0:
+                        del self.images[_old_key[0]]
+                        self.finished.discard(_old_key[0])
+
+                self.buffer[_slot, :len(frame)] = frame
+                self.lengths[_slot] = len(frame)
+                self.order[_key] = _slot
+                self.images.setdefault(_image_key, set()).add(_packet_id)
+
+            if _eoi and _image_key not in self.finished:
+                # This image has been sent in full, so the images which finished before it are no longer needed.
+                for _finished_key in list(self.finished):
+                    self._discard_image(_finished_key)
+                self.finished.add(_image_key)
+
+
+    def next_frame(self):
+        """ Return a view of the least-recently-sent frame, and mark it as sent.
+        Returns None if the carousel is empty.
+        """
+        with self.lock:
+            if len(self.order) == 0:
+                return None
+
+            (_key, _slot) = self.order.popitem(last=False)
+            self.order[_key] = _slot
+            return self.buffer[_slot, :self.lengths[_slot]]
+
+
+    def __len__(self):
+        return len(self.order)
+
+
+class FrameCache(object):
+    """ Least-recently-used cache of framed packets, keyed by the packet contents.
+
+    Used for packets which are transmitted more than once (repeated telemetry packets,
+    idle and status messages), so the CRC and LDPC parity are only calculated once.
+    """
+
+    def __init__(self, max_entries=64):
+        """
+        Keyword Arguments:
+        max_entries: Maximum number of frames to cache.
+        """
+        self.max_entries = max_entries
+        self.frames = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+        self.lock = Lock()
+
+
+    def get(self, key):
+        """ Return the cached frame (a uint8 array) for a packet, or None if it is not cached. """
+        with self.lock:
+            _frame = self.frames.pop(key, None)
+            if _frame is None:
+                self.misses += 1
+                return None
+
+            # Re-insert, to mark as most recently used.
+            self.frames[key] = _frame
+            self.hits += 1
+            return _frame
+
+
+    def put(self, key, frame):
+        """ Store a copy of a frame. """
+        with self.lock:
+            if key in self.frames:
+                del self.frames[key]
+            elif len(self.frames) >= self.max_entries:
+                self.frames.popitem(last=False)
+
+            self.frames[key] = np.array(frame, dtype=np.uint8)
+
+
+    def stats(self):
+        """ Return a dictionary of the cache hit/miss counters. """
+        with self.lock:
+            _lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / max(_lookups, 1),
+                'entries': len(self.frames)
+            }
@@ -0,0 +1,182 @@
+#!/usr/bin/env python2.7
+#
+# Wenet GPS Track Encoder
+#
+#   Copyright (C) 2018  Mark Jessop <vk5qi@rfhead.net>
+#   Released under GNU GPL v3 or later
+#
+# Buffers high-rate (i.e. 10 Hz) GPS fixes from the UBloxGPS class, and packs them into
+# GPS track packets, containing one absolute fix followed by many small delta-encoded fixes.
+#
+# GPS Track Packet Format (all values big endian):
+#   0:      Packet Type (0x05)
+#   1-2:    GPS Week (uint16)
+#   3-6:    GPS Time-of-week of the first fix, in milliseconds (uint32)
+#   7:      GPS Leap Seconds (uint8)
+#   8:      GPS Fix Type of the last fix (uint8)
+#   9:      Number of satellites used in the last fix (uint8)
+#   10-13:  Latitude of the first fix, in units of 1e-7 degrees (int32)
+#   14-17:  Longitude of the first fix, in units of 1e-7 degrees (int32)
+#   18-21:  Altitude of the first fix, in cm (int32)
+#   22:     Number of delta records (N)
+#   Then N delta records, each relative to the previous fix:
+#   0:      Time delta, in units of 10 ms (uint8)
+#   1-2:    Latitude delta, in units of 1e-6 degrees (int16)
+#   3-4:    Longitude delta, in units of 1e-6 degrees (int16)
+#   5-6:    Altitude delta, in cm (int16)
+#
+# The corresponding decoder is within rx/WenetPackets.py, in the function gps_track_decode.
+#
+
+import struct
+
+GPS_TRACK_PACKET_TYPE = 0x05
+GPS_TRACK_HEADER_FORMAT = ">BHIBBBiiiB"
+GPS_TRACK_DELTA_FORMAT = ">Bhhh"
+GPS_TRACK_HEADER_LENGTH = struct.calcsize(GPS_TRACK_HEADER_FORMAT)
+GPS_TRACK_DELTA_LENGTH = struct.calcsize(GPS_TRACK_DELTA_FORMAT)
+
+# Quantisation of the absolute fix, and of the deltas.
+GPS_TRACK_ABS_SCALE = 1e7
+GPS_TRACK_DELTA_SCALE = 1e6
+GPS_TRACK_ALT_SCALE = 100.0
+GPS_TRACK_TIME_SCALE = 100.0
+
+
+class GPSTrackEncoder(object):
+    """ GPS Track Encoder
+
+    GPS states (as produced by the UBloxGPS class) are added with add(). A track packet
+    is completed when it is full, when the next fix cannot be represented as a delta
+    (i.e. a large jump in position, or a gap in fixes), or once it spans max_duration seconds.
+
+    Deltas are calculated against the previous fix as it will be reconstructed by the
+    receiver, so quantisation errors do not accumulate along the track.
+    """
+
+    def __init__(self, payload_length=256, max_duration=2.0, min_fix=2):
+        """
+        Keyword Arguments:
+        payload_length: Maximum length of a packet.
+        max_duration: Maximum span (seconds) of fixes in one packet. This bounds the latency of the track.
+        min_fix: Fixes with a GPS fix type lower than this are not added to the track.
+        """
+        self.max_deltas = min(255, (payload_length - GPS_TRACK_HEADER_LENGTH) // GPS_TRACK_DELTA_LENGTH)
+        self.max_duration = max_duration
+        self.min_fix = min_fix
+
+        self.first = None
+        self.last = None
+        self.deltas = []
+        self.latest_state = None
+
+
+    def _quantise(self, gps_data):
+        """ Convert a GPS state into a tuple of integer time (ms), latitude, longitude (1e-7 degrees) and altitude (cm). """
+        return (
+            int(round(gps_data['iTOW']*1000)),
+            int(round(gps_data['latitude']*GPS_TRACK_ABS_SCALE)),
+            int(round(gps_data['longitude']*GPS_TRACK_ABS_SCALE)),
+            int(round(gps_data['altitude']*GPS_TRACK_ALT_SCALE))
+        )
+
+
+    def _delta(self, fix):
+        """ Calculate the delta record from the last fix to a new fix.
+        Returns a (record, reconstructed fix) tuple, or None if the delta cannot be represented.
+        """
+        _scale = int(GPS_TRACK_ABS_SCALE/GPS_TRACK_DELTA_SCALE)
+
+        _dt = int(round((fix[0] - self.last[0])/(1000.0/GPS_TRACK_TIME_SCALE)))
+        _dlat = int(round(float(fix[1] - self.last[1])/_scale))
+        _dlon = int(round(float(fix[2] - self.last[2])/_scale))
+        _dalt = fix[3] - self.last[3]
+
+        if not (0 < _dt <= 255):
+            return None
+
+        for _value in (_dlat, _dlon, _dalt):
+            if not (-32768 <= _value <= 32767):
+                return None
+
+        _reconstructed = (
+            self.last[0] + _dt*int(1000/GPS_TRACK_TIME_SCALE),
+            self.last[1] + _dlat*_scale,
+            self.last[2] + _dlon*_scale,
+            self.last[3] + _dalt
+        )
+
+        return (struct.pack(GPS_TRACK_DELTA_FORMAT, _dt, _dlat, _dlon, _dalt), _reconstructed)
+
+
+    def _start(self, gps_data, fix):
+        self.first = (gps_data, fix)
+        self.last = fix
+        self.deltas = []
+
+
+    def packet(self):
+        """ Build a track packet from the currently buffered fixes. Returns None if there are none. """
+        if self.first is None:
+            return None
+
+        (_gps_data, _fix) = self.first
+        _latest = self.latest_state
+
+        _packet = struct.pack(GPS_TRACK_HEADER_FORMAT,
+            GPS_TRACK_PACKET_TYPE,
+            _gps_data['week'],
+            _fix[0],
+            _gps_data['leapS'],
+            _latest['gpsFix'],
+            _latest['numSV'],
+            _fix[1],
+            _fix[2],
+            _fix[3],
+            len(self.deltas)
+            )
+
+        return _packet + "".join(self.deltas)
+
+
+    def flush(self):
+        """ Return a packet containing any buffered fixes (or None), and clear the buffer. """
+        _packet = self.packet()
+        self.first = None
+        self.last = None
+        self.deltas = []
+        return _packet
+
+
+    def add(self, gps_data):
+        """ Add a GPS state to the track.
+        Returns a list of completed track packets (usually empty).
+        """
+        if gps_data['gpsFix'] < self.min_fix:
+            return []
+
+        _packets = []
+        _fix = self._quantise(gps_data)
+
+        if self.first is None:
+            self._start(gps_data, _fix)
+        else:
+            _delta = None
+            if gps_data['week'] == self.first[0]['week']:
+                _delta = self._delta(_fix)
+
+            if _delta is None:
+                # Cannot be represented as a delta - start a new packet from this fix.
+                _packets.append(self.flush())
+                self._start(gps_data, _fix)
+            else:
+                (_record, self.last) = _delta
+                self.deltas.append(_record)
+
+        self.latest_state = gps_data
+
+        # Send the packet if it is full, or spans the maximum duration.
+        if len(self.deltas) >= self.max_deltas or (self.last[0] - self.first[1][0]) >= self.max_duration*1000:
+            _packets.append(self.flush())
+
+        return _packets
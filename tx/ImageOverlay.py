@@ -0,0 +1,297 @@
+#!/usr/bin/env python2.7
+#
+# Wenet Image Overlays
+#
+#   Copyright (C) 2018  Mark Jessop <vk5qi@rfhead.net>
+#   Released under GNU GPL v3 or later
+#
+# In-process post-processing stages (gamma correction, text and logo overlays), which
+# operate on the decoded image as a NumPy array, in between decoding the captured JPEG and
+# resizing it for SSDV encoding (refer ssdv_encoder.resize_image). This avoids re-encoding
+# the JPEG, and running ImageMagick, for every image.
+#
+# A stage is any function which accepts a (height, width, 3) uint8 RGB array, and modifies it
+# in place (returning None), or returns a new array.
+#
+# Overlays are alpha-composited in integer arithmetic as:
+#   out = (image*(255 - alpha) + colour*alpha + 127) / 255
+# where colour*alpha (the premultiplied overlay) is calculated once, and cached.
+#
+
+import numpy as np
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:
+    Image = None
+
+
+# Fonts to try for text overlays, before falling back to PIL's built-in font.
+OVERLAY_FONTS = [
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
+    "/usr/share/fonts/truetype/freefont/FreeSansBold.ttf",
+    "DejaVuSans-Bold.ttf"
+]
+
+
+def overlays_available():
+    """ Returns True if the in-process post-processing stages can be used. """
+    return Image is not None
+
+
+def _composite(pixels, x, y, premultiplied, inverse_alpha):
+    """ Composite a premultiplied overlay onto pixels (in place), with its top-left corner at (x,y).
+    The overlay is clipped to the image.
+    """
+    (_height, _width) = pixels.shape[:2]
+    (_o_height, _o_width) = inverse_alpha.shape[:2]
+
+    # Clip the overlay to the image.
+    _x0 = max(x, 0)
+    _y0 = max(y, 0)
+    _x1 = min(x + _o_width, _width)
+    _y1 = min(y + _o_height, _height)
+    if _x1 <= _x0 or _y1 <= _y0:
+        return
+
+    _region = pixels[_y0:_y1, _x0:_x1]
+    _premultiplied = premultiplied[_y0-y:_y1-y, _x0-x:_x1-x]
+    _inverse_alpha = inverse_alpha[_y0-y:_y1-y, _x0-x:_x1-x]
+
+    _region[:] = ((_region.astype(np.uint32)*_inverse_alpha + _premultiplied + 127) // 255).astype(np.uint8)
+
+
+def _position(gravity, image_size, overlay_size, offset):
+    """ Position an overlay within an image, ImageMagick style.
+    Returns the (x,y) coordinate of the overlay's top-left corner.
+
+    Keyword Arguments:
+    gravity: One of 'North', 'South', 'East', 'West', 'NorthEast', 'NorthWest', 'SouthEast', 'SouthWest', 'Center'.
+    image_size: (width, height) of the image.
+    overlay_size: (width, height) of the overlay.
+    offset: (x,y) offset from the edge(s) the overlay is placed against.
+    """
+    (_width, _height) = image_size
+    (_o_width, _o_height) = overlay_size
+
+    if 'West' in gravity:
+        _x = offset[0]
+    elif 'East' in gravity:
+        _x = _width - _o_width - offset[0]
+    else:
+        _x = (_width - _o_width)//2 + offset[0]
+
+    if 'North' in gravity:
+        _y = offset[1]
+    elif 'South' in gravity:
+        _y = _height - _o_height - offset[1]
+    else:
+        _y = (_height - _o_height)//2 + offset[1]
+
+    return (_x, _y)
+
+
+class GammaStage(object):
+    """ Apply gamma correction to the image, via a cached lookup table. """
+
+    def __init__(self, gamma=0.8):
+        """
+        Keyword Arguments:
+        gamma: Gamma value, as per ImageMagick's -gamma option (values < 1 darken the image).
+        """
+        self.lut = (255.0*(np.arange(256)/255.0)**(1.0/gamma) + 0.5).astype(np.uint8)
+
+    def __call__(self, pixels):
+        pixels[:] = self.lut[pixels]
+
+
+class LogoOverlay(object):
+    """ Overlay a logo (i.e. a PNG with transparency) onto the image.
+
+    The logo is loaded once. For each image size it is used with, it is scaled and
+    premultiplied by its alpha channel once, and cached.
+    """
+
+    def __init__(self, filename, gravity='SouthEast', offset=(0,0), width=None, reference_width=None):
+        """
+        Keyword Arguments:
+        filename: Logo image filename.
+        gravity: Where to place the logo (refer _position).
+        offset: (x,y) offset in pixels from the edge(s) of the image, at the logo's native scale.
+        width: Width of the logo, as a fraction of the image width.
+        reference_width: If width is not set, the logo is used at its native size on images of this width
+                         (i.e. the capture resolution), and scaled in proportion on images of other widths
+                         (i.e. when the JPEG decoder has down-scaled the image). If neither are set, the logo
+                         is always used at its native size.
+        """
+        self.logo = Image.open(filename).convert('RGBA')
+        self.gravity = gravity
+        self.offset = offset
+        self.width = width
+        self.reference_width = reference_width
+
+        # Premultiplied logo and inverse alpha arrays, and position, keyed by image size.
+        self.cache = {}
+
+    def _prepare(self, image_size):
+        if self.width is not None:
+            _scale = self.width*image_size[0]/float(self.logo.size[0])
+        elif self.reference_width is not None:
+            _scale = image_size[0]/float(self.reference_width)
+        else:
+            _scale = 1.0
+
+        _logo = self.logo
+        if _scale != 1.0:
+            _size = (max(1, int(round(_logo.size[0]*_scale))), max(1, int(round(_logo.size[1]*_scale))))
+            _logo = _logo.resize(_size, getattr(Image, 'LANCZOS', Image.ANTIALIAS))
+
+        _rgba = np.asarray(_logo, dtype=np.uint32)
+        _alpha = _rgba[:,:,3:4]
+        _premultiplied = _rgba[:,:,:3]*_alpha
+        _inverse_alpha = 255 - _alpha
+
+        _offset = (int(round(self.offset[0]*_scale)), int(round(self.offset[1]*_scale)))
+        _xy = _position(self.gravity, image_size, _logo.size, _offset)
+
+        return (_xy, _premultiplied, _inverse_alpha)
+
+    def __call__(self, pixels):
+        _image_size = (pixels.shape[1], pixels.shape[0])
+        if _image_size not in self.cache:
+            self.cache[_image_size] = self._prepare(_image_size)
+
+        ((_x, _y), _premultiplied, _inverse_alpha) = self.cache[_image_size]
+        _composite(pixels, _x, _y, _premultiplied, _inverse_alpha)
+
+
+class TextOverlay(object):
+    """ Overlay a line of text (i.e. GPS data) onto the image, with an outline so it is readable
+    against any background.
+    """
+
+    def __init__(self, text_ptr, gravity='North', offset=(0,5), font_size=30, reference_width=1920,
+            colour=(255,255,255), outline_colour=(0,0,0), outline_alpha=0.8, outline_width=2):
+        """
+        Keyword Arguments:
+        text_ptr: Function which returns the text to overlay, called for every image.
+        gravity: Where to place the text (refer _position).
+        offset: (x,y) offset in pixels from the edge(s) of the image, at reference_width.
+        font_size: Font size in pixels, at reference_width. Text is scaled with the image width.
+        reference_width: Image width at which font_size and offset apply.
+        colour: Text colour.
+        outline_colour: Outline colour.
+        outline_alpha: Opacity of the outline (0.0 - 1.0).
+        outline_width: Outline width in pixels, at reference_width.
+        """
+        self.text_ptr = text_ptr
+        self.gravity = gravity
+        self.offset = offset
+        self.font_size = font_size
+        self.reference_width = reference_width
+        self.colour = np.array(colour, dtype=np.uint32)
+        self.outline_colour = np.array(outline_colour, dtype=np.uint32)
+        self.outline_alpha = outline_alpha
+        self.outline_width = outline_width
+
+        # Fonts, keyed by size.
+        self.fonts = {}
+
+    def _font(self, size):
+        if size not in self.fonts:
+            _font = None
+            for _filename in OVERLAY_FONTS:
+                try:
+                    _font = ImageFont.truetype(_filename, size)
+                    break
+                except (IOError, OSError):
+                    continue
+
+            self.fonts[size] = _font if _font is not None else ImageFont.load_default()
+
+        return self.fonts[size]
+
+    def _stroke_mask(self, text, font, size, outline):
+        """ Render the text and its outline in one pass, using Pillow's stroke_width (Pillow 6.0 and later),
+        as an alpha mask of the given size, with the text itself at (outline, outline).
+        Returns None if this version of Pillow cannot draw stroked text.
+        """
+        # Pillow 6 and 7 place the top left of the outline at the given position, and later versions
+        # centre the outline on the text. Render with a margin, and line the outline up with the text.
+        _padded = (size[0] + 2*outline, size[1] + 2*outline)
+        _stroke = Image.new('L', _padded, 0)
+        try:
+            ImageDraw.Draw(_stroke).text((2*outline, 2*outline), text, font=font, fill=255, stroke_width=outline, stroke_fill=255)
+        except TypeError:
+            return None
+
+        _fill = Image.new('L', _padded, 0)
+        ImageDraw.Draw(_fill).text((2*outline, 2*outline), text, font=font, fill=255)
+
+        _shift = 0
+        (_stroke_box, _fill_box) = (_stroke.getbbox(), _fill.getbbox())
+        if _stroke_box is not None and _fill_box is not None and (_fill_box[0] - _stroke_box[0]) < outline/2.0:
+            _shift = outline
+
+        return _stroke.crop((outline + _shift, outline + _shift, outline + _shift + size[0], outline + _shift + size[1]))
+
+    def __call__(self, pixels):
+        _text = self.text_ptr()
+        if _text is None or _text == "":
+            return
+
+        _scale = pixels.shape[1]/float(self.reference_width)
+        _font = self._font(max(8, int(round(self.font_size*_scale))))
+        _outline = max(1, int(round(self.outline_width*_scale)))
+
+        # Render the text (and its outline) as alpha masks.
+        _draw = ImageDraw.Draw(Image.new('L', (1,1)))
+        if hasattr(_draw, 'textbbox'):
+            _bbox = _draw.textbbox((0,0), _text, font=_font)
+            (_text_width, _text_height) = (_bbox[2], _bbox[3])
+        else:
+            (_text_width, _text_height) = _draw.textsize(_text, font=_font)
+        _size = (_text_width + 2*_outline, _text_height + 2*_outline)
+
+        _fill = Image.new('L', _size, 0)
+        ImageDraw.Draw(_fill).text((_outline, _outline), _text, font=_font, fill=255)
+
+        _stroke = self._stroke_mask(_text, _font, _size, _outline)
+        if _stroke is None:
+            # Older versions of Pillow: draw the text at every offset within the outline width.
+            _stroke = Image.new('L', _size, 0)
+            _draw = ImageDraw.Draw(_stroke)
+            for _dx in range(-_outline, _outline+1):
+                for _dy in range(-_outline, _outline+1):
+                    _draw.text((_outline + _dx, _outline + _dy), _text, font=_font, fill=255)
+
+        _offset = (int(round(self.offset[0]*_scale)), int(round(self.offset[1]*_scale)))
+        (_x, _y) = _position(self.gravity, (pixels.shape[1], pixels.shape[0]), _size, _offset)
+
+        _stroke_alpha = (np.asarray(_stroke, dtype=np.uint32)*int(round(255*self.outline_alpha))//255)[:,:,np.newaxis]
+        _composite(pixels, _x, _y, self.outline_colour*_stroke_alpha, 255 - _stroke_alpha)
+
+        _fill_alpha = np.asarray(_fill, dtype=np.uint32)[:,:,np.newaxis]
+        _composite(pixels, _x, _y, self.colour*_fill_alpha, 255 - _fill_alpha)
+
+
+def apply_stages(img, stages):
+    """ Run post-processing stages on a PIL image. Returns the processed image. """
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    _pixels = np.array(img, dtype=np.uint8)
+    for _stage in stages:
+        _result = _stage(_pixels)
+        if _result is not None:
+            _pixels = _result
+
+    return Image.fromarray(_pixels, 'RGB')
+
+
+def apply_stages_to_file(filename, stages, jpeg_quality=95):
+    """ Run post-processing stages on a JPEG file, in place. Used when the image cannot be
+    SSDV-encoded in-process, so the stages cannot be run on the decoded image.
+    """
+    _img = apply_stages(Image.open(filename), stages)
+    _img.save(filename, format='JPEG', quality=jpeg_quality)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python2.7
+#
+# Wenet Image Pipeline
+#
+#   Copyright (C) 2018  Mark Jessop <vk5qi@rfhead.net>
+#   Released under GNU GPL v3 or later
+#
+# Runs the camera classes' capture -> post-process -> SSDV steps in a thread of their own,
+# separately to the step which hands the finished SSDV files to the transmitter.
+# This means the next image is captured and converted while the current image is
+# still being transmitted, and is queued as soon as the current image has (almost) been sent.
+#
+# The stages are connected by a bounded queue, so at most 'depth' finished images are
+# held waiting, and the camera does not run ahead of the transmitter.
+#
+
+import os
+import Queue
+import traceback
+from threading import Thread
+from time import sleep
+
+
+class ImagePipeline(object):
+    """ Image Capture / Transmit Pipeline
+
+    The encode function is called repeatedly (from a separate thread) with the image ID to use,
+    and must capture, post-process and SSDV-encode an image, returning either the SSDV filename,
+    or a (N, 256) array of SSDV packets (refer ssdv_encoder.py). It returns None if no image could
+    be produced, in which case it is called again, with the same image ID.
+
+    For progressive transmission, the encode function instead returns a (thumbnail, image) tuple,
+    using the image ID it was passed for the thumbnail, and the following image ID for the full
+    resolution image. The two are sent linked by a capture ID (refer PacketTX.queue_image_thumbnail).
+    The thumbnail is queued as soon as it is available, and is sent ahead of the rest of the previous
+    image. Only the full resolution image waits for the previous image to be sent.
+
+    An SSDV file must not be overwritten by the next call of the encode function, i.e. it
+    should have a unique filename per image.
+    """
+
+    def __init__(self, tx, encode_ptr, running_ptr, start_id=0, depth=1, low_water=4, poll_interval=0.05, debug_ptr=None):
+        """
+        Keyword Arguments:
+        tx: A reference to a PacketTX Object, which is used to transmit packets, and interrogate the TX queue.
+        encode_ptr: Function which produces an SSDV image, as described above.
+        running_ptr: Function which returns False when the pipeline should stop.
+        start_id: Starting image ID.
+        depth: Number of finished images which can be held waiting for the transmitter.
+        low_water: The next image is queued once this many (or fewer) SSDV packets are left to send.
+                   This should be enough packets to cover poll_interval, so the SSDV queue never runs dry.
+        poll_interval: Interval (seconds) at which the transmit queue is checked.
+        debug_ptr: Optional function which is passed log messages.
+        """
+        self.tx = tx
+        self.encode_ptr = encode_ptr
+        self.running_ptr = running_ptr
+        self.image_id = start_id % 256
+        self.capture_id = 0
+        self.low_water = low_water
+        self.poll_interval = poll_interval
+        self.debug_ptr = debug_ptr
+
+        self.encoded = Queue.Queue(maxsize=depth)
+        self.encode_thread = None
+
+
+    def debug_message(self, message):
+        message = "Image Pipeline: " + message
+        if self.debug_ptr != None:
+            self.debug_ptr(message)
+        else:
+            print(message)
+
+
+    def packet_count(self, image):
+        """ Return the number of packets in an SSDV image, given as a filename or array of packets. """
+        if isinstance(image, str):
+            return os.path.getsize(image)/256
+        else:
+            return len(image)
+
+
+    def encode_loop(self):
+        """ Produce SSDV images until stopped. Runs in its own thread. """
+        while self.running_ptr():
+            try:
+                _image = self.encode_ptr(self.image_id)
+            except:
+                self.debug_message("Image encoding failed: %s" % traceback.format_exc())
+                _image = None
+
+            if _image is None:
+                continue
+
+            # Wait for a free slot in the pipeline. Finished images are always handed over, even if
+            # the pipeline has been stopped in the meantime, as run() sends any images left when it exits.
+            self.encoded.put((self.image_id, _image))
+
+            if isinstance(_image, tuple):
+                self.image_id = (self.image_id + 2) % 256
+            else:
+                self.image_id = (self.image_id + 1) % 256
+
+
+    def queue_thumbnail(self, image_id, image):
+        """ Hand the thumbnail of a finished progressive image to the transmitter. Does nothing for other images. """
+        if isinstance(image, tuple):
+            (_thumbnail, _full) = image
+            self.debug_message("Transmitting capture %d: thumbnail %d (%d SSDV Packets)." % (
+                self.capture_id, image_id, self.packet_count(_thumbnail)))
+            self.tx.queue_image_thumbnail(_thumbnail, self.capture_id, image_id, (image_id + 1) % 256)
+
+
+    def queue_image(self, image_id, image):
+        """ Hand a finished image (the full resolution image, for progressive images) to the transmitter. """
+        if isinstance(image, tuple):
+            (_thumbnail, _full) = image
+            self.debug_message("Transmitting capture %d: image %d (%d SSDV Packets)." % (
+                self.capture_id, (image_id + 1) % 256, self.packet_count(_full)))
+            self.tx.queue_image(_full)
+        else:
+            self.debug_message("Transmitting image %d (%d SSDV Packets)." % (image_id, self.packet_count(image)))
+            self.tx.queue_image(image)
+
+        self.capture_id = (self.capture_id + 1) % 65536
+
+
+    def transmit_loop(self):
+        """ Queue finished images for transmission until stopped. """
+        while self.running_ptr():
+            try:
+                (_image_id, _image) = self.encoded.get(timeout=self.poll_interval*10)
+            except Queue.Empty:
+                continue
+
+            # Thumbnails are sent straight away, ahead of the rest of the previous image.
+            self.queue_thumbnail(_image_id, _image)
+
+            # Wait until the previous image has (almost) been sent. If the pipeline is stopped
+            # meanwhile (i.e. the camera has failed), this image is still sent.
+            while self.tx.image_queue_frames() > self.low_water and self.running_ptr():
+                sleep(self.poll_interval)
+
+            self.queue_image(_image_id, _image)
+
+
+    def run(self):
+        """ Run the pipeline, blocking until running_ptr() returns False.
+        Images which were already captured when the pipeline stopped are queued for transmission
+        before returning, so e.g. the last good image before a camera failure is not lost.
+        """
+        self.encode_thread = Thread(target=self.encode_loop)
+        self.encode_thread.start()
+
+        try:
+            self.transmit_loop()
+        finally:
+            # Drain the pipeline, until the encode thread has finished its last image.
+            while self.encode_thread.is_alive() or not self.encoded.empty():
+                try:
+                    (_image_id, _image) = self.encoded.get(timeout=self.poll_interval)
+                except Queue.Empty:
+                    continue
+
+                self.queue_thumbnail(_image_id, _image)
+                self.queue_image(_image_id, _image)
+
+            self.encode_thread.join()
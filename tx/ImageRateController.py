@@ -0,0 +1,148 @@
+#!/usr/bin/env python2.7
+#
+# Wenet Image Rate Controller
+#
+#   Copyright (C) 2018  Mark Jessop <vk5qi@rfhead.net>
+#   Released under GNU GPL v3 or later
+#
+# Picks the image resolution and SSDV quality setting for each image, so that images
+# can be transmitted at a target interval (i.e. one image every 60 seconds), given the
+# rate at which the transmitter is actually draining SSDV packets.
+#
+
+from time import time
+
+
+# Candidate (resolution, SSDV quality) settings, from best to worst.
+# Resolutions must be multiples of 16.
+DEFAULT_IMAGE_SETTINGS = [
+    ((1920, 1440), 6),
+    ((1488, 1120), 6),
+    ((1488, 1120), 5),
+    ((1280, 960), 5),
+    ((1024, 768), 5),
+    ((1024, 768), 4),
+    ((800, 608), 4),
+    ((640, 480), 4)
+]
+
+# Initial estimate of the number of SSDV packets per megapixel at each quality setting.
+# These are refined as images are sent.
+DEFAULT_PACKETS_PER_MEGAPIXEL = {
+    4: 250.0,
+    5: 330.0,
+    6: 420.0,
+    7: 1000.0
+}
+
+
+class ImageRateController(object):
+    """ Image Resolution and Quality Controller
+
+    For each image, the controller measures the SSDV packet rate available from the
+    transmitter (the total frame rate, less the frames used by the other transmit queues),
+    and picks the best setting whose predicted size can be sent within the target interval.
+
+    The size prediction (packets per megapixel for each quality setting) is updated with the
+    actual size of each image, using an exponentially weighted moving average.
+
+    Packets sent with each image which do not depend on the chosen setting (i.e. the thumbnail of a
+    progressively transmitted image) are averaged in the same way, and taken out of the budget.
+    If erasure coding is enabled, the predicted sizes are scaled up by the fraction of repair packets
+    sent along with the SSDV packets.
+    """
+
+    def __init__(self, target_interval=60.0, settings=DEFAULT_IMAGE_SETTINGS, smoothing=0.3, debug_ptr=None):
+        """
+        Keyword Arguments:
+        target_interval: Target time (seconds) to transmit each image.
+        settings: List of ((width, height), quality) settings, from best to worst.
+        smoothing: Weight given to the most recent image when updating the size predictions (0.0 - 1.0).
+        debug_ptr: Optional function which is passed the controller's log messages.
+        """
+        self.target_interval = target_interval
+        self.settings = list(settings)
+        self.smoothing = smoothing
+        self.debug_ptr = debug_ptr
+
+        self.packets_per_megapixel = dict(DEFAULT_PACKETS_PER_MEGAPIXEL)
+        self.overhead_packets = None
+        # Erasure coding repair packets sent per SSDV packet (m/k), as of the last image.
+        self.repair_ratio = 0.0
+        self.last_decision = None
+
+
+    def debug_message(self, message):
+        message = "Rate Control: " + message
+        if self.debug_ptr != None:
+            self.debug_ptr(message)
+        else:
+            print(message)
+
+
+    def predict_packets(self, setting):
+        """ Predict the number of SSDV packets an image will use with a given setting. """
+        ((_width, _height), _quality) = setting
+        return self.packets_per_megapixel.get(_quality, DEFAULT_PACKETS_PER_MEGAPIXEL[6]) * _width * _height / 1.0e6
+
+
+    def choose(self, tx):
+        """ Choose the setting for the next image.
+
+        Keyword Arguments:
+        tx: The PacketTX object the image will be transmitted with.
+
+        Returns a ((width, height), quality) tuple.
+        """
+        _rate = tx.ssdv_frame_rate()
+        _source = "measured"
+        if _rate <= 0:
+            # Nothing sent yet, so assume the whole link is available.
+            _rate = tx.serial_baud / 10.0 / tx.frame_length
+            _source = "nominal"
+
+        # Every SSDV packet (of the image and its thumbnail) is sent with its share of repair packets.
+        _scale = 1.0 + self.repair_ratio
+
+        _budget = _rate * self.target_interval
+        if self.overhead_packets is not None:
+            _budget = max(0.0, _budget - self.overhead_packets*_scale)
+
+        _choice = self.settings[-1]
+        for _setting in self.settings:
+            if self.predict_packets(_setting)*_scale <= _budget:
+                _choice = _setting
+                break
+
+        ((_width, _height), _quality) = _choice
+        self.debug_message("%.1f pkt/s (%s), budget %d pkts in %ds. Using %dx%d Q%d (predicted %d pkts)." % (
+            _rate, _source, int(_budget), int(self.target_interval), _width, _height, _quality, int(self.predict_packets(_choice)*_scale)))
+
+        self.last_decision = {'time': time(), 'rate': _rate, 'budget': _budget, 'setting': _choice}
+        return _choice
+
+
+    def update(self, setting, packets, overhead_packets=0, repair_ratio=0.0):
+        """ Update the size prediction with the actual number of packets used by an image.
+
+        Keyword Arguments:
+        setting: The ((width, height), quality) setting the image was encoded with.
+        packets: Number of SSDV packets in the image, not including erasure coding repair packets.
+        overhead_packets: Number of other SSDV packets sent along with the image, i.e. its thumbnail.
+        repair_ratio: Number of erasure coding repair packets sent per SSDV packet (refer PacketTX.ssdv_repair_ratio).
+        """
+        self.repair_ratio = repair_ratio
+
+        if self.overhead_packets is None:
+            self.overhead_packets = float(overhead_packets)
+        else:
+            self.overhead_packets = (1 - self.smoothing)*self.overhead_packets + self.smoothing*overhead_packets
+
+        ((_width, _height), _quality) = setting
+        _observed = packets / (_width * _height / 1.0e6)
+
+        _previous = self.packets_per_megapixel.get(_quality, _observed)
+        self.packets_per_megapixel[_quality] = (1 - self.smoothing)*_previous + self.smoothing*_observed
+
+        self.debug_message("Image used %d pkts (predicted %d). Q%d now %.0f pkts/MP." % (
+            packets, int(_previous * _width * _height / 1.0e6), _quality, self.packets_per_megapixel[_quality]))
@@ -0,0 +1,246 @@
+#!/usr/bin/env python2.7
+#
+# Wenet On-board Image Store
+#
+#   Copyright (C) 2018  Mark Jessop <vk5qi@rfhead.net>
+#   Released under GNU GPL v3 or later
+#
+# Keeps an index (an SQLite database) of the images captured during a flight, with their
+# image ID, capture time, GPS position and files (i.e. the full-resolution JPEG, SSDV image
+# and metadata), and deletes images according to an eviction policy to keep the total size
+# of the files within a byte budget.
+#
+# The most recent image stored under each image ID can be looked up directly, so it can
+# be re-sent on demand.
+#
+
+import os
+import sqlite3
+from threading import Lock
+from time import time
+
+
+class OldestFirstEviction(object):
+    """ Evict the oldest images first. """
+
+    def order(self, records):
+        """ Return the records (sorted oldest first) in the order they should be evicted. """
+        return records
+
+
+class KeepEveryNthEviction(object):
+    """ Evict the oldest images first, but keep every Nth image (by capture sequence) until
+    all other images have been evicted, so a sparse record of the whole flight survives.
+    """
+
+    def __init__(self, n=10):
+        self.n = n
+
+    def order(self, records):
+        _kept = [_record for _record in records if _record['key'] % self.n == 0]
+        _others = [_record for _record in records if _record['key'] % self.n != 0]
+        return _others + _kept
+
+
+class ImageStore(object):
+    """ Bounded On-board Image Store
+
+    Images are added with add() once they have been captured and converted. If the total size
+    of the stored files then exceeds max_bytes, images are deleted in the order given by the
+    eviction policy, except for the most recent protect_recent images.
+    """
+
+    def __init__(self, directory, max_bytes=4e9, policy=None, protect_recent=2, index_file="image_index.sqlite", gps_ptr=None, debug_ptr=None):
+        """
+        Keyword Arguments:
+        directory: Directory the images are stored in. The index is kept here too.
+        max_bytes: Maximum total size of the stored files, in bytes.
+        policy: Eviction policy object (i.e. OldestFirstEviction, KeepEveryNthEviction). Defaults to OldestFirstEviction.
+        protect_recent: Number of most recent images which are never evicted (i.e. as they may still be transmitting).
+        index_file: Filename of the index database, within directory.
+        gps_ptr: Optional function which returns the current GPS state (i.e. UBloxGPS.read_state),
+                 used when an image is added without GPS data.
+        debug_ptr: Optional function which is passed log messages.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.policy = policy if policy is not None else OldestFirstEviction()
+        self.protect_recent = protect_recent
+        self.gps_ptr = gps_ptr
+        self.debug_ptr = debug_ptr
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.lock = Lock()
+        self.db = sqlite3.connect(os.path.join(directory, index_file), check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS images (
+                key INTEGER PRIMARY KEY AUTOINCREMENT,
+                image_id INTEGER,
+                timestamp REAL,
+                latitude REAL,
+                longitude REAL,
+                altitude REAL,
+                gps_fix INTEGER,
+                size INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                key INTEGER,
+                filename TEXT,
+                size INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS files_key ON files (key);
+            """)
+        self.db.commit()
+
+        # Total size of the stored files, and the key of the most recent image stored under each image ID.
+        self.total_bytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM images").fetchone()[0]
+        self.latest = {}
+        for _row in self.db.execute("SELECT image_id, MAX(key) FROM images GROUP BY image_id"):
+            self.latest[_row[0]] = _row[1]
+
+
+    def debug_message(self, message):
+        message = "Image Store: " + message
+        if self.debug_ptr != None:
+            self.debug_ptr(message)
+        else:
+            print(message)
+
+
+    def add(self, image_id, files, timestamp=None, gps_data=None):
+        """ Add an image to the store, then evict images if the store is over its budget.
+        Returns the image's key (a sequence number, unique across the whole flight).
+
+        Keyword Arguments:
+        image_id: SSDV image ID (0-255).
+        files: List of the image's files (i.e. the JPEG, SSDV image, metadata).
+        timestamp: Capture time. Defaults to time().
+        gps_data: Optional GPS state (as produced by the UBloxGPS class) at the time of capture.
+        """
+        if timestamp is None:
+            timestamp = time()
+
+        if gps_data is None and self.gps_ptr is not None:
+            try:
+                gps_data = self.gps_ptr()
+            except:
+                gps_data = None
+
+        if gps_data is None:
+            gps_data = {}
+
+        _sizes = []
+        for _filename in files:
+            try:
+                _sizes.append(os.path.getsize(_filename))
+            except OSError:
+                _sizes.append(0)
+
+        with self.lock:
+            _cursor = self.db.execute("INSERT INTO images (image_id, timestamp, latitude, longitude, altitude, gps_fix, size) VALUES (?,?,?,?,?,?,?)",
+                (image_id, timestamp, gps_data.get('latitude'), gps_data.get('longitude'), gps_data.get('altitude'), gps_data.get('gpsFix'), sum(_sizes)))
+            _key = _cursor.lastrowid
+            self.db.executemany("INSERT INTO files (key, filename, size) VALUES (?,?,?)",
+                [(_key, _filename, _size) for (_filename, _size) in zip(files, _sizes)])
+            self.db.commit()
+
+            self.latest[image_id] = _key
+            self.total_bytes += sum(_sizes)
+
+            self._evict()
+
+        return _key
+
+
+    def _record(self, row):
+        _record = dict(zip(row.keys(), tuple(row)))
+        _record['files'] = [_file[0] for _file in self.db.execute("SELECT filename FROM files WHERE key=?", (_record['key'],))]
+        return _record
+
+
+    def get(self, image_id):
+        """ Return the most recent image stored under an image ID, as a dictionary, or None.
+        The dictionary contains the fields of the index, and a list of the image's files.
+        """
+        with self.lock:
+            _key = self.latest.get(image_id)
+            if _key is None:
+                return None
+
+            _row = self.db.execute("SELECT * FROM images WHERE key=?", (_key,)).fetchone()
+            return self._record(_row) if _row is not None else None
+
+
+    def find_file(self, image_id, extension):
+        """ Return the file with a given extension (i.e. '.ssdv') of the most recent image stored under an image ID, or None. """
+        _record = self.get(image_id)
+        if _record is None:
+            return None
+
+        for _filename in _record['files']:
+            if _filename.endswith(extension) and os.path.exists(_filename):
+                return _filename
+
+        return None
+
+
+    def resend(self, tx, image_id):
+        """ Queue the SSDV file of a stored image for transmission again.
+        Returns False if the image (or its SSDV file) is no longer stored.
+        """
+        _filename = self.find_file(image_id, '.ssdv')
+        if _filename is None:
+            self.debug_message("Image %d not available to re-send." % image_id)
+            return False
+
+        self.debug_message("Re-sending image %d." % image_id)
+        return tx.queue_image(_filename)
+
+
+    def count(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+
+    def _evict(self):
+        """ Delete images until the store is within its budget. Called with self.lock held. """
+        if self.total_bytes <= self.max_bytes:
+            return
+
+        _records = [dict(zip(_row.keys(), tuple(_row))) for _row in
+            self.db.execute("SELECT key, image_id, timestamp, size FROM images ORDER BY key")]
+        if self.protect_recent > 0:
+            _records = _records[:-self.protect_recent]
+
+        _evicted = 0
+        for _record in self.policy.order(_records):
+            if self.total_bytes <= self.max_bytes:
+                break
+
+            for _file in self.db.execute("SELECT filename FROM files WHERE key=?", (_record['key'],)).fetchall():
+                try:
+                    os.remove(_file[0])
+                except OSError:
+                    pass
+
+            self.db.execute("DELETE FROM files WHERE key=?", (_record['key'],))
+            self.db.execute("DELETE FROM images WHERE key=?", (_record['key'],))
+
+            if self.latest.get(_record['image_id']) == _record['key']:
+                self.latest.pop(_record['image_id'])
+
+            self.total_bytes -= _record['size']
+            _evicted += 1
+
+        self.db.commit()
+
+        if _evicted > 0:
+            self.debug_message("Evicted %d images, %.1f MB stored." % (_evicted, self.total_bytes/1e6))
+
+
+    def close(self):
+        with self.lock:
+            self.db.close()
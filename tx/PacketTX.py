@@ -21,14 +21,29 @@ import sys
 import os
 import datetime
 import crcmod
+import mmap
 import json
 import socket
 import struct
 import traceback
+import time
 from time import sleep
-from threading import Thread
+from threading import Thread, Event, Lock
 import numpy as np
 from ldpc_encoder import *
+from FrameRingBuffer import FrameRingBuffer, FrameCarousel, FrameCache, FrameCompletion
+from TxScheduler import TxScheduler, AdmissionControl
+from PacketTXLoop import PacketTXLoop
+from TxStats import ThroughputMeter, TxStatsCollector
+import ssdv_erasure
+from TelemetryAggregator import TelemetryAggregator
+from GPSTrack import GPSTrackEncoder
+
+# Binary UDP message format. Refer PacketTX.handle_udp_binary_packet.
+UDP_BINARY_MAGIC = "WB"
+UDP_BINARY_TEXT = 0x00
+UDP_BINARY_SEC_PAYLOAD = 0x03
+
 
 class PacketTX(object):
     """ Packet Transmitter Class
@@ -48,16 +63,29 @@ class PacketTX(object):
         Parity bits: 516 bits (zero-padded to 65 bytes) of LDPC parity bits, using a r=0.8 Repeat-accumulate code, developed by
                      Bill Cowley, VK5DSP. See ldpc_enc.c for more details.
 
-    Packets are transmitted from two queues, named 'telemetry' and 'ssdv'.
+    Packets are transmitted from three queues, named 'telemetry', 'thumbnail' and 'ssdv', in that order of priority.
     The 'telemetry' queue is intended for immediate transmission of low-latency telemetry packets,
     for example, GPS or IMU data. Care must be taken to not over-use this queue, at the detriment of image transmission.
     The 'ssdv' queue is used for transmission of large amounts of image (SSDV) data, and up to 4096 packets can be queued for transmit.
+    The 'thumbnail' queue holds the thumbnails of progressively transmitted images, which are sent ahead
+    of any full resolution image still in the 'ssdv' queue (refer queue_image_thumbnail).
+    The queues are FrameRingBuffers owned by each PacketTX instance, with packets framed directly into their slots.
+
+    A third, low priority 'bulk' queue holds secondary payload packets which are over their rate limit
+    (or could not fit in the telemetry queue). It is only sent from when the link would otherwise be idle.
 
     """
 
-    # Transmit Queues.
-    ssdv_queue = Queue.Queue(4096) # Up to 1MB of 256 byte packets
-    telemetry_queue = Queue.Queue(256) # Keep this queue small. It's up to the user not to over-use this queue.
+    # Transmit Queue sizes, in frames.
+    ssdv_queue_size = 4096 # Up to 1MB of 256 byte packets
+    telemetry_queue_size = 256 # Keep this queue small. It's up to the user not to over-use this queue.
+    thumbnail_queue_size = 512
+    bulk_queue_size = 256
+
+    # Number of frames to keep in the SSDV queue when streaming image files.
+    image_stream_depth = 32
+    # Image files at least this large (in bytes) are streamed by queue_image.
+    image_stream_min_size = 32768
 
     # Framing parameters
     unique_word = "\xab\xcd\xef\x01"
@@ -82,16 +110,69 @@ class PacketTX(object):
         debug = False, 
         callsign="N0CALL",
         udp_listener = None,
-        log_file = None):
+        log_file = None,
+        tx_policy = 'priority',
+        write_batch_latency = 0.0,
+        stats_udp_port = None,
+        stats_interval = 10.0,
+        carousel_size = 0,
+        ssdv_repair_group = 32,
+        ssdv_repair_packets = 0,
+        telemetry_aggregation = 0.0,
+        frame_cache_size = 64,
+        sec_payload_limits = None,
+        sec_payload_default_limit = None,
+        event_loop = False):
+        """ Instantiate a PacketTX object.
+
+        Keyword Arguments:
+        serial_port: Serial port device to transmit via. An object with write() and close() methods
+                     (i.e. a fake serial port used for testing) can also be provided.
+        tx_policy: Transmit scheduling policy used to pick between the telemetry, thumbnail and ssdv queues.
+                   One of 'priority' (telemetry always first - the default), 'weighted' (weighted fair share)
+                   or 'airtime' (per-queue airtime budget), or a policy object. Refer TxScheduler.py.
+        write_batch_latency: If set (seconds), ready frames are gathered together and sent to the
+                   serial port with a single write, with no more than this much airtime per write.
+                   This reduces the number of times Python has to wake up per second.
+                   The default (0) writes each frame individually.
+        stats_udp_port: If set, transmitter statistics (refer get_stats) are published as JSON
+                   to this UDP port on localhost, every stats_interval seconds.
+        carousel_size: If set, up to this many already-transmitted SSDV frames of the latest images
+                   are cached, and re-sent (least-recently-sent first) instead of idle frames.
+        ssdv_repair_packets: If set, this many erasure coding repair packets are sent after every
+                   ssdv_repair_group SSDV packets queued with queue_image_file, allowing the receiver
+                   to rebuild lost packets. Refer ssdv_erasure.py.
+        telemetry_aggregation: If set (seconds), small telemetry packets are held for up to this long,
+                   and packed together into telemetry container packets (refer TelemetryAggregator.py),
+                   so several of them share a single frame.
+        frame_cache_size: Number of framed packets to cache, so packets sent with repeats > 1 (and idle
+                   messages) are only encoded once. Packets sent once are never cached. 0 disables the cache.
+        sec_payload_limits: Dictionary of (rate, burst) tuples per secondary payload ID, limiting the rate
+                   (packets per second) at which each payload can use the telemetry queue. Packets over the
+                   limit are deferred to the bulk queue, which is only sent when the link would otherwise be idle.
+                   If None (the default), no payload IDs have a limit of their own.
+        sec_payload_default_limit: (rate, burst) tuple for secondary payload IDs not in sec_payload_limits.
+                   By default these are not rate limited.
+        event_loop: If True, the transmitter, UDP listener and statistics publisher all run from a single
+                   select() based event loop thread (refer PacketTXLoop.py), instead of a thread each.
+                   The loop is available as the event_loop attribute, for scheduling timers.
+                   In either mode, frames are picked and written by the transmit core in PacketTXLoop.py,
+                   which is available as the tx_loop attribute (i.e. for non-blocking packet queueing).
+        """
         
         # Instantiate our low-level transmit interface, be it a serial port, or the BinaryDebug class.
         if debug == True:
             self.s = BinaryDebug()
             self.debug = True
+        elif hasattr(serial_port, 'write'):
+            self.debug = False
+            self.s = serial_port
         else:
             self.debug = False
             self.s = serial.Serial(serial_port,serial_baud)
 
+        self.serial_baud = serial_baud
+
 
         self.payload_length = payload_length
         self.callsign = callsign
@@ -99,6 +180,73 @@ class PacketTX(object):
 
         self.crc16 = crcmod.predefined.mkCrcFun('crc-ccitt-false')
 
+        # Frame layout. Frames are built directly into preallocated uint8 arrays,
+        # with the payload, CRC and parity bits at fixed offsets.
+        self.header = np.frombuffer(self.preamble + self.unique_word, dtype=np.uint8)
+        self.payload_offset = len(self.header)
+        self.crc_offset = self.payload_offset + self.payload_length
+        self.parity_offset = self.crc_offset + 2
+        self.frame_length = self.parity_offset + (LDPC_PARITY_BYTES if fec else 0)
+        self.padding = np.frombuffer("\x55"*self.payload_length, dtype=np.uint8)
+
+        # Transmit Queues.
+        self.ssdv_queue = FrameRingBuffer(self.ssdv_queue_size, self.frame_length)
+        self.telemetry_queue = FrameRingBuffer(self.telemetry_queue_size, self.frame_length)
+        self.thumbnail_queue = FrameRingBuffer(self.thumbnail_queue_size, self.frame_length)
+        self.bulk_queue = FrameRingBuffer(self.bulk_queue_size, self.frame_length)
+
+        # Transmit scheduler, which picks the queue to send the next frame from.
+        self.scheduler = TxScheduler([('telemetry', self.telemetry_queue), ('thumbnail', self.thumbnail_queue), ('ssdv', self.ssdv_queue)], policy=tx_policy,
+            background=[('bulk', self.bulk_queue)])
+
+        # Rate limiting of secondary payload packets.
+        self.sec_payload_admission = AdmissionControl(sec_payload_limits, sec_payload_default_limit)
+
+        # Coalesced serial writes. Up to write_batch_frames frames are gathered into the batch buffer
+        # and sent with a single write. 10 bits are sent per byte (8N1).
+        _frame_time = self.frame_length*10.0/self.serial_baud
+        self.write_batch_frames = max(1, int(write_batch_latency/_frame_time))
+        self.write_batch_buffer = np.zeros(self.write_batch_frames*self.frame_length, dtype=np.uint8)
+
+        # Measured UART throughput.
+        self.uart_meter = ThroughputMeter(nominal_rate=self.serial_baud/10.0)
+
+        # Per-queue latency, depth and frame rate statistics.
+        self.tx_stats = TxStatsCollector([_name for (_name, _queue) in self.scheduler.all_queues])
+        self.stats_udp_port = stats_udp_port
+        self.stats_interval = stats_interval
+        self.stats_thread = None
+        self.stats_stop = Event()
+
+        # Carousel of transmitted SSDV frames, re-sent when the queues are empty.
+        if carousel_size > 0:
+            self.carousel = FrameCarousel(carousel_size, self.frame_length, self.payload_offset)
+        else:
+            self.carousel = None
+
+        # Erasure coding of SSDV images.
+        self.ssdv_repair_group = ssdv_repair_group
+        self.ssdv_repair_packets = ssdv_repair_packets
+
+        # Telemetry aggregation.
+        if telemetry_aggregation > 0:
+            self.telemetry_aggregator = TelemetryAggregator(telemetry_aggregation, self.payload_length)
+        else:
+            self.telemetry_aggregator = None
+
+        # Cache of framed telemetry packets.
+        if frame_cache_size > 0:
+            self.frame_cache = FrameCache(frame_cache_size)
+        else:
+            self.frame_cache = None
+
+        # Encoder for high-rate GPS track packets.
+        self.gps_track = GPSTrackEncoder(self.payload_length)
+
+        # Image files being streamed into the SSDV queue, oldest first.
+        self.image_streams = []
+        self.image_streams_lock = Lock()
+
         self.idle_message = self.frame_packet(self.idle_sequence,fec=fec)
 
         if log_file != None:
@@ -107,43 +255,172 @@ class PacketTX(object):
         else:
             self.log_file = None
 
-        # Startup the UDP listener, if enabled.
+        # Transmit core, which is either driven by the transmit thread, or run as a single-threaded event loop.
+        self.tx_loop = PacketTXLoop(self)
+        if event_loop:
+            self.event_loop = self.tx_loop
+        else:
+            self.event_loop = None
+
+        # Startup the UDP listener, if enabled. The event loop runs its own listener.
         self.listener_thread = None
         self.udp = None
         self.udp_listener_running = False
+        self.udp_port = udp_listener
 
-        if udp_listener != None:
-            self.udp_port = udp_listener
+        if udp_listener != None and self.event_loop is None:
             self.start_udp()
 
 
     def start_tx(self):
         self.transmit_active = True
+
+        if self.event_loop is not None:
+            self.event_loop.start()
+            return
+
         txthread = Thread(target=self.tx_thread)
         txthread.start()
 
+        if self.stats_udp_port != None:
+            self.stats_stop.clear()
+            self.stats_thread = Thread(target=self.stats_publish_thread)
+            self.stats_thread.start()
 
 
-    def frame_packet(self,packet, fec=False):
-        # Ensure payload size is equal to the desired payload length
-        if len(packet) > self.payload_length:
-            packet = packet[:self.payload_length]
 
-        if len(packet) < self.payload_length:
-            packet = packet + "\x55"*(self.payload_length - len(packet))
+    def frame_packet_into(self, packet, frame=None, fec=None):
+        """ Frame a packet directly into a preallocated frame buffer.
 
-        crc = struct.pack("<H",self.crc16(packet))
+        The preamble, unique word, payload, CRC and parity bits are written in-place,
+        without building any intermediate strings.
 
-        if fec:
-            parity = ldpc_encode_string(packet + crc)
-            return self.preamble + self.unique_word + packet + crc + parity
+        Keyword Arguments:
+        packet: The packet to frame. Can be a string, or a uint8 numpy array / memoryview slice
+                of a larger buffer (i.e. an entire SSDV image), which will not be copied.
+                Packets are clipped or padded (with 0x55) to the payload length.
+        frame: A uint8 numpy array to write the frame into, long enough for the frame (including
+               the parity bits if fec is set). If not provided, a new array is allocated.
+               This function is called from several threads (UDP listener, cameras, transmitter),
+               so any frame provided must not be shared between them.
+        fec: Generate LDPC parity bits. Defaults to the fec setting provided on instantiation.
+
+        Returns a uint8 numpy array (a view of frame) containing the framed packet.
+        """
+        if fec is None:
+            fec = self.fec
+
+        _frame_length = self.parity_offset + (LDPC_PARITY_BYTES if fec else 0)
+        if frame is None:
+            frame = np.empty(_frame_length, dtype=np.uint8)
+        elif len(frame) < _frame_length:
+            raise ValueError("Frame buffer is too short (%d bytes) for a %d byte frame." % (len(frame), _frame_length))
+
+        if isinstance(packet, np.ndarray):
+            payload = packet[:self.payload_length]
+        elif isinstance(packet, memoryview):
+            payload = np.asarray(packet[:self.payload_length])
         else:
-            return self.preamble + self.unique_word + packet + crc 
+            payload = np.frombuffer(packet[:self.payload_length], dtype=np.uint8)
+
+        _len = len(payload)
+
+        frame[:self.payload_offset] = self.header
+        frame[self.payload_offset:self.payload_offset+_len] = payload
+
+        # Pad the payload out to the desired payload length.
+        if _len < self.payload_length:
+            frame[self.payload_offset+_len:self.crc_offset] = self.padding[:self.payload_length-_len]
+
+        crc = self.crc16(frame[self.payload_offset:self.crc_offset].tostring())
+        frame[self.crc_offset] = crc & 0xFF
+        frame[self.crc_offset+1] = crc >> 8
+
+        if fec:
+            # Write the parity bits straight into the end of the frame.
+            ldpc_encode_batch(frame[self.payload_offset:self.parity_offset],
+                out=frame[self.parity_offset:_frame_length].reshape((1,LDPC_PARITY_BYTES)))
+
+        return frame[:_frame_length]
+
+
+    def frame_packet_cached(self, packet, frame=None):
+        """ Frame a packet as per frame_packet_into, re-using the frame from the frame cache
+        if the same packet has been framed recently. Only string packets are cached.
+
+        Only use this for packets which are likely to be framed again (repeated packets, the
+        idle message), as caching unique packets costs more than it saves.
+        """
+        if self.frame_cache is None or not isinstance(packet, str):
+            return self.frame_packet_into(packet, frame=frame)
+
+        _cached = self.frame_cache.get(packet)
+        if _cached is None:
+            _frame = self.frame_packet_into(packet, frame=frame)
+            self.frame_cache.put(packet, _frame)
+            return _frame
+
+        if frame is None:
+            # Return a copy, so the caller cannot modify the cached frame.
+            return np.array(_cached, dtype=np.uint8)
+        frame[:len(_cached)] = _cached
+        return frame[:len(_cached)]
+
+
+    def frame_packet(self,packet, fec=False):
+        """ Frame a packet, returning the frame as a string. """
+        return self.frame_packet_into(packet, fec=fec).tostring()
+
+
+    def frame_packet_batch(self, packets, fec=False):
+        """ Frame a list of packets, LDPC encoding all of them with a single call.
+
+        Produces the same output as calling frame_packet on each packet, but avoids
+        the per-packet overhead of the LDPC encoder. Used when queueing entire images.
+
+        Returns a (N, frame length) uint8 numpy array, with one frame per row.
+        """
+        frame_length = self.parity_offset + (LDPC_PARITY_BYTES if fec else 0)
+        frames = np.empty((len(packets), frame_length), dtype=np.uint8)
+
+        for x in range(len(packets)):
+            self.frame_packet_into(packets[x], frame=frames[x], fec=False)
+
+        if fec and len(packets) > 0:
+            frames[:, self.parity_offset:] = ldpc_encode_batch(frames[:, self.payload_offset:self.parity_offset])
+
+        return frames
+
+
+    def queue_frame(self, queue, packet, block=True, timeout=None, deadline=None, key=None, cache=False, completion=None):
+        """ Frame a packet directly into the next free slot of a transmit queue.
+        The optional deadline and supersede key are passed through to FrameRingBuffer.commit.
+        If cache is True, the frame cache is used (refer frame_packet_cached).
+
+        Raises Queue.Full if the queue is full, and block is False (or the timeout expires).
+        Returns a FrameCompletion (or the one provided), which is set once the frame leaves the queue.
+        """
+        if completion is None:
+            completion = FrameCompletion()
+
+        (_index, _slot) = queue.reserve(block=block, timeout=timeout)
+        try:
+            if cache:
+                _frame = self.frame_packet_cached(packet, frame=_slot)
+            else:
+                _frame = self.frame_packet_into(packet, frame=_slot)
+        except:
+            # Cancel the slot, so the transmitter does not stall waiting on it.
+            queue.commit(_index, 0)
+            raise
+
+        queue.commit(_index, len(_frame), deadline=deadline, key=key, completion=completion)
+        return completion
 
 
     def set_idle_message(self, message):
         temp_msg = "\x00" + "DE %s: \t%s" % (self.callsign, message)
-        self.idle_message = self.frame_packet(temp_msg,fec=self.fec)
+        self.idle_message = self.frame_packet_cached(temp_msg).tostring()
 
 
     def generate_idle_message(self):
@@ -153,36 +430,131 @@ class PacketTX(object):
 
     def tx_thread(self):
         """ Main Transmit Thread.
-            
-            Checks telemetry and image queues in order, and transmits a packet.
+
+            Transmits frames picked by the transmit core (refer PacketTXLoop.transmit) until closed.
+            If there is nothing to send, an idle (or carousel) frame is transmitted to keep the
+            modem in sync. In debug mode we instead block until a frame is queued.
         """
         while self.transmit_active:
-            if self.telemetry_queue.qsize()>0:
-                packet = self.telemetry_queue.get_nowait()
-                self.s.write(packet)
-            elif self.ssdv_queue.qsize()>0:
-                packet = self.ssdv_queue.get_nowait()
-                self.s.write(packet)
-            else:
-                if not self.debug:
-                    self.s.write(self.idle_message)
-                else:
-                    # TODO: Tune this value.
-                    sleep(0.05)
-        
+            self.tx_loop.transmit(timeout=self.debug_wait_time())
+
         print("Closing Thread")
         self.s.close()
 
 
+    def debug_wait_time(self):
+        """ Time to block waiting for a frame in debug mode - no longer than it takes for
+        aggregated telemetry to become due.
+        """
+        if self.telemetry_aggregator is not None:
+            _remaining = self.telemetry_aggregator.time_remaining()
+            if _remaining is not None:
+                return min(1.0, _remaining)
+
+        return 1.0
+
+
+    def next_idle_frame(self):
+        """ Return a (label, frame) tuple of the frame to send when there is nothing queued.
+        This is the least-recently-sent frame of the latest image if the carousel is enabled
+        and has frames available, otherwise the idle message.
+        """
+        if self.carousel is not None:
+            _frame = self.carousel.next_frame()
+            if _frame is not None:
+                return ('carousel', _frame)
+
+        return ('idle', np.frombuffer(self.idle_message, dtype=np.uint8))
+
+
+    def record_queue_depths(self):
+        for (_name, _queue) in self.scheduler.all_queues:
+            self.tx_stats.queue_depth(_name, _queue.qsize())
+
+
+    def get_stats(self):
+        """ Return a dictionary of transmitter statistics.
+
+        'uart' contains the measured serial port throughput (bytes/sec), compared to the
+        nominal rate for the configured baud rate. A utilisation close to 1.0 means the UART is saturated.
+
+        'queues' contains, for each transmit queue, the frame rate, and rolling percentiles of the
+        enqueue-to-air latency (seconds) and queue depth (frames).
+        'idle_ratio' is the fraction of recently transmitted frames which were idle frames, and
+        'carousel_ratio' the fraction which were carousel re-transmissions.
+        Each queue also reports the number of frames discarded because they 'expired' before
+        being sent, or were 'superseded' by a newer frame.
+        'frame_cache' contains the frame cache hit/miss counters.
+        'sec_payload' contains the number of packets admitted, deferred (to the bulk queue) and dropped
+        for each secondary payload ID.
+        """
+        _stats = self.tx_stats.stats()
+        _stats['uart'] = self.uart_meter.stats()
+        for (_name, _queue) in self.scheduler.all_queues:
+            _stats['queues'][_name].update(_queue.discard_stats())
+        _stats['sec_payload'] = self.sec_payload_admission.stats()
+        if self.frame_cache is not None:
+            _stats['frame_cache'] = self.frame_cache.stats()
+        return _stats
+
+
+    def ssdv_frame_rate(self):
+        """ Return the rate (frames per second) at which SSDV frames could be sent, measured
+        as the total transmitted frame rate less the frames sent from the non-image queues.
+        Idle and carousel frames count as available, as SSDV frames would have been sent in their place.
+        Thumbnail frames count as available too, as they are part of the image transmission.
+        Returns 0 if nothing has been transmitted yet.
+        """
+        _stats = self.tx_stats.stats()
+        _rate = _stats['frames_per_sec']
+        for (_name, _queue_stats) in _stats['queues'].items():
+            if _name not in ('ssdv', 'thumbnail'):
+                _rate -= _queue_stats['frames_per_sec']
+
+        return max(_rate, 0.0)
+
+
+    def ssdv_repair_ratio(self):
+        """ Return the number of erasure coding repair packets sent per SSDV packet (m/k), or 0 if disabled. """
+        if self.ssdv_repair_packets > 0:
+            return float(self.ssdv_repair_packets) / self.ssdv_repair_group
+        else:
+            return 0.0
+
+
+    def stats_publish_thread(self):
+        """ Periodically publish transmitter statistics as a JSON blob via UDP. """
+        _socket = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+
+        while not self.stats_stop.wait(self.stats_interval) and self.transmit_active:
+            try:
+                _data = {'type': 'WENET_TX_STATS', 'callsign': self.callsign, 'stats': self.get_stats()}
+                _socket.sendto(json.dumps(_data), ('127.0.0.1', self.stats_udp_port))
+            except:
+                traceback.print_exc()
+
+        _socket.close()
+
+
     def close(self):
         self.transmit_active = False
         self.udp_listener_running = False
+        self.scheduler.notify()
+        self.stats_stop.set()
+        if self.event_loop is not None:
+            self.event_loop.stop()
         #self.listener_thread.join()
 
+        # Release any image files which were still being streamed.
+        with self.image_streams_lock:
+            for _stream in self.image_streams:
+                _stream.close()
+            self.image_streams = []
+
 
     # Deprecated function
     def tx_packet(self,packet,blocking = False):
-        self.ssdv_queue.put(self.frame_packet(packet, self.fec))
+        self.queue_frame(self.ssdv_queue, packet)
 
         if blocking:
             while not self.ssdv_queue.empty():
@@ -196,35 +568,244 @@ class PacketTX(object):
 
     # New packet queueing and queue querying functions (say that 3 times fast)
 
-    def queue_image_packet(self,packet):
-        self.ssdv_queue.put(self.frame_packet(packet, self.fec))
+    def queue_image_packet(self, packet, block=True, timeout=None):
+        """ Queue a single SSDV packet for transmission.
+        Raises Queue.Full if the SSDV queue is full, and block is False (or the timeout expires).
+        Returns a FrameCompletion, which can be waited on until the packet has been sent.
+        """
+        return self.queue_frame(self.ssdv_queue, packet, block=block, timeout=timeout)
 
 
-    def queue_image_file(self, filename):
+    def queue_image_file(self, filename, stream=False, queue=None):
         """ Read in <filename> and transmit it, 256 bytes at a time.
             Intended for transmitting SSDV images.
+
+            Keyword Arguments:
+            filename: SSDV file to transmit. A trailing partial (<256 byte) packet is ignored.
+            stream: If True, the file is memory-mapped, and packets are framed as the
+                    transmitter drains the SSDV queue, rather than all at once. This function
+                    then returns immediately, and memory usage does not depend on the image size.
+                    The file must not be modified until it has been transmitted (i.e.
+                    image_queue_empty() returns True). Deleting it, or renaming another file
+                    over it, is safe, as the mapping keeps the original contents.
+                    Streamed files are always sent from the SSDV queue.
+            queue: Queue to transmit the image from. Defaults to the SSDV queue.
         """
-        file_size = os.path.getsize(filename)
         try:
+            file_size = os.path.getsize(filename)
+
+            if file_size % 256 > 0:
+                print("WARNING: %s is not a multiple of 256 bytes, ignoring the last %d bytes." % (filename, file_size % 256))
+
+            if file_size < 256:
+                return True
+
+            if stream:
+                _stream = ImageFileStream(filename, group_size=self.ssdv_repair_group, num_repairs=self.ssdv_repair_packets)
+                with self.image_streams_lock:
+                    self.image_streams.append(_stream)
+                # Wake up the transmit thread if it's waiting for frames.
+                self.scheduler.notify()
+                return True
+
             f = open(filename,'rb')
-            for x in range(file_size/256):
-                data = f.read(256)
-                self.queue_image_packet(data)
+            data = f.read()
             f.close()
+            image = np.frombuffer(data, dtype=np.uint8)[:(file_size/256)*256].reshape((-1,256))
+            return self.queue_image_packets(image, queue=queue)
+        except:
+            traceback.print_exc()
+            return False
+
+
+    def queue_image_packets(self, image, queue=None):
+        """ Transmit an SSDV image already held in memory (i.e. from ssdv_encoder.encode_image).
+
+            Keyword Arguments:
+            image: A (N, 256) uint8 array of SSDV packets.
+            queue: Queue to transmit the image from. Defaults to the SSDV queue.
+        """
+        if queue is None:
+            queue = self.ssdv_queue
+
+        try:
+            # Frame the entire image at once, using the batch LDPC encoder.
+            if self.ssdv_repair_packets > 0:
+                packets = ssdv_erasure.add_repair_packets(image, self.ssdv_repair_group, self.ssdv_repair_packets)
+            else:
+                packets = list(image)
+            for frame in self.frame_packet_batch(packets, self.fec):
+                queue.put(frame)
             return True
         except:
+            traceback.print_exc()
             return False
 
+
+    def queue_image(self, image):
+        """ Transmit an SSDV image, given either as a filename (refer queue_image_file), or
+            as a (N, 256) uint8 array of SSDV packets (refer queue_image_packets).
+
+            Files of at least image_stream_min_size bytes are streamed, so they must not be
+            modified until they have been transmitted (they can be deleted, or replaced by renaming
+            another file over them). The camera classes write a new SSDV file for each capture.
+        """
+        if isinstance(image, str):
+            try:
+                _stream = os.path.getsize(image) >= self.image_stream_min_size
+            except OSError:
+                _stream = False
+            return self.queue_image_file(image, stream=_stream)
+        else:
+            return self.queue_image_packets(image)
+
+
+    def queue_image_thumbnail(self, thumbnail, capture_id, thumbnail_id, image_id):
+        """ Transmit the thumbnail of a progressively transmitted image, and the Image Link packet
+            (refer transmit_image_link) which links it to the full resolution image.
+
+            The thumbnail is sent from the thumbnail queue, so it goes out ahead of any full resolution
+            image still in the SSDV queue. The full resolution image is then queued with queue_image,
+            i.e. once the previous image has (almost) been sent (refer ImagePipeline).
+
+            Keyword Arguments:
+            thumbnail: The thumbnail SSDV image, as a filename or array of packets.
+            capture_id: ID number of the capture both images were produced from.
+            thumbnail_id: SSDV image ID of the thumbnail.
+            image_id: SSDV image ID of the full resolution image.
+        """
+        self.transmit_image_link(capture_id, thumbnail_id, image_id)
+        if isinstance(thumbnail, str):
+            return self.queue_image_file(thumbnail, queue=self.thumbnail_queue)
+        else:
+            return self.queue_image_packets(thumbnail, queue=self.thumbnail_queue)
+
+
+    def queue_image_progressive(self, thumbnail, image, capture_id, thumbnail_id, image_id):
+        """ Transmit an image progressively: a low resolution thumbnail first, then the full
+            resolution image. Both are separate SSDV images, which are linked by an Image Link
+            packet (refer transmit_image_link), sent ahead of them.
+
+            Keyword Arguments:
+            thumbnail: The thumbnail SSDV image, as a filename or array of packets.
+            image: The full resolution SSDV image, as a filename or array of packets.
+            capture_id: ID number of the capture both images were produced from.
+            thumbnail_id: SSDV image ID of the thumbnail.
+            image_id: SSDV image ID of the full resolution image.
+        """
+        _thumbnail_ok = self.queue_image_thumbnail(thumbnail, capture_id, thumbnail_id, image_id)
+        _image_ok = self.queue_image(image)
+        return _thumbnail_ok and _image_ok
+
+
+    def refill_image_queue(self):
+        """ Frame packets from any image files being streamed, keeping up to
+        image_stream_depth frames in the SSDV queue. Called from the transmit thread.
+        """
+        with self.image_streams_lock:
+            while len(self.image_streams) > 0:
+                _stream = self.image_streams[0]
+
+                # Never fill the queue, as the transmit thread must not block on it.
+                _space = min(self.image_stream_depth, self.ssdv_queue.num_slots) - self.ssdv_queue.qsize()
+                if _space <= 0:
+                    return
+
+                _packets = _stream.next_packets(_space)
+                _frames = self.frame_packet_batch(_packets, self.fec)
+
+                for x in range(len(_frames)):
+                    try:
+                        self.ssdv_queue.put(_frames[x], block=False)
+                    except Queue.Full:
+                        # Another producer got in first - these packets will be framed again next time.
+                        _stream.rewind(len(_frames) - x)
+                        return
+
+                if _stream.finished():
+                    _stream.close()
+                    self.image_streams.pop(0)
+
+
     def image_queue_empty(self):
-        return self.ssdv_queue.qsize() == 0
+        with self.image_streams_lock:
+            _streaming = len(self.image_streams) > 0
+        return (self.ssdv_queue.qsize() == 0) and (self.thumbnail_queue.qsize() == 0) and not _streaming
+
+
+    def image_queue_frames(self):
+        """ Return the number of SSDV packets (including thumbnails) still waiting to be transmitted,
+        including packets of image files being streamed which have not been framed yet.
+        """
+        with self.image_streams_lock:
+            _streaming = sum([_stream.remaining() for _stream in self.image_streams])
+        return self.ssdv_queue.qsize() + self.thumbnail_queue.qsize() + _streaming
+
 
+    def queue_telemetry_packet(self, packet, repeats = 1, lifetime = None, key = None, block = True, timeout = None):
+        """ Queue a telemetry packet for transmission.
 
-    def queue_telemetry_packet(self, packet, repeats = 1):
+        Keyword Arguments:
+        packet: The packet to transmit.
+        repeats: Number of times to transmit the packet.
+        lifetime: Optional time (seconds) after which the packet is discarded if it has not yet been sent.
+        key: Optional supersede key (i.e. 'gps'). A newer packet with the same key replaces this packet
+             if it is still waiting to be sent. Ignored for repeated packets.
+        block: Wait for space if the telemetry queue is full. If False, Queue.Full is raised instead.
+        timeout: Maximum time (seconds) to wait for space, after which Queue.Full is raised.
+
+        If telemetry aggregation is enabled, a packet with a key replaces an older packet with the
+        same key in the open telemetry container, and lifetime is not used.
+
+        Returns a FrameCompletion for the (last copy of the) packet, which can be waited on until it
+        has been sent, or None if the packet was added to a telemetry container.
+        """
+        if repeats > 1:
+            key = None
+
+        # Single packets are aggregated if enabled. Repeated packets are always sent in their
+        # own frames, so that losing one frame does not lose every copy.
+        if self.telemetry_aggregator is not None and repeats == 1:
+            if self.telemetry_aggregator.add(packet, key=key):
+                return None
+
+        if lifetime is not None:
+            _deadline = time.time() + lifetime
+        else:
+            _deadline = None
+
+        # Only repeated packets are cached, as a packet sent once will never be framed again.
+        _completion = None
         for n in range(repeats):
-            self.telemetry_queue.put(self.frame_packet(packet, self.fec))
+            _completion = self.queue_frame(self.telemetry_queue, packet, block=block, timeout=timeout,
+                deadline=_deadline, key=key, cache=(repeats > 1))
+
+        return _completion
+
+
+    def flush_telemetry_aggregator(self):
+        """ Move any due telemetry containers from the aggregator into the telemetry queue.
+        Called from the transmit thread, so must not block on the queue.
+        """
+        if self.telemetry_aggregator is None:
+            return
+
+        while True:
+            _packet = self.telemetry_aggregator.get()
+            if _packet is None:
+                return
+
+            try:
+                self.queue_frame(self.telemetry_queue, _packet, block=False)
+            except Queue.Full:
+                # Try again next time around.
+                self.telemetry_aggregator.unget(_packet)
+                return
 
 
     def telemetry_queue_empty(self):
+        if self.telemetry_aggregator is not None and self.telemetry_aggregator.pending() > 0:
+            return False
         return self.telemetry_queue.qsize() == 0
 
 
@@ -260,13 +841,16 @@ class PacketTX(object):
         print(log_string)
 
 
-    def transmit_gps_telemetry(self, gps_data):
+    def transmit_gps_telemetry(self, gps_data, lifetime=None):
         """ Generate and Transmit a GPS Telemetry Packet.
 
         Keyword Arguments:
         gps_data: A dictionary, as produced by the UBloxGPS class. It must have the following fields:
                   latitude, longitude, altitude, ground_speed, ascent_rate, heading, gpsFix, numSV,
                   week, iTOW, leapS, dynamic_model.
+        lifetime: Optional time (seconds) after which the packet is discarded if it has not been sent.
+
+        A newer GPS packet supersedes this one if it is still waiting in the telemetry queue.
 
         The generated packet format is in accordance with the specification in:
         https://docs.google.com/document/d/12230J1X3r2-IcLVLkeaVmIXqFeo3uheurFakElIaPVo/edit?usp=sharing
@@ -293,11 +877,35 @@ class PacketTX(object):
                 gps_data['dynamic_model']
                 )
 
-            self.queue_telemetry_packet(gps_packet)
+            self.queue_telemetry_packet(gps_packet, lifetime=lifetime, key='gps')
         except:
             traceback.print_exc()
 
-    def transmit_orientation_telemetry(self, week, iTOW, leapS, orientation_data):
+    def transmit_gps_track(self, gps_data, flush=False):
+        """ Add a GPS fix to the GPS track, and transmit a GPS Track Packet if one is complete.
+
+        Track packets contain one absolute position followed by many small delta-encoded positions,
+        allowing high rate (i.e. 10 Hz) GPS fixes to be downlinked. Refer GPSTrack.py for the packet format.
+        The corresponding decoder for this packet format is within rx/WenetPackets.py, in the function
+        gps_track_decode
+
+        Keyword Arguments:
+        gps_data: A dictionary, as produced by the UBloxGPS class. It must have the following fields:
+                  latitude, longitude, altitude, gpsFix, numSV, week, iTOW, leapS.
+        flush: If True, transmit the buffered fixes immediately.
+        """
+        try:
+            _packets = self.gps_track.add(gps_data)
+            if flush:
+                _packets.append(self.gps_track.flush())
+
+            for _packet in _packets:
+                if _packet is not None:
+                    self.queue_telemetry_packet(_packet)
+        except:
+            traceback.print_exc()
+
+    def transmit_orientation_telemetry(self, week, iTOW, leapS, orientation_data, lifetime=None):
         """ Generate and Transmit an Payload Orientation telemetry packet.
 
         Keyword Arguments:
@@ -307,6 +915,9 @@ class PacketTX(object):
 
         orientation_data: A dictionary, as produced by the BNO055 Class. It must have the following fields:
 
+        lifetime: Optional time (seconds) after which the packet is discarded if it has not been sent.
+
+        A newer orientation packet supersedes this one if it is still waiting in the telemetry queue.
 
         The generated packet format is in accordance with the specification in 
         https://docs.google.com/document/d/12230J1X3r2-IcLVLkeaVmIXqFeo3uheurFakElIaPVo/edit?usp=sharing
@@ -337,7 +948,7 @@ class PacketTX(object):
                 orientation_data['quaternion_w']
                 )
 
-            self.queue_telemetry_packet(orientation_packet)
+            self.queue_telemetry_packet(orientation_packet, lifetime=lifetime, key='orientation')
         except:
             traceback.print_exc()
 
@@ -404,6 +1015,26 @@ class PacketTX(object):
             traceback.print_exc()
 
 
+    def transmit_image_link(self, capture_id, thumbnail_id, image_id, repeats=2):
+        """ Generate and Transmit an Image Link packet, which tells the receiver that two SSDV
+        images (a thumbnail and a full resolution image) are of the same capture.
+
+        Packet Format:
+        0:      Packet Type (0x06)
+        1-2:    Capture ID (uint16)
+        3:      SSDV image ID of the thumbnail
+        4:      SSDV image ID of the full resolution image
+
+        The corresponding decoder for this packet format is within rx/WenetPackets.py, in the function
+        image_link_decode
+        """
+        try:
+            _packet = struct.pack(">BHBB", 0x06, capture_id % 65536, thumbnail_id % 256, image_id % 256)
+            self.queue_telemetry_packet(_packet, repeats=repeats)
+        except:
+            traceback.print_exc()
+
+
     def transmit_secondary_payload_packet(self, id=1, data=[], repeats=1):
         """ Generate and transmit a packet supplied by a 'secondary' payload.
         These will usually be provided via a UDP messaging system, described in the functions
@@ -411,15 +1042,22 @@ class PacketTX(object):
 
         Keyword Arguments:
         id (int): A payload ID number, 0-255.
-        data (list): The payload contents, as a list of integers. Maximum of 254 bytes.
+        data (list): The payload contents, as a list of integers or a string. Maximum of 254 bytes.
         repeats (int): (Optional) The number of times to transmit this packet.
+
+        Each packet is subject to the payload's rate limit (refer sec_payload_limits). Packets over the limit,
+        or which do not fit in the telemetry queue, are deferred to the bulk queue, and dropped if that is full.
+        This function never blocks.
         """
 
         # Clip the id to 0-255.
         _id = int(id) % 256
 
-        # Convert the provided data to a string
-        _data = str(bytearray(data))
+        # Convert the provided data to a string, if it isn't one already.
+        if isinstance(data, str):
+            _data = data
+        else:
+            _data = str(bytearray(data))
         # Clip to 254 bytes.
         if len(_data) > 254:
             _data = _data[:254]
@@ -427,7 +1065,24 @@ class PacketTX(object):
         
         _packet = "\x03" + struct.pack(">B",_id) + _data
 
-        self.queue_telemetry_packet(_packet, repeats=repeats)
+        for n in range(repeats):
+            if self.sec_payload_admission.admit(_id):
+                if self.telemetry_aggregator is not None and repeats == 1 and self.telemetry_aggregator.add(_packet):
+                    self.sec_payload_admission.count(_id, 'admitted')
+                    continue
+
+                try:
+                    self.queue_frame(self.telemetry_queue, _packet, block=False, cache=(repeats > 1))
+                    self.sec_payload_admission.count(_id, 'admitted')
+                    continue
+                except Queue.Full:
+                    pass
+
+            try:
+                self.queue_frame(self.bulk_queue, _packet, block=False, cache=(repeats > 1))
+                self.sec_payload_admission.count(_id, 'deferred')
+            except Queue.Full:
+                self.sec_payload_admission.count(_id, 'dropped')
 
 
         
@@ -437,6 +1092,10 @@ class PacketTX(object):
 
     def handle_udp_packet(self, packet):
         ''' Process a received UDP packet '''
+        if packet[:2] == UDP_BINARY_MAGIC:
+            self.handle_udp_binary_packet(packet)
+            return
+
         try:
             packet_dict = json.loads(packet)
 
@@ -469,6 +1128,32 @@ class PacketTX(object):
             traceback.print_exc()
 
 
+    def handle_udp_binary_packet(self, packet):
+        ''' Process a received binary-format UDP packet.
+
+        Binary packets are a compact alternative to the JSON format, with the following layout:
+            0-1: Magic ('WB')
+            2:   Message type (UDP_BINARY_TEXT or UDP_BINARY_SEC_PAYLOAD)
+            3:   Secondary payload ID (ignored for text messages)
+            4:   Number of times to transmit the packet
+            5-:  Raw data - the secondary payload packet contents, or the text message.
+        '''
+        try:
+            (_type, _id, _repeats) = struct.unpack(">BBB", packet[2:5])
+            _data = packet[5:]
+
+            if _type == UDP_BINARY_SEC_PAYLOAD:
+                self.transmit_secondary_payload_packet(id=_id, data=_data, repeats=max(1, _repeats))
+            elif _type == UDP_BINARY_TEXT:
+                self.transmit_text_message(_data, repeats=max(1, _repeats))
+            else:
+                print("Unknown binary UDP message type: %d" % _type)
+
+        except Exception as e:
+            print("Could not parse binary packet: %s" % str(e))
+            traceback.print_exc()
+
+
     def udp_rx_thread(self):
         ''' Listen for Broadcast UDP packets '''
 
@@ -490,14 +1175,32 @@ class PacketTX(object):
                 m = None
             except:
                 traceback.print_exc()
-            
+                m = None
+
             if m != None:
                 self.handle_udp_packet(m[0])
+
+                # Drain any other datagrams which are already waiting, without blocking.
+                for _packet in self.udp_drain():
+                    self.handle_udp_packet(_packet)
         
         print("Closing UDP Listener")
         self.udp.close()
 
 
+    def udp_drain(self, max_packets=256):
+        ''' Read up to max_packets datagrams which are already waiting on the UDP socket. '''
+        _packets = []
+        while len(_packets) < max_packets:
+            try:
+                _packets.append(self.udp.recv(4096, socket.MSG_DONTWAIT))
+            except socket.error:
+                # Nothing left to read.
+                break
+
+        return _packets
+
+
     def start_udp(self):
         if self.listener_thread is None:
             self.listener_thread = Thread(target=self.udp_rx_thread)
@@ -507,6 +1210,80 @@ class PacketTX(object):
 
 
 
+class ImageFileStream(object):
+    """ A memory-mapped SSDV image file, which is read out 256 byte packet at a time.
+    Packets are returned as slices of the mapped file, so are not copied until framed.
+
+    If num_repairs is set, erasure coding repair packets (refer ssdv_erasure.py) are
+    generated for each group of group_size packets, and returned after that group.
+    """
+    def __init__(self, filename, packet_length=256, group_size=32, num_repairs=0):
+        self.filename = filename
+        self.packet_length = packet_length
+        self.group_size = group_size
+        self.num_repairs = num_repairs
+
+        self.f = open(filename, 'rb')
+        self.mmap = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data = np.frombuffer(self.mmap, dtype=np.uint8)
+
+        self.num_packets = len(self.data) // packet_length
+        self.packets = self.data[:self.num_packets*packet_length].reshape((-1, packet_length))
+
+        # Index of the first packet of the next group, packets of the current group still to be
+        # returned, and the most recently returned packets.
+        self.next_group = 0
+        self.pending = []
+        self.returned = []
+
+    def load_group(self):
+        _group = self.packets[self.next_group:self.next_group+self.group_size]
+        self.next_group += self.group_size
+        self.pending = list(_group)
+        if self.num_repairs > 0:
+            self.pending.extend(list(ssdv_erasure.encode_group(_group, self.num_repairs)))
+
+    def next_packets(self, count):
+        """ Return a list of up to count packets, as uint8 arrays. """
+        _packets = []
+        while len(_packets) < count:
+            if len(self.pending) == 0:
+                if self.next_group >= self.num_packets:
+                    break
+                self.load_group()
+
+            _take = self.pending[:count - len(_packets)]
+            self.pending = self.pending[len(_take):]
+            _packets.extend(_take)
+
+        self.returned = _packets
+        return _packets
+
+    def rewind(self, count):
+        """ Step back count packets (from the last call to next_packets), so they are returned again. """
+        if count > 0:
+            self.pending = self.returned[-count:] + self.pending
+
+    def finished(self):
+        return len(self.pending) == 0 and self.next_group >= self.num_packets
+
+    def remaining(self):
+        """ Return the number of image packets (not including repair packets) still to be returned. """
+        return len(self.pending) + max(0, self.num_packets - self.next_group)
+
+    def close(self):
+        # Release our views of the mapping before closing it.
+        self.data = None
+        self.packets = None
+        self.pending = []
+        self.returned = []
+        try:
+            self.mmap.close()
+        except:
+            traceback.print_exc()
+        self.f.close()
+
+
 class BinaryDebug(object):
     """ Debug binary 'transmitter' Class
     Used to write packet data to a file in one-bit-per-char (i.e. 0 = 0x00, 1 = 0x01)
@@ -517,11 +1294,13 @@ class BinaryDebug(object):
         self.f = open("debug.bin",'wb')
 
     def write(self,data):
-        # TODO: Add in RS232 framing
-        raw_data = np.array([],dtype=np.uint8)
-        for d in data:
-            d_array = np.unpackbits(np.fromstring(d,dtype=np.uint8))
-            raw_data = np.concatenate((raw_data,[0],d_array[::-1],[1]))
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+
+        # Unpack each byte into bits, LSB first, and add on a start (0) and stop (1) bit.
+        d_array = np.frombuffer(data, dtype=np.uint8).reshape((-1,1))
+        bits = np.unpackbits(d_array, axis=1)[:,::-1]
+        raw_data = np.hstack((np.zeros_like(d_array), bits, np.ones_like(d_array)))
 
         self.f.write(raw_data.astype(np.uint8).tostring())
 
@@ -529,6 +1308,100 @@ class BinaryDebug(object):
         self.f.close()
 
 
+def frame_benchmark(num_frames=2000, fec=True):
+    """ Measure framing performance (frames per second) on 256 byte payloads.
+
+    Compares the original string-concatenation framing approach against
+    the preallocated frame builder (frame_packet_into).
+    """
+    tx = PacketTX(debug=True, fec=fec)
+    crc16 = crcmod.predefined.mkCrcFun('crc-ccitt-false')
+
+    def concat_frame_packet(packet):
+        # The original framing approach, which builds the frame via string concatenation.
+        if len(packet) < tx.payload_length:
+            packet = packet + "\x55"*(tx.payload_length - len(packet))
+        crc = struct.pack("<H",crc16(packet))
+        if fec:
+            parity = ldpc_encode_string(packet + crc)
+            return tx.preamble + tx.unique_word + packet + crc + parity
+        else:
+            return tx.preamble + tx.unique_word + packet + crc
+
+    image = np.random.randint(0, 256, size=num_frames*256).astype(np.uint8)
+    packets = [image[x*256:(x+1)*256].tostring() for x in range(num_frames)]
+
+    start = time.time()
+    concat_frames = [concat_frame_packet(p) for p in packets]
+    concat_rate = num_frames/(time.time() - start)
+
+    # No destination given, so a new frame is allocated for each packet.
+    start = time.time()
+    for x in range(num_frames):
+        tx.frame_packet_into(packets[x])
+    builder_rate = num_frames/(time.time() - start)
+
+    # Frame directly out of slices of the image buffer, into a set of preallocated slots.
+    slots = np.zeros((num_frames, tx.frame_length), dtype=np.uint8)
+    start = time.time()
+    for x in range(num_frames):
+        tx.frame_packet_into(image[x*256:(x+1)*256], frame=slots[x])
+    slice_rate = num_frames/(time.time() - start)
+
+    if "".join(concat_frames) != slots.tostring():
+        print("ERROR: Frame builder output does not match string concatenation output!")
+
+    tx.s.close()
+
+    print("String concatenation: %.1f frames/s" % concat_rate)
+    print("Frame builder: %.1f frames/s" % builder_rate)
+    print("Frame builder (image slices into slots): %.1f frames/s" % slice_rate)
+
+
+def frame_cache_benchmark(duration=600):
+    """ Measure the effect of the frame cache on a realistic mix of telemetry traffic.
+
+    Simulates duration seconds of a flight: 1 Hz GPS and orientation packets (always unique),
+    image telemetry packets sent with repeats=2 every 10 seconds, status text messages
+    (from a small set) sent with repeats=3 every 30 seconds, and a few idle messages.
+    As in queue_telemetry_packet, only the repeated packets and idle messages use the cache.
+    """
+    # (packet, cached) tuples.
+    _packets = []
+    for t in range(duration):
+        _packets.append(("\x01" + struct.pack(">d", t) + "\x00"*26, False))
+        _packets.append(("\x02" + struct.pack(">d", t) + "\x00"*34, False))
+        if t % 10 == 0:
+            _image_telem = "\x54" + struct.pack(">d", t) + "\x00"*71
+            _packets.extend([(_image_telem, True)]*2)
+        if t % 30 == 0:
+            _text = "\x00" + struct.pack(">BH", 20, 0) + "Status message #%d.." % ((t//30) % 4)
+            _packets.extend([(_text, True)]*3)
+        if t % 60 == 0:
+            _packets.append(("\x00" + "DE N0CALL: \tIdle message %d" % ((t//60) % 2), True))
+
+    for _cache_size in [0, 64]:
+        tx = PacketTX(debug=True, frame_cache_size=_cache_size)
+        _slot = np.zeros(tx.frame_length, dtype=np.uint8)
+
+        start = time.time()
+        for (_packet, _cached) in _packets:
+            if _cached:
+                tx.frame_packet_cached(_packet, frame=_slot)
+            else:
+                tx.frame_packet_into(_packet, frame=_slot)
+        _rate = len(_packets)/(time.time() - start)
+
+        if tx.frame_cache is not None:
+            _cache_stats = tx.frame_cache.stats()
+            print("Frame cache (%d entries): %.1f frames/s, hit rate %.1f%% (%d hits, %d misses)" % (
+                _cache_size, _rate, 100*_cache_stats['hit_rate'], _cache_stats['hits'], _cache_stats['misses']))
+        else:
+            print("No frame cache: %.1f frames/s" % _rate)
+
+        tx.s.close()
+
+
 if __name__ == "__main__":
     """ Test script, which transmits a text message repeatedly. """
     import argparse
@@ -536,9 +1409,15 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--txport", default="/dev/ttyAMA0", type=str, help="Transmitter serial port. Defaults to /dev/ttyAMA0")
     parser.add_argument("--baudrate", default=115200, type=int, help="Transmitter baud rate. Defaults to 115200 baud.")
+    parser.add_argument("--benchmark", action="store_true", default=False, help="Run a framing benchmark and exit.")
     args = parser.parse_args()
     debug_output = False # If True, packet bits are saved to debug.bin as one char per bit.
 
+    if args.benchmark:
+        frame_benchmark()
+        frame_cache_benchmark()
+        sys.exit(0)
+
 
     tx = PacketTX(
         debug=debug_output,
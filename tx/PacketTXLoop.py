@@ -0,0 +1,551 @@
+#!/usr/bin/env python2.7
+#
+# Wenet Transmitter Event Loop
+#
+#   Copyright (C) 2018  Mark Jessop <vk5qi@rfhead.net>
+#   Released under GNU GPL v3 or later
+#
+# The transmit core of PacketTX. This picks the frames to send (via the transmit scheduler),
+# gathers them into coalesced writes, and keeps the transmit statistics, for both ways
+# PacketTX can run:
+#
+#   - Threaded (the default): PacketTX's transmit thread calls transmit() in a loop,
+#     which writes each frame (or batch of frames) with a blocking write.
+#   - Event loop: run() is a single-threaded, select() based loop. The serial port writer, the
+#     UDP listener, statistics publishing, and any timers registered by the user all run
+#     from one loop, instead of a thread each. This reduces context switching on
+#     single-core hosts (i.e. the Pi Zero). The serial port is written to via its file
+#     descriptor in non-blocking mode, so the loop only wakes up when the UART driver has
+#     room for more data. Writes to a port without a file descriptor (i.e. the debug output,
+#     or a fake serial port) are paced from a timer instead, at the port's measured throughput.
+#
+# Other threads can hand work to the event loop with call_soon_threadsafe(), which wakes
+# the loop via a self-pipe.
+#
+
+import fcntl
+import heapq
+import json
+import os
+import Queue
+import select
+import socket
+import traceback
+from collections import deque
+from threading import Condition, Lock, Thread
+from time import time
+from FrameRingBuffer import FrameCompletion
+
+
+class PacketTXLoop(object):
+    """ Transmit core and event loop for a PacketTX instance.
+
+    Every PacketTX object has one of these, as its tx_loop attribute. When the PacketTX object was
+    created with event_loop=True, PacketTX.start_tx() runs the event loop in a background thread.
+    run() can instead be called directly to run the transmitter in the calling thread.
+    """
+
+    # Maximum number of packets held by queue_packet waiting for space, per queue.
+    max_pending = 256
+
+    def __init__(self, tx):
+        """
+        Keyword Arguments:
+        tx: The PacketTX instance to drive.
+        """
+        self.tx = tx
+        self.running = False
+        self.thread = None
+
+        # Timers, as a heap of (time, sequence, function, args).
+        self.timers = []
+        self.timer_sequence = 0
+
+        # Functions handed to the loop from other threads.
+        self.callbacks = deque()
+        self.callbacks_lock = Lock()
+        (self.wake_read, self.wake_write) = os.pipe()
+        self._set_nonblocking(self.wake_read)
+        self._set_nonblocking(self.wake_write)
+
+        # Packets waiting for space in a transmit queue, per queue name, as (packet, callback, completion) tuples,
+        # and the number of packets held per queue (including those not yet handed to the loop).
+        self.pending = {}
+        self.pending_count = {}
+        self.pending_space = Condition(Lock())
+
+        # Serial port file descriptor, if the event loop is writing to it in non-blocking mode.
+        self.serial_fd = None
+        # Pacing of writes to a serial port without a file descriptor: the time the next write is due,
+        # and whether a timer has been set for it.
+        self.next_write_time = 0.0
+        self.write_scheduled = False
+
+        # Write currently in progress: [frames, data, queue, offset], where frames is a list of the
+        # (label, enqueue time) of each frame in data, and queue is the queue a single frame's slot
+        # is held in (None for batches and idle frames, which are copied out of their queues).
+        self.current = None
+
+        self.udp = None
+
+
+    def _set_nonblocking(self, fd):
+        _flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, _flags | os.O_NONBLOCK)
+
+
+    #
+    # Scheduling functions.
+    #
+
+    def call_later(self, delay, function, *args):
+        """ Run function(*args) from the loop, after delay seconds. Must be called from the loop. """
+        self.timer_sequence += 1
+        heapq.heappush(self.timers, (time() + delay, self.timer_sequence, function, args))
+
+
+    def call_soon_threadsafe(self, function, *args):
+        """ Run function(*args) from the loop as soon as possible. Can be called from any thread. """
+        with self.callbacks_lock:
+            self.callbacks.append((function, args))
+        self.wake()
+
+
+    def set(self):
+        """ Called by the transmit queues when a frame is committed, as the loop stands in for their Event. """
+        self.wake()
+
+
+    def wake(self):
+        """ Wake the loop up, i.e. when a frame has been queued from another thread. """
+        try:
+            os.write(self.wake_write, "\x00")
+        except OSError:
+            # The pipe is full, so the loop is already due to wake up.
+            pass
+
+        # When driven by the transmit thread, it may be waiting on the scheduler instead (in debug mode).
+        if self.tx.event_loop is None:
+            self.tx.scheduler.notify()
+
+
+    #
+    # Producer API.
+    #
+
+    def queue_packet(self, queue_name, packet, callback=None, block=True, timeout=None):
+        """ Queue a packet onto a transmit queue, without waiting for space in the queue.
+        Can be called from any thread.
+
+        If the queue is full, the packet is held by the loop and queued as soon as space
+        becomes available, after any other packets held for the same queue. At most
+        max_pending packets are held per queue. Beyond that, this function blocks (or raises
+        Queue.Full, if block is False or the timeout expires), so producers are slowed to the
+        rate the transmitter can send. Must not be called with block=True from the loop itself.
+
+        Keyword Arguments:
+        queue_name: Name of the transmit queue ('telemetry', 'ssdv' or 'bulk').
+        packet: The packet to frame and queue.
+        callback: Optional function, called from the loop (with no arguments) once the packet is queued.
+        block: Wait for space if max_pending packets are already held for the queue.
+        timeout: Maximum time (seconds) to wait for space.
+
+        Returns a FrameCompletion, which can be waited on until the packet has been sent.
+        """
+        with self.pending_space:
+            if timeout is not None:
+                _end_time = time() + timeout
+
+            while self.pending_count.get(queue_name, 0) >= self.max_pending:
+                if not block:
+                    raise Queue.Full
+                elif timeout is None:
+                    self.pending_space.wait()
+                else:
+                    _remaining = _end_time - time()
+                    if _remaining <= 0.0:
+                        raise Queue.Full
+                    self.pending_space.wait(_remaining)
+
+            self.pending_count[queue_name] = self.pending_count.get(queue_name, 0) + 1
+
+        _completion = FrameCompletion()
+        self.call_soon_threadsafe(self._queue_packet, queue_name, packet, callback, _completion)
+        return _completion
+
+
+    def _queue_packet(self, queue_name, packet, callback, completion):
+        if queue_name not in self.pending:
+            self.pending[queue_name] = deque()
+        self.pending[queue_name].append((packet, callback, completion))
+        self._flush_pending()
+
+
+    def pending_packets(self, queue_name):
+        """ Return the number of packets held waiting for space in a queue. """
+        with self.pending_space:
+            return self.pending_count.get(queue_name, 0)
+
+
+    def _flush_pending(self):
+        """ Move held packets into their queues, while there is space. """
+        for (_name, _pending) in self.pending.items():
+            _queue = self.tx.scheduler.queue_dict[_name]
+            _queued = 0
+            while len(_pending) > 0:
+                (_packet, _callback, _completion) = _pending[0]
+                try:
+                    self.tx.queue_frame(_queue, _packet, block=False, completion=_completion)
+                except Queue.Full:
+                    break
+
+                _pending.popleft()
+                _queued += 1
+                if _callback is not None:
+                    try:
+                        _callback()
+                    except:
+                        traceback.print_exc()
+
+            if _queued > 0:
+                with self.pending_space:
+                    self.pending_count[_name] -= _queued
+                    self.pending_space.notify_all()
+
+
+    #
+    # Transmit functions.
+    #
+
+    def next_frame(self, timeout=0):
+        """ Pick the next frame (or batch of frames, if write coalescing is enabled) to transmit,
+        and make it the current write. If there is nothing to send, an idle (or carousel) frame is
+        used to keep the modem in sync, except in debug mode.
+
+        Keyword Arguments:
+        timeout: Time (seconds) to block waiting for a frame, in debug mode.
+        """
+        if self.tx.write_batch_frames > 1:
+            self.next_batch(timeout)
+            return
+
+        self.tx.refill_image_queue()
+        self.tx.flush_telemetry_aggregator()
+
+        _next = self.tx.scheduler.next_queue(timeout=timeout if self.tx.debug else 0)
+
+        if _next is not None:
+            (_name, _queue) = _next
+            self.tx.record_queue_depths()
+            # The frame is written straight out of its slot, which is released once it has been sent.
+            _frame = _queue.get_slot(block=False)
+            self.current = [[(_name, _queue.head_timestamp())], _frame, _queue, 0]
+        elif not self.tx.debug:
+            (_label, _frame) = self.tx.next_idle_frame()
+            self.current = [[(_label, None)], _frame, None, 0]
+        else:
+            self.current = None
+
+
+    def next_batch(self, timeout=0):
+        """ Gather up to write_batch_frames frames into the batch buffer, to be sent with a single write.
+        Idle frames are used to fill the batch if there is nothing else to send (except in debug mode).
+        """
+        _buffer = self.tx.write_batch_buffer
+        _offset = 0
+        # (queue name, enqueue time) of each frame in the batch.
+        _sent = []
+
+        self.tx.record_queue_depths()
+
+        while len(_sent) < self.tx.write_batch_frames:
+            self.tx.refill_image_queue()
+            self.tx.flush_telemetry_aggregator()
+
+            # Only block if in debug mode, and we have nothing to send yet.
+            _next = self.tx.scheduler.next_queue(timeout=timeout if (self.tx.debug and len(_sent) == 0) else 0)
+
+            if _next is not None:
+                (_name, _queue) = _next
+                _frame = _queue.get_slot(block=False)
+                _buffer[_offset:_offset+len(_frame)] = _frame
+                _sent.append((_name, _queue.head_timestamp()))
+                if _name in ('ssdv', 'thumbnail') and self.tx.carousel is not None:
+                    self.tx.carousel.add(_frame)
+                _queue.release_slot()
+                self.tx.scheduler.sent(_name, len(_frame))
+            elif not self.tx.debug:
+                (_label, _frame) = self.tx.next_idle_frame()
+                _buffer[_offset:_offset+len(_frame)] = _frame
+                _sent.append((_label, None))
+            else:
+                break
+
+            _offset += len(_frame)
+
+        if _offset > 0:
+            self.current = [_sent, _buffer[:_offset], None, 0]
+        else:
+            self.current = None
+
+
+    def write_complete(self):
+        """ Update the queues and statistics once the current write has been sent. """
+        (_frames, _data, _queue, _offset) = self.current
+        self.current = None
+
+        if _queue is not None:
+            _name = _frames[0][0]
+            if _name in ('ssdv', 'thumbnail') and self.tx.carousel is not None:
+                self.tx.carousel.add(_data)
+            _queue.release_slot()
+            self.tx.scheduler.sent(_name, len(_data))
+
+        self.tx.uart_meter.update(len(_data), len(_frames))
+
+        _now = time()
+        for (_name, _enqueue_time) in _frames:
+            self.tx.tx_stats.frame_sent(_name, _enqueue_time, now=_now)
+
+        # Space may have been freed for held packets.
+        self._flush_pending()
+
+
+    def transmit(self, timeout=0):
+        """ Transmit the next frame (or batch of frames) with a blocking write.
+        Called repeatedly by PacketTX's transmit thread.
+
+        Keyword Arguments:
+        timeout: Time (seconds) to block waiting for a frame, in debug mode.
+
+        Returns False if there was nothing to send (only in debug mode).
+        """
+        # Run any work handed over by other threads (i.e. packets from queue_packet).
+        if len(self.callbacks) > 0:
+            self.run_callbacks()
+
+        if self.current is None:
+            self.next_frame(timeout)
+            if self.current is None:
+                return False
+
+        try:
+            self.tx.s.write(memoryview(self.current[1][self.current[3]:]))
+        finally:
+            self.write_complete()
+
+        return True
+
+
+    def write_ready(self):
+        """ Write as much of the current frame(s) as the serial port will accept. Used by the event loop. """
+        if self.current is None:
+            self.next_frame()
+            if self.current is None:
+                return
+
+        _data = self.current[1]
+        _offset = self.current[3]
+
+        if self.serial_fd is not None:
+            try:
+                _written = os.write(self.serial_fd, memoryview(_data[_offset:]))
+            except OSError:
+                # Would block.
+                return
+        else:
+            self.tx.s.write(memoryview(_data[_offset:]))
+            _written = len(_data) - _offset
+
+        self.current[3] += _written
+        if self.current[3] >= len(_data):
+            self.write_complete()
+
+
+    def paced_write(self):
+        """ Write the next frame(s) to a serial port without a file descriptor, which cannot be waited on
+        with select(), and may not block for as long as the data takes to send. Run from a timer, set
+        so writes go out at the port's measured throughput, at most its nominal rate.
+        """
+        self.write_scheduled = False
+
+        if not self._transmit_waiting():
+            return
+
+        if self.current is None:
+            self.next_frame()
+            if self.current is None:
+                return
+
+        _nbytes = len(self.current[1]) - self.current[3]
+        _start = time()
+        self.write_ready()
+
+        # The port cannot send faster than its nominal rate, so a higher measured rate
+        # (i.e. from writes which return immediately) is ignored.
+        _rate = self.tx.uart_meter.rate()
+        if _rate <= 0 or _rate > self.tx.uart_meter.nominal_rate:
+            _rate = self.tx.uart_meter.nominal_rate
+        _frame_time = _nbytes/_rate
+
+        # Writes are due a frame time apart, so timer latency does not slow the rate down.
+        # If a write started more than a frame time late (i.e. the last write blocked), it is not caught up on.
+        self.next_write_time = max(self.next_write_time, _start - _frame_time) + _frame_time
+
+
+    def _transmit_waiting(self):
+        """ Return True if there is something to transmit. Outside of debug mode there always is (idle frames). """
+        if not self.tx.debug or self.current is not None:
+            return True
+        return self.tx.scheduler._select() is not None
+
+
+    #
+    # UDP listener.
+    #
+
+    def open_udp(self, port):
+        self.udp = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        self.udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.udp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        except:
+            pass
+        self.udp.bind(('', port))
+        self.udp.setblocking(0)
+        self.tx.udp = self.udp
+        print("Started UDP Listener.")
+
+
+    def read_udp(self):
+        for _packet in self.tx.udp_drain():
+            self.tx.handle_udp_packet(_packet)
+
+
+    #
+    # Statistics.
+    #
+
+    def publish_stats(self):
+        try:
+            _data = {'type': 'WENET_TX_STATS', 'callsign': self.tx.callsign, 'stats': self.tx.get_stats()}
+            self.stats_socket.sendto(json.dumps(_data), ('127.0.0.1', self.tx.stats_udp_port))
+        except:
+            traceback.print_exc()
+
+        self.call_later(self.tx.stats_interval, self.publish_stats)
+
+
+    #
+    # Main loop.
+    #
+
+    def run_callbacks(self):
+        try:
+            while True:
+                os.read(self.wake_read, 4096)
+        except OSError:
+            pass
+
+        with self.callbacks_lock:
+            _callbacks = list(self.callbacks)
+            self.callbacks.clear()
+
+        for (_function, _args) in _callbacks:
+            try:
+                _function(*_args)
+            except:
+                traceback.print_exc()
+
+
+    def run_timers(self):
+        _now = time()
+        while len(self.timers) > 0 and self.timers[0][0] <= _now:
+            (_time, _sequence, _function, _args) = heapq.heappop(self.timers)
+            try:
+                _function(*_args)
+            except:
+                traceback.print_exc()
+
+
+    def run(self):
+        """ Run the event loop until the PacketTX object is closed. """
+        self.running = True
+
+        # If the serial port has a file descriptor, write to it directly in non-blocking mode,
+        # otherwise (i.e. the debug output) writes are paced from a timer (refer paced_write).
+        try:
+            self.serial_fd = self.tx.s.fileno()
+            self._set_nonblocking(self.serial_fd)
+        except:
+            self.serial_fd = None
+
+        if self.tx.udp_port is not None:
+            self.open_udp(self.tx.udp_port)
+
+        if self.tx.stats_udp_port is not None:
+            self.stats_socket = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+            self.call_later(self.tx.stats_interval, self.publish_stats)
+
+        # Queued frames wake the loop, in place of the scheduler's Event.
+        for (_name, _queue) in self.tx.scheduler.all_queues:
+            _queue.event = self
+
+        while self.running and self.tx.transmit_active:
+            _readers = [self.wake_read]
+            if self.udp is not None:
+                _readers.append(self.udp)
+
+            _writers = []
+            _timeout = None
+
+            if self._transmit_waiting():
+                if self.serial_fd is not None:
+                    _writers.append(self.serial_fd)
+                elif not self.write_scheduled:
+                    # No file descriptor to wait on, so pace the writes with a timer.
+                    self.write_scheduled = True
+                    self.call_later(max(0.0, self.next_write_time - time()), self.paced_write)
+
+            if len(self.timers) > 0:
+                _timer_timeout = max(0.0, self.timers[0][0] - time())
+                _timeout = _timer_timeout if _timeout is None else min(_timeout, _timer_timeout)
+
+            if self.tx.debug and _timeout is None:
+                # Wake up periodically, as aggregated telemetry becomes due without a frame being queued.
+                _timeout = self.tx.debug_wait_time()
+
+            try:
+                (_readable, _writable, _error) = select.select(_readers, _writers, [], _timeout)
+            except select.error:
+                continue
+
+            if self.wake_read in _readable:
+                self.run_callbacks()
+
+            if self.udp is not None and self.udp in _readable:
+                self.read_udp()
+
+            self.run_timers()
+
+            if self.serial_fd is not None and self.serial_fd in _writable:
+                if self._transmit_waiting():
+                    self.write_ready()
+
+        print("Closing Event Loop")
+
+        if self.udp is not None:
+            self.udp.close()
+
+        self.tx.s.close()
+
+
+    def start(self):
+        """ Run the loop in a (single) background thread. """
+        self.thread = Thread(target=self.run)
+        self.thread.start()
+
+
+    def stop(self):
+        self.running = False
+        self.wake()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python2.7
+#
+# Wenet State Snapshots
+#
+#   Copyright (C) 2018  Mark Jessop <vk5qi@rfhead.net>
+#   Released under GNU GPL v3 or later
+#
+# Copy-on-write state dictionary, shared between a sensor's RX thread (the writer) and
+# any number of reader threads (i.e. the camera, telemetry and callback threads), as used
+# by the UBloxGPS and WenetBNO055 classes.
+#
+# The published state dictionary is never modified. A write copies it, modifies the copy,
+# and publishes the copy by re-binding a single attribute, which is atomic in CPython.
+# Readers just take a reference to the current dictionary, so they never wait, never spin,
+# and never see a half-written state. A lock is only held between writers.
+#
+# Run this file to stress-test it against the spin-lock scheme it replaced.
+#
+
+import os
+import time
+from contextlib import contextmanager
+from threading import RLock, Thread
+
+
+class StateSnapshot(object):
+    """ Lock-free-read State Dictionary """
+
+    def __init__(self, initial_state):
+        """
+        Keyword Arguments:
+        initial_state: Dictionary of the initial state. This is copied, not modified.
+        """
+        self.state = dict(initial_state)
+
+        # Held by writers only. Re-entrant, so write() can be called within block_write().
+        self.write_lock = RLock()
+        # State being built up by a block write, which is not yet visible to readers.
+        self.pending = None
+
+
+    def read(self):
+        """ Return a copy of the latest state dictionary. Never blocks. """
+        return self.state.copy()
+
+
+    def write(self, key, value):
+        """ Set a single state value. Within a block write, it is not published until the block ends. """
+        with self.write_lock:
+            if self.pending is not None:
+                self.pending[key] = value
+            else:
+                _state = self.state.copy()
+                _state[key] = value
+                self.state = _state
+
+
+    def update(self, values):
+        """ Set a number of state values (from a dictionary), which are published together. """
+        with self.write_lock:
+            if self.pending is not None:
+                self.pending.update(values)
+            else:
+                _state = self.state.copy()
+                _state.update(values)
+                self.state = _state
+
+
+    @contextmanager
+    def block_write(self):
+        """ Context manager within which writes are collected, and then published together,
+        so readers never see a partially updated state. Other writers wait until the block ends.
+        If the block raises an exception, none of its writes are published.
+        """
+        with self.write_lock:
+            if self.pending is not None:
+                # Nested block, which is published with the outer block.
+                yield
+                return
+
+            self.pending = self.state.copy()
+            try:
+                yield
+                self.state = self.pending
+            finally:
+                self.pending = None
+
+
+class _SpinLockState(object):
+    """ The spin-lock scheme previously used by UBloxGPS and WenetBNO055, for comparison. """
+
+    def __init__(self, initial_state):
+        self.state = dict(initial_state)
+        self.state_writelock = False
+        self.state_readlock = False
+        self.state_blockwrite = False
+
+    def read(self):
+        while self.state_writelock:
+            pass
+
+        self.state_readlock = True
+        _state = self.state.copy()
+        self.state_readlock = False
+        return _state
+
+    def write(self, key, value):
+        while self.state_readlock:
+            pass
+
+        self.state_writelock = True
+        self.state[key] = value
+        if not self.state_blockwrite:
+            self.state_writelock = False
+
+    @contextmanager
+    def block_write(self):
+        self.state_blockwrite = True
+        try:
+            yield
+        finally:
+            self.state_blockwrite = False
+            self.state_writelock = False
+
+
+def _stress(state, duration, readers, fields, write_interval, read_interval):
+    """ Run one writer and a number of reader threads against a state object for duration seconds.
+    The writer sets every field to the same counter value within a block write, so a reader which
+    sees differing values has seen a torn (partially updated) state.
+    Returns a tuple of (writes, reads, torn reads, CPU seconds used).
+    """
+    _keys = ['field_%d' % i for i in range(fields)]
+    _running = [True]
+    _counts = {'writes': 0, 'reads': [0]*readers, 'torn': [0]*readers}
+
+    def writer():
+        _counter = 0
+        while _running[0]:
+            _counter += 1
+            with state.block_write():
+                for _key in _keys:
+                    state.write(_key, _counter)
+            _counts['writes'] += 1
+            if write_interval > 0:
+                time.sleep(write_interval)
+
+    def reader(index):
+        while _running[0]:
+            _state = state.read()
+            if len(set([_state[_key] for _key in _keys])) != 1:
+                _counts['torn'][index] += 1
+            _counts['reads'][index] += 1
+            if read_interval > 0:
+                time.sleep(read_interval)
+
+    _threads = [Thread(target=writer)] + [Thread(target=reader, args=(i,)) for i in range(readers)]
+
+    _start = os.times()
+    for _thread in _threads:
+        _thread.start()
+
+    time.sleep(duration)
+    _running[0] = False
+    for _thread in _threads:
+        _thread.join()
+    _end = os.times()
+
+    _cpu = (_end[0] - _start[0]) + (_end[1] - _start[1])
+    return (_counts['writes'], sum(_counts['reads']), sum(_counts['torn']), _cpu)
+
+
+def stress_test(duration=5.0, readers=4, fields=32, write_interval=0.01, read_interval=0.001):
+    """ Compare the StateSnapshot with the previous spin-lock scheme, under concurrent readers and a writer,
+    reporting throughput, CPU usage, and the number of torn reads seen.
+
+    Keyword Arguments:
+    duration: Duration of each test, in seconds.
+    readers: Number of reader threads.
+    fields: Number of fields written in each block write.
+    write_interval: Delay between block writes (i.e. the sensor's update rate). 0 to write continuously.
+    read_interval: Delay between each reader's reads. 0 to read continuously.
+    """
+    _initial = dict([('field_%d' % i, 0) for i in range(fields)])
+
+    for (_name, _state) in [("Spin-lock", _SpinLockState(_initial)), ("Snapshot", StateSnapshot(_initial))]:
+        (_writes, _reads, _torn, _cpu) = _stress(_state, duration, readers, fields, write_interval, read_interval)
+        print("%s: %d writes/s, %d reads/s, CPU %.0f%%, %d torn reads." % (
+            _name, _writes/duration, _reads/duration, 100.0*_cpu/duration, _torn))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duration", type=float, default=5.0, help="Duration of each test, in seconds.")
+    parser.add_argument("--readers", type=int, default=4, help="Number of reader threads.")
+    parser.add_argument("--fields", type=int, default=32, help="Number of state fields written per update.")
+    parser.add_argument("--write_interval", type=float, default=0.01, help="Delay between writes, in seconds.")
+    parser.add_argument("--read_interval", type=float, default=0.001, help="Delay between reads, in seconds.")
+    args = parser.parse_args()
+
+    stress_test(duration=args.duration, readers=args.readers, fields=args.fields,
+        write_interval=args.write_interval, read_interval=args.read_interval)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python2.7
+#
+# Wenet Telemetry Aggregator
+#
+#   Copyright (C) 2018  Mark Jessop <vk5qi@rfhead.net>
+#   Released under GNU GPL v3 or later
+#
+# Packs several small telemetry packets (GPS, orientation, text messages, etc) into
+# a single 'telemetry container' packet, so they share one transmitted frame.
+#
+# Telemetry Container Packet Format:
+#   0:      Packet Type (0x04)
+#   1:      Number of records
+#   Then, for each record:
+#   0:      Record length (N)
+#   1-N:    Record - a complete telemetry packet, starting with its own packet type byte.
+#
+# The remainder of the packet is padding. The corresponding decoder is within
+# rx/WenetPackets.py, in the function telemetry_container_decode.
+#
+# Records can be added with a supersede key (i.e. 'gps'), in which case they replace
+# any record with the same key still waiting in the open container.
+#
+
+import struct
+from threading import Lock
+from time import time
+
+TELEMETRY_CONTAINER_PACKET_TYPE = 0x04
+
+
+class TelemetryAggregator(object):
+    """ Telemetry Aggregator
+
+    Records are added to an open container. The container is closed, and made available
+    to transmit, when the next record does not fit in it, or once the oldest record in it
+    has been waiting for longer than the aggregation window.
+    """
+
+    def __init__(self, window=0.5, payload_length=256):
+        """
+        Keyword Arguments:
+        window: Maximum time (seconds) a record is held back waiting for other records.
+        payload_length: Length of the packet the container must fit within.
+        """
+        self.window = window
+        self.payload_length = payload_length
+        # Largest record which fits in an (empty) container.
+        self.max_record_length = min(payload_length - 3, 255)
+
+        self.records = []
+        self.keys = []
+        self.length = 2
+        self.start_time = None
+        # Closed containers, waiting to be transmitted.
+        self.ready = []
+
+        self.lock = Lock()
+
+
+    def _close(self):
+        """ Close the open container. Called with self.lock held. """
+        if len(self.records) == 0:
+            return
+
+        _packet = struct.pack(">BB", TELEMETRY_CONTAINER_PACKET_TYPE, len(self.records))
+        for _record in self.records:
+            _packet += struct.pack(">B", len(_record)) + _record
+
+        self.ready.append(_packet)
+        self.records = []
+        self.keys = []
+        self.length = 2
+        self.start_time = None
+
+
+    def add(self, packet, key=None, now=None):
+        """ Add a telemetry packet to the open container.
+        If a key is given, any record in the open container with the same key is replaced.
+        Returns False if the packet is too large to ever fit in a container.
+        """
+        if len(packet) > self.max_record_length:
+            return False
+
+        if now is None:
+            now = time()
+
+        with self.lock:
+            if key is not None and key in self.keys:
+                _index = self.keys.index(key)
+                if self.length - len(self.records[_index]) + len(packet) <= self.payload_length:
+                    self.length += len(packet) - len(self.records[_index])
+                    self.records[_index] = packet
+                    return True
+
+            if self.length + 1 + len(packet) > self.payload_length:
+                self._close()
+
+            if self.start_time is None:
+                self.start_time = now
+
+            self.records.append(packet)
+            self.keys.append(key)
+            self.length += 1 + len(packet)
+
+        return True
+
+
+    def get(self, now=None, force=False):
+        """ Return the next container packet ready to transmit, or None.
+
+        Keyword Arguments:
+        now: Current time. Defaults to time().
+        force: Close the open container even if its aggregation window has not expired.
+        """
+        if now is None:
+            now = time()
+
+        with self.lock:
+            if self.start_time is not None and (force or (now - self.start_time) >= self.window):
+                self._close()
+
+            if len(self.ready) > 0:
+                return self.ready.pop(0)
+            else:
+                return None
+
+
+    def unget(self, packet):
+        """ Return a container packet which could not be queued, so it is sent first next time. """
+        with self.lock:
+            self.ready.insert(0, packet)
+
+
+    def time_remaining(self, now=None):
+        """ Return the time until the open container must be sent, 0 if a container is
+        ready now, or None if there is nothing waiting.
+        """
+        if now is None:
+            now = time()
+
+        with self.lock:
+            if len(self.ready) > 0:
+                return 0.0
+            elif self.start_time is None:
+                return None
+            else:
+                return max(0.0, self.window - (now - self.start_time))
+
+
+    def pending(self):
+        """ Return the number of records waiting to be sent. """
+        with self.lock:
+            return len(self.records) + sum([ord(_packet[1]) for _packet in self.ready])
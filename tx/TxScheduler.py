@@ -0,0 +1,459 @@
+#!/usr/bin/env python2.7
+#
+# Wenet Transmit Scheduler
+#
+#   Copyright (C) 2018  Mark Jessop <vk5qi@rfhead.net>
+#   Released under GNU GPL v3 or later
+#
+# Decides which transmit queue the next frame is taken from, and blocks
+# on an Event (rather than polling) when there is nothing to send.
+#
+# Scheduling policies:
+#   'priority' - Strict priority. Always send from the highest priority queue with frames waiting.
+#   'weighted' - Weighted fair share (deficit round robin) between queues.
+#   'airtime'  - Per-queue airtime budget, as a fraction of the transmit time over a sliding window.
+#
+# Background queues (i.e. over-limit secondary payload traffic) are only sent from when no
+# other queue has frames ready, in place of an idle frame.
+#
+# Also contains token bucket admission control, used to rate limit secondary payload traffic.
+#
+
+from threading import Event, Lock
+from time import time, sleep
+from collections import deque
+
+
+class StrictPriorityPolicy(object):
+    """ Strict priority scheduling.
+    Queues are served in the order they were provided to the scheduler.
+    This is the original PacketTX behaviour (telemetry first, then SSDV).
+    """
+
+    def select(self, ready, now):
+        """ Pick a queue to transmit from.
+
+        Keyword Arguments:
+        ready: List of queue names with frames ready, in priority order.
+        now: Current time.
+
+        Returns the name of the queue to transmit from.
+        """
+        return ready[0]
+
+    def sent(self, name, nbytes, now):
+        """ Update the policy state after a frame has been transmitted. """
+        pass
+
+
+# Default relative weights of the weighted fair share policy.
+DEFAULT_WEIGHTS = {'telemetry': 1, 'thumbnail': 3, 'ssdv': 3}
+
+# Default airtime budgets of the airtime budget policy.
+DEFAULT_BUDGETS = {'telemetry': 0.25, 'thumbnail': 1.0, 'ssdv': 1.0}
+
+
+class WeightedFairPolicy(object):
+    """ Weighted fair share scheduling, using deficit round robin.
+
+    Each queue accumulates a byte 'deficit' proportional to its weight on every round, and
+    may transmit while its deficit covers the frame length. Queues with nothing to send
+    do not accumulate credit, so no airtime is wasted.
+    """
+
+    def __init__(self, weights=None, quantum=256):
+        """
+        Keyword Arguments:
+        weights: Dictionary of relative (positive) weights per queue name. Queues not listed have a weight of 1.
+                 Defaults to DEFAULT_WEIGHTS.
+        quantum: Number of bytes of credit given per unit weight on each round.
+        """
+        self.weights = dict(weights if weights is not None else DEFAULT_WEIGHTS)
+        self.quantum = quantum
+        self.deficit = {}
+
+    def select(self, ready, now):
+        # Forget the credit of any queue which has emptied.
+        for name in self.deficit.keys():
+            if name not in ready:
+                self.deficit[name] = 0
+
+        while True:
+            for name in ready:
+                if self.deficit.get(name, 0) > 0:
+                    return name
+
+            # Nobody has any credit left - start a new round.
+            for name in ready:
+                self.deficit[name] = self.deficit.get(name, 0) + self.weights.get(name, 1) * self.quantum
+
+    def sent(self, name, nbytes, now):
+        self.deficit[name] = self.deficit.get(name, 0) - nbytes
+
+
+class AirtimeBudgetPolicy(object):
+    """ Per-queue airtime budget scheduling.
+
+    Each queue is allocated a fraction of the transmit airtime, measured over a sliding window.
+    Queues are served in priority order while they are within their budget. If every queue with
+    frames waiting is over budget, the highest priority one is served anyway, so the link is never idle.
+    """
+
+    def __init__(self, budgets=None, window=10.0):
+        """
+        Keyword Arguments:
+        budgets: Dictionary of maximum airtime fractions (0.0 - 1.0) per queue name. Queues not listed are unlimited.
+                 Defaults to DEFAULT_BUDGETS.
+        window: Length of the sliding window (seconds) airtime is measured over.
+        """
+        self.budgets = dict(budgets if budgets is not None else DEFAULT_BUDGETS)
+        self.window = window
+        self.history = deque()
+        self.total_bytes = 0
+        self.queue_bytes = {}
+
+    def _expire(self, now):
+        while len(self.history) > 0 and (now - self.history[0][0]) > self.window:
+            (_time, _name, _nbytes) = self.history.popleft()
+            self.total_bytes -= _nbytes
+            self.queue_bytes[_name] -= _nbytes
+
+    def airtime(self, name):
+        """ Return the fraction of airtime used by a queue over the current window. """
+        if self.total_bytes == 0:
+            return 0.0
+        return float(self.queue_bytes.get(name, 0)) / self.total_bytes
+
+    def select(self, ready, now):
+        self._expire(now)
+
+        for name in ready:
+            if self.airtime(name) < self.budgets.get(name, 1.0):
+                return name
+
+        return ready[0]
+
+    def sent(self, name, nbytes, now):
+        self.history.append((now, name, nbytes))
+        self.total_bytes += nbytes
+        self.queue_bytes[name] = self.queue_bytes.get(name, 0) + nbytes
+
+
+TX_POLICIES = {
+    'priority': StrictPriorityPolicy,
+    'weighted': WeightedFairPolicy,
+    'airtime': AirtimeBudgetPolicy
+}
+
+
+class TxScheduler(object):
+    """ Transmit Scheduler
+
+    Holds a list of named transmit queues (FrameRingBuffers) in priority order, and a
+    scheduling policy. The queues set a shared Event whenever a frame is committed, which
+    the transmit thread blocks on when there is nothing to send.
+    """
+
+    def __init__(self, queues, policy='priority', background=None):
+        """
+        Keyword Arguments:
+        queues: List of (name, FrameRingBuffer) tuples, in priority order.
+        policy: Either the name of a policy ('priority', 'weighted', 'airtime'), or a policy object.
+        background: List of (name, FrameRingBuffer) tuples, in priority order, which are only
+                    sent from when none of the above queues have frames ready.
+        """
+        self.queues = list(queues)
+        self.background = list(background) if background is not None else []
+        self.all_queues = self.queues + self.background
+        self.background_names = set([_name for (_name, _queue) in self.background])
+        self.queue_dict = dict(self.all_queues)
+        self.event = Event()
+
+        if policy in TX_POLICIES:
+            self.policy = TX_POLICIES[policy]()
+        elif hasattr(policy, 'select'):
+            self.policy = policy
+        else:
+            raise ValueError("Unknown transmit policy '%s'. Must be one of %s" % (str(policy), str(TX_POLICIES.keys())))
+
+        for (_name, _queue) in self.all_queues:
+            _queue.event = self.event
+
+
+    def notify(self):
+        """ Wake up the transmit thread, i.e. on shutdown. """
+        self.event.set()
+
+
+    def ready(self):
+        """ Return a list of the names of queues with frames ready to send, in priority order. """
+        return [_name for (_name, _queue) in self.queues if _queue.ready()]
+
+
+    def background_ready(self):
+        """ Return the name of the first background queue with frames ready, or None. """
+        for (_name, _queue) in self.background:
+            if _queue.ready():
+                return _name
+
+        return None
+
+
+    def _select(self):
+        """ Return the name of the queue to send from, or None if nothing is ready. """
+        _ready = self.ready()
+        if len(_ready) > 0:
+            return self.policy.select(_ready, time())
+        else:
+            return self.background_ready()
+
+
+    def next_queue(self, timeout=None):
+        """ Select the next queue to transmit from.
+
+        Keyword Arguments:
+        timeout: Time (seconds) to block for a frame to become available.
+                 0 returns immediately, None blocks indefinitely (until notify() is called).
+
+        Returns a (name, queue) tuple, or None if no frames are ready.
+        """
+        # Clear the event before checking the queues, so we cannot miss a frame
+        # committed between the check and the wait.
+        self.event.clear()
+        _name = self._select()
+
+        if _name is None:
+            if timeout == 0:
+                return None
+
+            self.event.wait(timeout)
+            _name = self._select()
+
+            if _name is None:
+                return None
+
+        return (_name, self.queue_dict[_name])
+
+
+    def sent(self, name, nbytes):
+        """ Inform the policy that a frame has been transmitted from a queue.
+        Background queues do not count towards the policy. """
+        if name not in self.background_names:
+            self.policy.sent(name, nbytes, time())
+
+
+class TokenBucket(object):
+    """ Token bucket rate limiter.
+    Tokens accumulate at a fixed rate, up to the burst size. Each admitted packet uses one token.
+    """
+
+    def __init__(self, rate, burst):
+        """
+        Keyword Arguments:
+        rate: Long-term rate limit, in packets per second.
+        burst: Maximum number of packets which can be admitted at once.
+        """
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.last_update = None
+
+    def consume(self, tokens=1, now=None):
+        """ Attempt to take tokens from the bucket. Returns True if the packet is within the rate limit. """
+        if now is None:
+            now = time()
+
+        if self.last_update is not None:
+            self.tokens = min(self.burst, self.tokens + max(0.0, now - self.last_update)*self.rate)
+        self.last_update = now
+
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        else:
+            return False
+
+
+class AdmissionControl(object):
+    """ Per-ID token bucket admission control, with counters of the packets admitted,
+    deferred (sent to a background queue) and dropped for each ID.
+    """
+
+    def __init__(self, limits=None, default_limit=None):
+        """
+        Keyword Arguments:
+        limits: Dictionary of (rate, burst) tuples per ID. Rate is in packets per second.
+        default_limit: (rate, burst) tuple used for IDs not in limits. If None, these IDs are not rate limited.
+        """
+        self.limits = dict(limits) if limits is not None else {}
+        self.default_limit = default_limit
+        self.buckets = {}
+        self.counters = {}
+        self.lock = Lock()
+
+    def admit(self, id, now=None):
+        """ Returns True if a packet from this ID is within its rate limit. """
+        with self.lock:
+            if id not in self.buckets:
+                _limit = self.limits.get(id, self.default_limit)
+                self.buckets[id] = TokenBucket(*_limit) if _limit is not None else None
+
+            if self.buckets[id] is None:
+                return True
+
+            return self.buckets[id].consume(1, now)
+
+    def count(self, id, result):
+        """ Record the result ('admitted', 'deferred' or 'dropped') of a packet from an ID. """
+        with self.lock:
+            if id not in self.counters:
+                self.counters[id] = {'admitted': 0, 'deferred': 0, 'dropped': 0}
+            self.counters[id][result] += 1
+
+    def stats(self):
+        """ Return a dictionary of the counters for each ID. """
+        with self.lock:
+            return dict([(_id, dict(_counters)) for (_id, _counters) in self.counters.items()])
+
+
+class FakeSerial(object):
+    """ Fake serial port, which takes as long to 'transmit' data as a real UART,
+    and keeps a log of the frames written to it. Used to test transmit scheduling.
+    """
+
+    def __init__(self, baudrate=115177, classify=None, frame_length=None):
+        """
+        Keyword Arguments:
+        baudrate: Emulated baud rate. 10 bits are sent per byte (8N1).
+        classify: A function which is passed each written frame, and returns a label for it.
+        frame_length: If set, each write is split into frames of this length before being classified
+                      (i.e. for coalesced writes). Otherwise each write is treated as one frame.
+        """
+        self.baudrate = baudrate
+        self.classify = classify
+        self.frame_length = frame_length
+        self.log = []
+
+    def write(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+
+        _start = time()
+        _duration = len(data)*10.0/self.baudrate
+
+        if self.classify is not None:
+            _length = self.frame_length if self.frame_length is not None else len(data)
+            for _offset in range(0, len(data), _length):
+                _frame = data[_offset:_offset+_length]
+                self.log.append((_start, self.classify(_frame), len(_frame)))
+
+        # Block until the data would have been sent.
+        _remaining = _duration - (time() - _start)
+        if _remaining > 0:
+            sleep(_remaining)
+
+        return len(data)
+
+    def close(self):
+        pass
+
+
+def scheduler_test(duration=10.0, baudrate=115177, telemetry_rate=12.0, tolerance=0.05, tx_options=None):
+    """ Drive each scheduling policy with a fake serial sink, using a mix of
+    SSDV and telemetry traffic, and report the airtime share each queue received.
+
+    The SSDV queue is kept full, and telemetry is offered at telemetry_rate packets per second,
+    which should be below the link's frame rate. Asserts that the link was kept busy, and that
+    each policy gave the telemetry queue the airtime share it should have:
+        priority - All of the offered telemetry.
+        weighted - 1/4 (weights of 1:3).
+        airtime - 1/4 (budget of 0.25).
+
+    tx_options are passed on to PacketTX, i.e. {'write_batch_latency': 0.1} or {'event_loop': True}.
+    """
+    import PacketTX
+    from threading import Thread
+
+    _results = {}
+
+    for _policy in sorted(TX_POLICIES.keys()):
+        tx = None
+
+        def classify(frame):
+            _type = ord(frame[tx.payload_offset])
+            if _type == 0x55:
+                return 'ssdv'
+            elif _type == 0x56:
+                return 'idle'
+            else:
+                return 'telemetry'
+
+        _sink = FakeSerial(baudrate=baudrate, classify=classify)
+        tx = PacketTX.PacketTX(serial_port=_sink, serial_baud=baudrate, tx_policy=_policy, **(tx_options or {}))
+        _sink.frame_length = tx.frame_length
+        tx.start_tx()
+
+        _running = [True]
+
+        def telemetry_source():
+            # Pairs of GPS-sized packets, at telemetry_rate packets per second in total.
+            _next = time()
+            while _running[0]:
+                for i in range(2):
+                    tx.queue_telemetry_packet("\x01" + "\x00"*34)
+                _next += 2.0/telemetry_rate
+                sleep(max(0.0, _next - time()))
+
+        _telem_thread = Thread(target=telemetry_source)
+        _telem_thread.start()
+
+        # Keep the SSDV queue full for the duration of the test.
+        _end = time() + duration
+        while time() < _end:
+            try:
+                tx.queue_image_packet("\x55" + "\x00"*255)
+            except:
+                pass
+            while tx.ssdv_queue.qsize() > 200 and time() < _end:
+                sleep(0.05)
+
+        _running[0] = False
+        _telem_thread.join()
+        tx.close()
+
+        _counts = {}
+        for (_time, _label, _len) in _sink.log:
+            _counts[_label] = _counts.get(_label, 0) + _len
+
+        _total = float(max(sum(_counts.values()), 1))
+        _shares = dict([(_label, _counts.get(_label, 0)/_total) for _label in ['telemetry', 'ssdv', 'idle']])
+        print("Policy '%s': %d frames, %.1f frames/s. Airtime - Telemetry: %.1f%%, SSDV: %.1f%%, Idle: %.1f%%" % (
+            _policy,
+            len(_sink.log),
+            len(_sink.log)/duration,
+            100.0*_shares['telemetry'],
+            100.0*_shares['ssdv'],
+            100.0*_shares['idle']))
+
+        _results[_policy] = (len(_sink.log), _shares)
+
+        # The link should have been kept (almost) fully busy.
+        _capacity = duration*baudrate/(10.0*tx.frame_length)
+        assert len(_sink.log) >= 0.9*_capacity, "Policy '%s' only sent %d of %d possible frames." % (_policy, len(_sink.log), _capacity)
+        assert _shares['idle'] <= tolerance, "Policy '%s' sent idle frames while queues were full." % _policy
+
+        # Check the telemetry queue got its expected share of the airtime.
+        if _policy == 'priority':
+            _expected = min(1.0, telemetry_rate*tx.frame_length*10.0/baudrate)
+        else:
+            _expected = 0.25
+        assert abs(_shares['telemetry'] - _expected) <= tolerance, "Policy '%s' gave telemetry %.1f%% of the airtime, expected %.1f%%." % (
+            _policy, 100.0*_shares['telemetry'], 100.0*_expected)
+
+    return _results
+
+
+if __name__ == "__main__":
+    for _options in [{}, {'write_batch_latency': 0.1}, {'event_loop': True}]:
+        print("PacketTX options: %s" % str(_options))
+        scheduler_test(tx_options=_options)
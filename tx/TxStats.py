@@ -0,0 +1,203 @@
+#!/usr/bin/env python2.7
+#
+# Wenet Transmitter Statistics
+#
+#   Copyright (C) 2018  Mark Jessop <vk5qi@rfhead.net>
+#   Released under GNU GPL v3 or later
+#
+# Measurement helpers used by PacketTX to report on transmitter performance.
+#
+
+import numpy as np
+from threading import Lock
+from time import time
+from collections import deque
+
+
+class ThroughputMeter(object):
+    """ Measure the achieved byte rate of a (blocking) writer, i.e. a serial port.
+
+    The time at which each write completes is recorded, and the byte rate is calculated
+    over a sliding window. As serial writes block once the UART's transmit buffer is full,
+    in steady state this is the rate the UART is actually sending data at.
+    """
+
+    def __init__(self, nominal_rate, window=10.0):
+        """
+        Keyword Arguments:
+        nominal_rate: Nominal byte rate of the link (i.e. baud rate / 10 for 8N1).
+        window: Length of the sliding window (seconds) the rate is measured over.
+        """
+        self.nominal_rate = float(nominal_rate)
+        self.window = window
+        self.history = deque()
+        self.window_bytes = 0
+
+        self.total_bytes = 0
+        self.total_frames = 0
+        self.total_writes = 0
+
+        self.lock = Lock()
+
+
+    def update(self, nbytes, frames=1):
+        """ Record a completed write of nbytes, containing a number of frames. """
+        _now = time()
+
+        with self.lock:
+            self.history.append((_now, nbytes))
+            self.window_bytes += nbytes
+            self.total_bytes += nbytes
+            self.total_frames += frames
+            self.total_writes += 1
+
+            while (_now - self.history[0][0]) > self.window:
+                (_time, _nbytes) = self.history.popleft()
+                self.window_bytes -= _nbytes
+
+
+    def rate(self):
+        """ Return the measured byte rate over the current window. """
+        with self.lock:
+            if len(self.history) < 2:
+                return 0.0
+
+            _elapsed = self.history[-1][0] - self.history[0][0]
+            if _elapsed <= 0:
+                return 0.0
+
+            # The bytes from the first write in the window were sent before the window started.
+            return (self.window_bytes - self.history[0][1]) / _elapsed
+
+
+    def stats(self):
+        """ Return a dictionary of throughput statistics. """
+        _rate = self.rate()
+
+        with self.lock:
+            return {
+                'nominal_bytes_per_sec': self.nominal_rate,
+                'measured_bytes_per_sec': _rate,
+                'utilisation': _rate / self.nominal_rate,
+                'bytes_written': self.total_bytes,
+                'frames_written': self.total_frames,
+                'writes': self.total_writes,
+                'frames_per_write': float(self.total_frames) / max(self.total_writes, 1)
+            }
+
+
+class RollingSamples(object):
+    """ Keep the most recent samples of a value, and report percentiles over them. """
+
+    def __init__(self, max_samples=1000):
+        self.samples = deque(maxlen=max_samples)
+
+    def add(self, value):
+        self.samples.append(value)
+
+    def stats(self, percentiles=(50, 90, 99)):
+        """ Return a dictionary of the mean, max and requested percentiles of the current samples. """
+        if len(self.samples) == 0:
+            return {}
+
+        _samples = np.array(self.samples, dtype=np.float64)
+        _stats = {'mean': float(_samples.mean()), 'max': float(_samples.max()), 'samples': len(_samples)}
+        for _p, _value in zip(percentiles, np.percentile(_samples, percentiles)):
+            _stats['p%d' % _p] = float(_value)
+
+        return _stats
+
+
+class TxStatsCollector(object):
+    """ Collect transmit statistics per queue.
+
+    Tracks the enqueue-to-air latency of each frame, the depth of each queue, the frame
+    rate of each queue (including idle frames), and the ratio of idle (and carousel)
+    frames to all frames sent.
+    Rates are measured over a sliding window, latency and depth over the most recent samples.
+    """
+
+    def __init__(self, queue_names, window=60.0, max_samples=1000):
+        """
+        Keyword Arguments:
+        queue_names: List of transmit queue names.
+        window: Length of the sliding window (seconds) frame rates are measured over.
+        max_samples: Number of latency and queue depth samples to keep per queue.
+        """
+        self.queue_names = list(queue_names)
+        self.window = window
+        self.start_time = time()
+
+        self.frames = deque()
+        self.frame_counts = {}
+        self.total_frames = {}
+        self.latency = {}
+        self.depth = {}
+
+        for _name in self.queue_names + ['idle', 'carousel']:
+            self.frame_counts[_name] = 0
+            self.total_frames[_name] = 0
+
+        for _name in self.queue_names:
+            self.latency[_name] = RollingSamples(max_samples)
+            self.depth[_name] = RollingSamples(max_samples)
+
+        self.lock = Lock()
+
+
+    def frame_sent(self, name, enqueue_time=None, now=None):
+        """ Record a frame being written to the transmitter.
+
+        Keyword Arguments:
+        name: Name of the queue the frame came from, 'idle' for an idle frame, or
+              'carousel' for a carousel re-transmission.
+        enqueue_time: Time the frame was queued, used to calculate its latency.
+        now: Time the frame was written. Defaults to the current time.
+        """
+        if now is None:
+            now = time()
+
+        with self.lock:
+            self.frames.append((now, name))
+            self.frame_counts[name] += 1
+            self.total_frames[name] += 1
+
+            while (now - self.frames[0][0]) > self.window:
+                (_time, _name) = self.frames.popleft()
+                self.frame_counts[_name] -= 1
+
+            if enqueue_time is not None:
+                self.latency[name].add(now - enqueue_time)
+
+
+    def queue_depth(self, name, depth):
+        """ Record a sample of a queue's depth. """
+        with self.lock:
+            self.depth[name].add(depth)
+
+
+    def stats(self):
+        """ Return a dictionary of transmit statistics. """
+        with self.lock:
+            _now = time()
+            _elapsed = max(min(self.window, _now - self.start_time), 1e-3)
+            _window_frames = max(sum(self.frame_counts.values()), 1)
+
+            _stats = {
+                'frames_per_sec': sum(self.frame_counts.values()) / _elapsed,
+                'idle_ratio': float(self.frame_counts['idle']) / _window_frames,
+                'idle_frames': self.total_frames['idle'],
+                'carousel_ratio': float(self.frame_counts['carousel']) / _window_frames,
+                'carousel_frames': self.total_frames['carousel'],
+                'queues': {}
+            }
+
+            for _name in self.queue_names:
+                _stats['queues'][_name] = {
+                    'frames_per_sec': self.frame_counts[_name] / _elapsed,
+                    'frames_sent': self.total_frames[_name],
+                    'latency': self.latency[_name].stats(),
+                    'depth': self.depth[_name].stats()
+                }
+
+            return _stats
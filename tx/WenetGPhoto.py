@@ -19,6 +19,8 @@ import glob
 import os
 import subprocess
 import datetime
+import shutil
+from ImagePipeline import ImagePipeline
 
 import piggyphoto
 
@@ -37,7 +39,9 @@ class WenetGPhoto(object):
 				num_images=1, 
 				temp_filename_prefix = 'gphoto_temp',
 				debug_ptr = None,
-				callsign = "N0CALL"):
+				callsign = "N0CALL",
+				thumbnail_resolution = None,
+				thumbnail_quality = 4):
 
 		""" Instantiate a WenetGPhoto Object
 			used to capture images using GPhoto.
@@ -59,12 +63,18 @@ class WenetGPhoto(object):
 						This function needs to be able to accept a string.
 						Used to get status messages into the downlink.
 
+			thumbnail_resolution: If set, images are transmitted progressively by auto_capture: a thumbnail at
+						this resolution (x,y, multiples of 16) is sent first, followed by the full resolution image.
+			thumbnail_quality: SSDV quality level of the thumbnails.
+
 		"""
 
 		self.debug_ptr = debug_ptr
 		self.temp_filename_prefix = temp_filename_prefix
 		self.num_images = num_images
 		self.callsign = callsign
+		self.thumbnail_resolution = thumbnail_resolution
+		self.thumbnail_quality = thumbnail_quality
 		self.resolution = resolution
 
 		# Attempt to set camera time.
@@ -142,7 +152,7 @@ class WenetGPhoto(object):
 
 		return True 
 
-	def ssdvify(self, filename="output.jpg", image_id=0, quality=6):
+	def ssdvify(self, filename="output.jpg", image_id=0, quality=6, resolution=None):
 		""" Convert a supplied JPEG image to SSDV.
 
 		Keyword Arguments:
@@ -152,12 +162,16 @@ class WenetGPhoto(object):
 		image_id:	Image ID number. Must be incremented between images.
 		quality:	JPEG quality level: 4 - 7, where 7 is 'lossless' (not recommended).
 					6 provides good quality at decent file-sizes.
+		resolution:	Optional (x,y) transmit resolution. Defaults to resolution.
 
 		"""
 
 		# Wrap image ID field if it's >255.
 		image_id = image_id % 256
 
+		if resolution is None:
+			resolution = self.resolution
+
 		# Resize image to the desired resolution.
 		self.debug_message("Resizing image.")
 		return_code = os.system("convert %s -resize %dx%d\! gphoto_temp.jpg" % (filename, resolution[0], resolution[1]))
@@ -183,8 +197,21 @@ class WenetGPhoto(object):
 		else:
 			return "gphoto_temp.ssdv"
 
+	def convert_image(self, filename, output_filename, image_id=0, quality=6, resolution=None):
+		""" Convert a supplied JPEG image to SSDV, and move the SSDV image to output_filename,
+		as the temporary file will be overwritten by the next image while this one is waiting to be transmitted.
+		Returns output_filename, or None if the conversion failed.
+		"""
+		ssdv_filename = self.ssdvify(filename, image_id=image_id, quality=quality, resolution=resolution)
+
+		if ssdv_filename == "FAIL":
+			return None
+
+		shutil.move(ssdv_filename, output_filename)
+		return output_filename
+
 	auto_capture_running = False
-	def auto_capture(self, destination_directory, tx, post_process_ptr=None, delay = 0, start_id = 0):
+	def auto_capture(self, destination_directory, tx, post_process_ptr=None, delay = 0, start_id = 0, image_store = None):
 		""" Automatically capture and transmit images in a loop.
 		Images are automatically saved to a supplied directory, with file-names
 		defined using a timestamp.
@@ -199,13 +226,14 @@ class WenetGPhoto(object):
 						  This can be used to add overlays, etc to the image before it is SSDVified and transmitted.
 						  NOTE: This function need to modify the image in-place.
 		delay:	An optional delay in seconds between capturing images. Defaults to 0.
-				This delay is added on top of any delays caused while waiting for the transmit queue to empty.
+				Images are captured and converted while the previous image is being transmitted,
+				so this delay only adds to the image interval if it is longer than the transmit time.
 		start_id: Starting image ID. Defaults to 0.
+		image_store: An optional ImageStore object, which each image (JPEG and SSDV) is added to once converted.
+					 The store deletes old images to keep within its size budget.
 		"""
 
-		image_id = start_id
-
-		while self.auto_capture_running:
+		def encode_image(image_id):
 			# Sleep before capturing next image.
 			sleep(delay)
 
@@ -216,10 +244,11 @@ class WenetGPhoto(object):
 			# Attempt to capture.
 			capture_successful = self.capture(capture_filename)
 
-			# If capture was unsuccessful, exit out of this thead, as clearly
+			# If capture was unsuccessful, stop capturing, as clearly
 			# the camera isn't working.
 			if not capture_successful:
-				return
+				self.auto_capture_running = False
+				return None
 
 			# Otherwise, proceed to post-processing step.
 			if post_process_ptr != None:
@@ -229,36 +258,44 @@ class WenetGPhoto(object):
 				except:
 					self.debug_message("Image Post-Processing Failed.")
 
+			# In progressive mode, the thumbnail uses this image ID, and the full resolution image the next.
+			progressive = self.thumbnail_resolution != None
+			full_image_id = (image_id + 1) % 256 if progressive else image_id
+
 			# SSDV'ify the image.
-			ssdv_filename = self.ssdvify(capture_filename, image_id=image_id)
+			image_filename = self.convert_image(capture_filename, capture_filename[:-4] + ".ssdv", image_id=full_image_id)
 
-			# Check the SSDV Conversion has completed properly. If not, break.
-			if ssdv_filename == "FAIL":
-				return
+			# Check the SSDV Conversion has completed properly.
+			if image_filename == None:
+				self.auto_capture_running = False
+				return None
 
+			image_files = [capture_filename, image_filename]
 
-			# Otherwise, read in the file and push into the TX buffer.
-			file_size = os.path.getsize(ssdv_filename)
+			if progressive:
+				thumbnail_filename = self.convert_image(capture_filename, capture_filename[:-4] + "_thumb.ssdv", image_id=image_id,
+					resolution=self.thumbnail_resolution, quality=self.thumbnail_quality)
+				if thumbnail_filename == None:
+					self.auto_capture_running = False
+					return None
 
-			# Wait until the transmit queue is empty before pushing in packets.
-			self.debug_message("Waiting for SSDV TX queue to empty.")
-			while tx.image_queue_empty() == False:
-				sleep(0.05) # Sleep for a short amount of time.
-				if self.auto_capture_running == False:
-					return
+				image_files.append(thumbnail_filename)
 
-			# Inform ground station we are about to send an image.
-			self.debug_message("Transmitting %d GPhoto SSDV Packets." % (file_size/256))
+			if image_store != None:
+				image_store.add(full_image_id, image_files)
 
-			# Push SSDV file into transmit queue.
-			tx.queue_image_file(ssdv_filename)
+			if progressive:
+				return (thumbnail_filename, image_filename)
+			else:
+				return image_filename
 
-			# Increment image ID.
-			image_id = (image_id + 1) % 256
-		# Loop!
+		# Capture and convert the next image while the current image is being transmitted.
+		pipeline = ImagePipeline(tx, encode_ptr=encode_image, running_ptr=lambda: self.auto_capture_running,
+			start_id=start_id, debug_ptr=self.debug_message)
+		pipeline.run()
 
 
-	def run(self, destination_directory, tx, post_process_ptr=None, delay = 0, start_id = 0):
+	def run(self, destination_directory, tx, post_process_ptr=None, delay = 0, start_id = 0, image_store = None):
 		""" Start auto-capturing images in a thread.
 
 		Refer auto_capture function above.
@@ -273,6 +310,7 @@ class WenetGPhoto(object):
 		delay:	An optional delay in seconds between capturing images. Defaults to 0.
 				This delay is added on top of any delays caused while waiting for the transmit queue to empty.
 		start_id: Starting image ID. Defaults to 0.
+		image_store: An optional ImageStore object. Refer auto_capture.
 		"""		
 
 		self.auto_capture_running = True
@@ -282,7 +320,8 @@ class WenetGPhoto(object):
 			tx = tx,
 			post_process_ptr=post_process_ptr,
 			delay=delay,
-			start_id=start_id))
+			start_id=start_id,
+			image_store=image_store))
 
 		capture_thread.start()
 
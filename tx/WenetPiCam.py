@@ -14,6 +14,40 @@ import glob
 import os
 import datetime
 import traceback
+import shutil
+import io
+import numpy as np
+import ssdv_encoder
+import ImageOverlay
+
+try:
+	from PIL import Image
+except ImportError:
+	Image = None
+from ImagePipeline import ImagePipeline
+
+
+def frame_score(jpeg_data, luma_size=(320,240)):
+	""" Score a captured frame on its sharpness and exposure. Higher is better.
+
+	The frame is decoded to a downscaled luma (greyscale) plane, using the JPEG decoder's
+	draft mode, so only a fraction of the image is actually decoded.
+	Sharpness is the variance of the Laplacian of the luma plane, which drops when the image
+	is blurred (i.e. by motion of the payload). This is scaled by the fraction of pixels which
+	are not clipped to black or white, to penalise badly exposed frames.
+
+	Keyword Arguments:
+	jpeg_data: The frame, as a JPEG image in a string.
+	luma_size: Approximate size of the luma plane to score.
+	"""
+	img = Image.open(io.BytesIO(jpeg_data))
+	img.draft('L', luma_size)
+	luma = np.asarray(img.convert('L'), dtype=np.float32)
+
+	laplacian = 4*luma[1:-1,1:-1] - luma[:-2,1:-1] - luma[2:,1:-1] - luma[1:-1,:-2] - luma[1:-1,2:]
+	clipped = np.mean((luma <= 4) | (luma >= 251))
+
+	return float(laplacian.var()) * (1.0 - clipped)
 
 
 class WenetPiCam(object):
@@ -35,6 +69,10 @@ class WenetPiCam(object):
 				vertical_flip = False, 
 				horizontal_flip = False,
 				temp_filename_prefix = 'picam_temp',
+				in_process_ssdv = True,
+				in_memory_burst = True,
+				thumbnail_resolution = None,
+				thumbnail_quality = 4,
 				debug_ptr = None
 				):
 
@@ -58,6 +96,18 @@ class WenetPiCam(object):
 
 			temp_filename_prefix: prefix used for temporary files.
 
+			in_process_ssdv: Resize and SSDV-encode images in-process (refer ssdv_encoder.py), rather than
+						using the convert and ssdv utilities. Ignored if the in-process encoder is not available.
+
+			in_memory_burst: Capture the sequence of images into memory, and select the sharpest,
+						best exposed image (refer frame_score), writing only that image to disk.
+						If False (or PIL is not available), each image is written to a temporary
+						file, and the largest file is selected.
+
+			thumbnail_resolution: If set, images are transmitted progressively by auto_capture: a thumbnail at
+						this resolution (x,y, multiples of 16) is sent first, followed by the full resolution image.
+			thumbnail_quality: SSDV quality level of the thumbnails.
+
 			debug_ptr:	'pointer' to a function which can handle debug messages.
 						This function needs to be able to accept a string.
 						Used to get status messages into the downlink.
@@ -73,6 +123,13 @@ class WenetPiCam(object):
 		self.src_resolution = src_resolution
 		self.horizontal_flip = horizontal_flip
 		self.vertical_flip = vertical_flip
+		self.in_process_ssdv = in_process_ssdv and ssdv_encoder.ssdv_encoder_available()
+		self.in_memory_burst = in_memory_burst and (Image is not None)
+		self.thumbnail_resolution = thumbnail_resolution
+		self.thumbnail_quality = thumbnail_quality
+
+		if in_process_ssdv and not self.in_process_ssdv:
+			self.debug_message("In-process SSDV encoder not available, using convert and ssdv utilities.")
 
 		self.init_camera()
 
@@ -120,6 +177,9 @@ class WenetPiCam(object):
 			filename:	destination filename.
 		"""
 
+		if self.in_memory_burst:
+			return self.capture_burst(filename, quality=quality, bayer=bayer)
+
 		# Attempt to capture a set of images.
 		for i in range(self.num_images):
 			self.debug_message("Capturing Image %d of %d" % (i+1,self.num_images))
@@ -145,13 +205,56 @@ class WenetPiCam(object):
 
 		# Copy best image to target filename.
 		self.debug_message("Copying image to storage with filename %s" % filename)
-		os.system("cp %s %s" % (largest_pic, filename))
+		shutil.copyfile(largest_pic, filename)
 		# Clean up temporary images.
-		os.system("rm %s_*.jpg" % self.temp_filename_prefix)
+		for pic in pic_list:
+			os.remove(pic)
 
 		return True 
 
-	def ssdvify(self, filename="output.jpg", image_id=0, quality=6):
+	def capture_burst(self, filename='picam.jpg', quality=90, bayer=False):
+		""" Capture a sequence of images into memory, and save the best to disk.
+			
+			Keyword Arguments:
+			filename:	destination filename.
+		"""
+
+		frames = []
+		for i in range(self.num_images):
+			self.debug_message("Capturing Image %d of %d" % (i+1,self.num_images))
+			# Wrap this in error handling in case we lose the camera for some reason.
+			try:
+				frame = io.BytesIO()
+				self.cam.capture(frame, format='jpeg', quality=quality, bayer=bayer)
+				frames.append(frame.getvalue())
+				if self.image_delay > 0 and i < self.num_images-1:
+					sleep(self.image_delay)
+			except Exception as e: # TODO: Narrow this down...
+				self.debug_message("ERROR: %s" % str(e))
+				# Immediately return false. Not much point continuing to try and capture images.
+				return False
+
+		# Pick the 'best' image based on its sharpness and exposure.
+		if len(frames) > 1:
+			try:
+				scores = [frame_score(frame) for frame in frames]
+			except:
+				self.debug_message("Frame scoring failed, choosing largest image: %s" % traceback.format_exc())
+				scores = [len(frame) for frame in frames]
+
+			best = scores.index(max(scores))
+			self.debug_message("Choosing Best Image: %d (Scores: %s)" % (best+1, ", ".join(["%.0f" % score for score in scores])))
+		else:
+			best = 0
+
+		self.debug_message("Saving image to storage with filename %s" % filename)
+		f = open(filename, 'wb')
+		f.write(frames[best])
+		f.close()
+
+		return True
+
+	def ssdvify(self, filename="output.jpg", image_id=0, quality=6, resolution=None):
 		""" Convert a supplied JPEG image to SSDV.
 		Returns the filename of the converted SSDV image.
 
@@ -162,15 +265,19 @@ class WenetPiCam(object):
 		image_id:	Image ID number. Must be incremented between images.
 		quality:	JPEG quality level: 4 - 7, where 7 is 'lossless' (not recommended).
 					6 provides good quality at decent file-sizes.
+		resolution:	Optional (x,y) transmit resolution. Defaults to tx_resolution.
 
 		"""
 
 		# Wrap image ID field if it's >255.
 		image_id = image_id % 256
 
+		if resolution is None:
+			resolution = self.tx_resolution
+
 		# Resize image to the desired resolution.
 		self.debug_message("Resizing image.")
-		return_code = os.system("convert %s -resize %dx%d\! picam_temp.jpg" % (filename, self.tx_resolution[0], self.tx_resolution[1]))
+		return_code = os.system("convert %s -resize %dx%d\! picam_temp.jpg" % (filename, resolution[0], resolution[1]))
 		if return_code != 0:
 			self.debug_message("Resize operation failed!")
 			return "FAIL"
@@ -193,8 +300,73 @@ class WenetPiCam(object):
 		else:
 			return "picam_temp.ssdv"
 
+	def ssdvify_packets(self, filename="output.jpg", image_id=0, quality=6, resolution=None, stages=None):
+		""" Convert a supplied JPEG image to SSDV, in-process.
+		Returns a (N, 256) array of SSDV packets, or None if the conversion failed.
+
+		Keyword Arguments:
+		filename:	Source JPEG filename.
+		image_id:	Image ID number. Must be incremented between images.
+		quality:	JPEG quality level: 4 - 7, where 7 is 'lossless' (not recommended).
+		resolution:	Optional (x,y) transmit resolution. Defaults to tx_resolution.
+		stages:		Optional list of post-processing stages (refer ImageOverlay.py), run on the decoded image.
+
+		"""
+
+		if resolution is None:
+			resolution = self.tx_resolution
+
+		self.debug_message("Converting image to SSDV.")
+
+		try:
+			packets = ssdv_encoder.encode_image(filename, resolution, self.callsign, image_id=image_id % 256, quality=quality, stages=stages)
+		except:
+			self.debug_message("ERROR: Could not perform SSDV Conversion: %s" % traceback.format_exc())
+			return None
+
+		if packets is None:
+			self.debug_message("ERROR: Could not perform SSDV Conversion.")
+
+		return packets
+
+	def convert_image(self, filename, output_filename, image_id=0, resolution=None, quality=6, stages=None):
+		""" Convert a supplied JPEG image to SSDV, saving the SSDV image to output_filename.
+		The image is converted in-process if possible, in which case the SSDV packets are returned
+		as an array. Otherwise, the SSDV utility is used, and output_filename is returned.
+		Returns None if the conversion failed.
+
+		Keyword Arguments:
+		filename:	Source JPEG filename.
+		output_filename: Filename to save the SSDV image to.
+		image_id:	Image ID number. Must be incremented between images.
+		quality:	JPEG quality level: 4 - 7, where 7 is 'lossless' (not recommended).
+		resolution:	Optional (x,y) transmit resolution. Defaults to tx_resolution.
+		stages:		Optional list of post-processing stages, run on the decoded image when converting in-process.
+					Ignored otherwise.
+
+		"""
+
+		if self.in_process_ssdv:
+			packets = self.ssdvify_packets(filename, image_id=image_id, resolution=resolution, quality=quality, stages=stages)
+			if packets is None:
+				return None
+
+			packets.tofile(output_filename)
+			return packets
+
+		ssdv_filename = self.ssdvify(filename, image_id=image_id, resolution=resolution, quality=quality)
+
+		# Check the SSDV Conversion has completed properly.
+		if ssdv_filename == "FAIL":
+			return None
+
+		# Move the SSDV file to its output filename, as the temporary file will be overwritten
+		# by the next image while this one is waiting to be transmitted.
+		shutil.move(ssdv_filename, output_filename)
+		return output_filename
+
 	auto_capture_running = False
-	def auto_capture(self, destination_directory, tx, post_process_ptr=None, delay = 0, start_id = 0):
+	def auto_capture(self, destination_directory, tx, post_process_ptr=None, delay = 0, start_id = 0, rate_controller = None, image_store = None, post_process_stages = None):
 		""" Automatically capture and transmit images in a loop.
 		Images are automatically saved to a supplied directory, with file-names
 		defined using a timestamp.
@@ -209,13 +381,21 @@ class WenetPiCam(object):
 						  This can be used to add overlays, etc to the image before it is SSDVified and transmitted.
 						  NOTE: This function need to modify the image in-place.
 		delay:	An optional delay in seconds between capturing images. Defaults to 0.
-				This delay is added on top of any delays caused while waiting for the transmit queue to empty.
+				Images are captured and converted while the previous image is being transmitted,
+				so this delay only adds to the image interval if it is longer than the transmit time.
 		start_id: Starting image ID. Defaults to 0.
+		rate_controller: An optional ImageRateController object, which picks the resolution and SSDV
+						 quality of each image to meet a target image interval. If not provided,
+						 tx_resolution and quality 6 are used.
+		image_store: An optional ImageStore object, which each image (JPEG and SSDV) is added to once converted.
+					 The store deletes old images to keep within its size budget.
+		post_process_stages: An optional list of post-processing stages (refer ImageOverlay.py), i.e. overlays.
+					 When images are SSDV-encoded in-process, these are run on the decoded image before it is resized,
+					 so the saved JPEG is left untouched, and no extra JPEG generation loss is added.
+					 Otherwise they are applied to the saved JPEG, after post_process_ptr.
 		"""
 
-		image_id = start_id
-
-		while self.auto_capture_running:
+		def encode_image(image_id):
 			# Sleep before capturing next image.
 			sleep(delay)
 
@@ -243,7 +423,7 @@ class WenetPiCam(object):
 					self.debug_message("Error initializing camera!")
 					sleep(1)
 
-				continue
+				return None
 
 			# Otherwise, proceed to post-processing step.
 			if post_process_ptr != None:
@@ -254,39 +434,72 @@ class WenetPiCam(object):
 					error_str = traceback.format_exc()
 					self.debug_message("Image Post-Processing Failed: %s" % error_str)
 
-			# SSDV'ify the image.
-			ssdv_filename = self.ssdvify(capture_filename, image_id=image_id)
-
-			# Check the SSDV Conversion has completed properly. If not, continue
-			if ssdv_filename == "FAIL":
+			# Without the in-process encoder, the post-processing stages can only be applied to the JPEG itself.
+			stages = post_process_stages
+			if stages and not self.in_process_ssdv:
+				try:
+					self.debug_message("Running Image Post-Processing Stages")
+					ImageOverlay.apply_stages_to_file(capture_filename, stages)
+				except:
+					error_str = traceback.format_exc()
+					self.debug_message("Image Post-Processing Failed: %s" % error_str)
+				stages = None
+
+			# SSDV'ify the image, at a resolution and quality chosen by the rate controller if we have one.
+			if rate_controller != None:
+				image_setting = rate_controller.choose(tx)
+				resolution = image_setting[0]
+				quality = image_setting[1]
+			else:
+				resolution = self.tx_resolution
+				quality = 6
+
+			# In progressive mode, the thumbnail uses this image ID, and the full resolution image the next.
+			progressive = self.thumbnail_resolution != None
+			full_image_id = (image_id + 1) % 256 if progressive else image_id
+
+			image_filename = capture_filename[:-4] + ".ssdv"
+			image = self.convert_image(capture_filename, image_filename, image_id=full_image_id, resolution=resolution, quality=quality, stages=stages)
+			if image is None:
 				sleep(1)
-				continue
+				return None
 
+			image_files = [capture_filename, image_filename]
+
+			if progressive:
+				thumbnail_filename = capture_filename[:-4] + "_thumb.ssdv"
+				thumbnail = self.convert_image(capture_filename, thumbnail_filename, image_id=image_id, resolution=self.thumbnail_resolution, quality=self.thumbnail_quality, stages=stages)
+				if thumbnail is None:
+					sleep(1)
+					return None
 
-			# Otherwise, read in the file and push into the TX buffer.
-			file_size = os.path.getsize(ssdv_filename)
+				image_files.append(thumbnail_filename)
 
-			# Wait until the transmit queue is empty before pushing in packets.
-			self.debug_message("Waiting for SSDV TX queue to empty.")
-			while tx.image_queue_empty() == False:
-				sleep(0.05) # Sleep for a short amount of time.
-				if self.auto_capture_running == False:
-					return
+			# The thumbnail and any erasure coding repair packets are sent in the same airtime budget as the full resolution image.
+			if rate_controller != None:
+				image_packets = len(image) if not isinstance(image, str) else os.path.getsize(image)/256
+				thumbnail_packets = 0
+				if progressive:
+					thumbnail_packets = len(thumbnail) if not isinstance(thumbnail, str) else os.path.getsize(thumbnail)/256
+				rate_controller.update(image_setting, image_packets, thumbnail_packets, tx.ssdv_repair_ratio())
 
-			# Inform ground station we are about to send an image.
-			self.debug_message("Transmitting %d PiCam SSDV Packets." % (file_size/256))
+			if image_store != None:
+				image_store.add(full_image_id, image_files)
 
-			# Push SSDV file into transmit queue.
-			tx.queue_image_file(ssdv_filename)
+			if progressive:
+				return (thumbnail, image)
+			else:
+				return image
 
-			# Increment image ID.
-			image_id = (image_id + 1) % 256
-		# Loop!
+		# Capture and convert the next image while the current image is being transmitted.
+		pipeline = ImagePipeline(tx, encode_ptr=encode_image, running_ptr=lambda: self.auto_capture_running,
+			start_id=start_id, debug_ptr=self.debug_message)
+		pipeline.run()
 
 		self.debug_message("Uh oh, we broke out of the main thread. This is not good!")
 
 
-	def run(self, destination_directory, tx, post_process_ptr=None, delay = 0, start_id = 0):
+	def run(self, destination_directory, tx, post_process_ptr=None, delay = 0, start_id = 0, rate_controller = None, image_store = None, post_process_stages = None):
 		""" Start auto-capturing images in a thread.
 
 		Refer auto_capture function above.
@@ -301,6 +514,9 @@ class WenetPiCam(object):
 		delay:	An optional delay in seconds between capturing images. Defaults to 0.
 				This delay is added on top of any delays caused while waiting for the transmit queue to empty.
 		start_id: Starting image ID. Defaults to 0.
+		rate_controller: An optional ImageRateController object. Refer auto_capture.
+		image_store: An optional ImageStore object. Refer auto_capture.
+		post_process_stages: An optional list of post-processing stages. Refer auto_capture.
 		"""		
 
 		self.auto_capture_running = True
@@ -310,7 +526,10 @@ class WenetPiCam(object):
 			tx = tx,
 			post_process_ptr=post_process_ptr,
 			delay=delay,
-			start_id=start_id))
+			start_id=start_id,
+			rate_controller=rate_controller,
+			image_store=image_store,
+			post_process_stages=post_process_stages))
 
 		capture_thread.start()
 
@@ -14,7 +14,7 @@
 import socket, struct, time, json, random
 
 
-def emit_secondary_packet(id=0, packet="", repeats = 1, hostname='<broadcast>', port=55674):
+def emit_secondary_packet(id=0, packet="", repeats = 1, hostname='<broadcast>', port=55674, binary=False):
     """ Send a Secondary Payload data packet into the network, to (hopefully) be
         transmitted by a Wenet transmitter.
 
@@ -24,6 +24,8 @@ def emit_secondary_packet(id=0, packet="", repeats = 1, hostname='<broadcast>',
         repeats (int): Number of times to re-transmit this packet. Defaults to 1.
         hostname (str): Hostname of the Wenet transmitter. Defaults to using UDP broadcast.
         port (int): UDP port of the Wenet transmitter. Defaults to 55674.
+        binary (bool): Send the packet using the compact binary format, instead of JSON.
+                       This uses much less CPU on the transmitter when sending many packets per second.
 
     """
 
@@ -39,14 +41,18 @@ def emit_secondary_packet(id=0, packet="", repeats = 1, hostname='<broadcast>',
     except:
         pass
 
-    # Place data into dictionary.
-    data = {'type': 'WENET_TX_SEC_PAYLOAD', 'id': int(id), 'repeats': int(repeats), 'packet': list(bytearray(packet))}
+    if binary:
+        # Binary format: 'WB' magic, message type (0x03 = secondary payload), ID, repeats, then the raw packet.
+        data = "WB" + struct.pack(">BBB", 0x03, int(id), int(repeats)) + str(bytearray(packet))
+    else:
+        # Place data into dictionary.
+        data = json.dumps({'type': 'WENET_TX_SEC_PAYLOAD', 'id': int(id), 'repeats': int(repeats), 'packet': list(bytearray(packet))})
 
     # Send to target hostname. If this fails just send to localhost.
     try:
-        telemetry_socket.sendto(json.dumps(data), (hostname, port))
+        telemetry_socket.sendto(data, (hostname, port))
     except socket.error:
-        telemetry_socket.sendto(json.dumps(data), ('127.0.0.1', port))
+        telemetry_socket.sendto(data, ('127.0.0.1', port))
 
     telemetry_socket.close()
 
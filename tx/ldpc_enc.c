@@ -47,6 +47,40 @@ void encode(unsigned char *ibits, unsigned char *pbits)   {
   }
 }
 
+/*
+  Batch encoder.
+  Accepts n packed codewords of Nibytes each (MSB first, as produced by numpy.packbits),
+  and writes out n packed parity blocks of Npbytes each. The last 4 bits of each
+  parity block are zero-padded, matching np.packbits on the output of encode().
+  This lets an entire SSDV image be encoded with a single call from Python.
+*/
+
+#define Nibytes (Nibits/8)
+#define Npbytes ((Npbits+7)/8)
+
+void encode_batch(unsigned char *ibytes, unsigned char *pbytes, int n)   {
+  unsigned char ibits[Nibits];
+  unsigned char pbits[Npbits];
+  unsigned char *in, *out;
+  int k, i;
+
+  for (k=0; k<n; k++)   {
+    in = ibytes + k*Nibytes;
+    out = pbytes + k*Npbytes;
+
+    // Unpack the codeword into one bit per char.
+    for (i=0; i<Nibits; i++)
+      ibits[i] = (in[i>>3] >> (7 - (i&7))) & 1;
+
+    encode(ibits, pbits);
+
+    // Pack the parity bits back into bytes.
+    memset(out, 0, Npbytes);
+    for (i=0; i<Npbits; i++)
+      out[i>>3] |= pbits[i] << (7 - (i&7));
+  }
+}
+
 
 /*
 
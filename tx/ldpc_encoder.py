@@ -3,8 +3,10 @@
 #   LDPC Encoder and interleaver Functions.
 #   Uses ctypes to call the encode function from ldpc_enc.c
 #
-#   ldpc_enc.c needs to be compiled to a .so before this will work, with:
+#   ldpc_enc.c should be compiled to a .so with:
 #   gcc -fPIC -shared -o ldpc_enc.so ldpc_enc.c
+#   If it is not available (or is too old to have encode_batch), a (slower) vectorized NumPy encoder is used instead.
+#   The interleaver functions still require ldpc_enc.so.
 #
 #   Copyright (C) 2018  Mark Jessop <vk5qi@rfhead.net>
 #   Released under GNU GPL v3 or later
@@ -13,25 +15,89 @@
 import ctypes
 from numpy.ctypeslib import ndpointer
 import numpy as np
+import os
 import time
 import sys
 
 
+# Directory containing this file, which is where ldpc_enc.so and Hrow2064.txt are expected to live.
+_module_dir = os.path.dirname(os.path.abspath(__file__))
+
 # Attempt to load in ldpc_enc.so on startup.
-try:
-    _ldpc_enc = ctypes.CDLL("./ldpc_enc.so")
+# We look alongside this file first, then in the current directory.
+_ldpc_enc = None
+for _lib_path in [os.path.join(_module_dir, "ldpc_enc.so"), "./ldpc_enc.so"]:
+    try:
+        _ldpc_enc = ctypes.CDLL(_lib_path)
+        break
+    except OSError as e:
+        continue
+
+if _ldpc_enc is not None:
     _ldpc_enc.encode.restype = None
     _ldpc_enc.encode.argtypes = (ndpointer(ctypes.c_ubyte, flags="C_CONTIGUOUS"), ndpointer(ctypes.c_ubyte, flags="C_CONTIGUOUS"))
 
+    # ldpc_enc.so builds from before the batch encoder was added do not have encode_batch.
+    if hasattr(_ldpc_enc, 'encode_batch'):
+        _ldpc_enc.encode_batch.restype = None
+        _ldpc_enc.encode_batch.argtypes = (ndpointer(ctypes.c_ubyte, flags="C_CONTIGUOUS"), ndpointer(ctypes.c_ubyte, flags="C_CONTIGUOUS"), ctypes.c_int)
+    else:
+        print("WARNING: ldpc_enc.so is out of date (no encode_batch). Falling back to the NumPy LDPC encoder. To re-compile ldpc_enc.c: \n gcc -fPIC -shared -o ldpc_enc.so ldpc_enc.c")
+
     _ldpc_enc.init_interleaver.restype = None
     _ldpc_enc.init_interleaver.argtypes = (ctypes.c_int,)
 
     _ldpc_enc.interleave_symbols.restype = None
     _ldpc_enc.interleave_symbols.argtypes = (ndpointer(ctypes.c_ubyte, flags="C_CONTIGUOUS"),)
+else:
+    print("WARNING: Could not find ldpc_enc.so! Falling back to the (slower) NumPy LDPC encoder. To compile ldpc_enc.c: \n gcc -fPIC -shared -o ldpc_enc.so ldpc_enc.c")
+
+
+#
+#   Encoder backend selection.
+#   'c' uses ldpc_enc.so via ctypes, 'numpy' uses the vectorized encoder below.
+#   The C encoder is only selected by default if ldpc_enc.so has the batch encoder, as the
+#   NumPy encoder is faster than encoding one packet at a time.
+#
+
+LDPC_BACKENDS = ['c', 'numpy']
+_ldpc_enc_batch = (_ldpc_enc is not None) and hasattr(_ldpc_enc, 'encode_batch')
+ldpc_backend = 'c' if _ldpc_enc_batch else 'numpy'
+
+def ldpc_set_backend(backend):
+    """ Select the LDPC encoder implementation, either 'c' or 'numpy'. """
+    global ldpc_backend
+
+    if backend not in LDPC_BACKENDS:
+        raise ValueError("Unknown LDPC backend '%s'. Must be one of %s" % (backend, str(LDPC_BACKENDS)))
+
+    if backend == 'c' and _ldpc_enc is None:
+        raise IOError("ldpc_enc.so is not available, cannot use the C LDPC encoder.")
+
+    if backend == 'c' and not _ldpc_enc_batch:
+        raise IOError("ldpc_enc.so is out of date (no encode_batch), cannot use the C LDPC encoder.")
+
+    ldpc_backend = backend
+
+
+def ldpc_get_backend():
+    return ldpc_backend
+
+
+def ldpc_backend_implementation(backend=None):
+    """ Describe the encoder which ldpc_encode_batch actually uses for a backend (by default, the selected backend).
+    Returns 'numpy', 'c' (the C batch encoder), or 'c-per-packet' (an ldpc_enc.so without encode_batch).
+    """
+    if backend is None:
+        backend = ldpc_backend
+
+    if backend == 'numpy':
+        return 'numpy'
+    elif _ldpc_enc_batch:
+        return 'c'
+    else:
+        return 'c-per-packet'
 
-except OSError as e:
-    print("WARNING: Could not find ldpc_enc.so! Have you compiled ldpc_enc.c? \n gcc -fPIC -shared -o ldpc_enc.so ldpc_enc.c")
-    sys.exit(1)
 
 #
 #   LDPC Encoder.
@@ -42,6 +108,9 @@ def ldpc_encode_string(payload, Nibits = 2064, Npbits = 516):
     if len(payload) != 258:
         raise TypeError("Payload MUST be 258 bytes in length! (2064 bit codeword)")
 
+    if ldpc_backend == 'numpy':
+        return ldpc_encode_batch(payload)[0].tostring()
+
     # Get input data into the right form (list of 0s and 1s)
     ibits = np.unpackbits(np.fromstring(payload,dtype=np.uint8)).astype(np.uint8)
     pbits = np.zeros(Npbits).astype(np.uint8)
@@ -51,6 +120,109 @@ def ldpc_encode_string(payload, Nibits = 2064, Npbits = 516):
     return np.packbits(np.array(list(pbits)).astype(np.uint8)).tostring()
 
 
+#
+#   Vectorized NumPy LDPC Encoder.
+#   Implements the same 'RA' encoder as encode() in ldpc_enc.c, using the
+#   parity check table in Hrow2064.txt. Each parity bit is the XOR of 12 information bits,
+#   accumulated with the previous parity bit.
+#
+
+LDPC_NWT = 12
+
+def _load_hrows(filename=os.path.join(_module_dir, "Hrow2064.txt")):
+    """ Read in the Hrow2064.txt table, and return it as a (516, 12) array of zero-based bit indexes. """
+    f = open(filename, 'r')
+    hrows = [int(x) for x in f.read().replace('\n', ' ').split(',') if x.strip() != '']
+    f.close()
+    # -1 as matlab arrays start from 1.
+    return (np.array(hrows, dtype=np.int32) - 1).reshape((-1, LDPC_NWT))
+
+_hrows = _load_hrows()
+
+# Number of packets to encode at a time, to bound the size of the intermediate arrays.
+NUMPY_ENCODE_CHUNK = 256
+
+def _ldpc_encode_numpy(data, out):
+    """ Encode a (N, 258) uint8 array of codewords into a (N, 65) uint8 array of packed parity bits. """
+    for start in range(0, data.shape[0], NUMPY_ENCODE_CHUNK):
+        chunk = data[start:start+NUMPY_ENCODE_CHUNK]
+        ibits = np.unpackbits(chunk, axis=1)
+        # Gather the 12 information bits for each parity row, and XOR them together.
+        par = np.bitwise_xor.reduce(ibits[:, _hrows], axis=2)
+        # Run the accumulator over the parity rows.
+        pbits = np.bitwise_xor.accumulate(par, axis=1)
+        out[start:start+NUMPY_ENCODE_CHUNK] = np.packbits(pbits, axis=1)
+
+
+#
+#   Batch LDPC Encoder.
+#   Encodes many 258 byte codewords with a single call into ldpc_enc.so, or the NumPy encoder.
+#
+
+LDPC_CODEWORD_BYTES = 258
+LDPC_PARITY_BYTES = 65
+LDPC_PARITY_BITS = 516
+
+def ldpc_encode_batch(payloads, out=None, backend=None):
+    """ LDPC encode a batch of codewords.
+
+    Keyword Arguments:
+    payloads: Either a (N, 258) uint8 numpy array, or a string of N*258 bytes, containing
+              the packets (with their CRCs appended) to be encoded.
+    out: An optional C-contiguous (N, 65) uint8 numpy array to write the parity bytes into.
+    backend: Optionally override the encoder backend ('c' or 'numpy') for this call.
+
+    Returns a (N, 65) uint8 numpy array of packed parity bits, identical to what
+    ldpc_encode_string would produce for each codeword.
+    """
+    if isinstance(payloads, np.ndarray):
+        data = np.ascontiguousarray(payloads, dtype=np.uint8)
+    else:
+        data = np.frombuffer(payloads, dtype=np.uint8)
+
+    if data.size % LDPC_CODEWORD_BYTES != 0:
+        raise TypeError("Payloads MUST be a multiple of 258 bytes in length! (2064 bit codewords)")
+
+    data = data.reshape((-1, LDPC_CODEWORD_BYTES))
+    num_packets = data.shape[0]
+
+    if out is None:
+        out = np.zeros((num_packets, LDPC_PARITY_BYTES), dtype=np.uint8)
+    elif out.shape != (num_packets, LDPC_PARITY_BYTES):
+        raise TypeError("Output array must have shape (%d, %d)" % (num_packets, LDPC_PARITY_BYTES))
+
+    if backend is None:
+        backend = ldpc_backend
+
+    if backend == 'numpy':
+        _ldpc_encode_numpy(data, out)
+    elif _ldpc_enc_batch:
+        _ldpc_enc.encode_batch(data, out, num_packets)
+    else:
+        # Older ldpc_enc.so - encode each packet separately.
+        pbits = np.zeros(LDPC_PARITY_BITS, dtype=np.uint8)
+        for x in range(num_packets):
+            _ldpc_enc.encode(np.unpackbits(data[x]), pbits)
+            out[x] = np.packbits(pbits)
+
+    return out
+
+
+def ldpc_compare_backends(num_packets=100):
+    """ Encode a set of random packets with both the C and NumPy encoders, and check they match.
+    Returns a tuple of (True if the outputs are identical, the C encoder used - refer ldpc_backend_implementation).
+    """
+    if _ldpc_enc is None:
+        raise IOError("ldpc_enc.so is not available, cannot compare against the C LDPC encoder.")
+
+    packets = np.random.randint(0, 256, size=(num_packets, LDPC_CODEWORD_BYTES)).astype(np.uint8)
+
+    c_parity = ldpc_encode_batch(packets, backend='c')
+    numpy_parity = ldpc_encode_batch(packets, backend='numpy')
+
+    return (np.array_equal(c_parity, numpy_parity), ldpc_backend_implementation('c'))
+
+
 #
 #   Interleaver functions
 #
@@ -64,7 +236,12 @@ INTERLEAVER_DEPTH = 10
 
 interleaver_byte_buffer = ""
 
+def _check_interleaver():
+    if _ldpc_enc is None:
+        raise IOError("The interleaver requires ldpc_enc.so, which could not be loaded.")
+
 def interleaver_init(forward=True):
+    _check_interleaver()
     if forward:
         _ldpc_enc.init_interleaver(0)
     else:
@@ -76,6 +253,8 @@ def interleave_symbols(symbols):
     if len(symbols)%INTERLEAVER_SIZE != 0:
         raise IOError("Input not a multiple of the interleaver width!")
 
+    _check_interleaver()
+
     data = np.array(symbols).astype(np.uint8)
 
     _ldpc_enc.interleave_symbols(data)
@@ -127,12 +306,45 @@ def main():
     start = time.time()
     for x in xrange(1000):
         #print(x)
-        parity = ldpc_encode(payload)
+        parity = ldpc_encode_string(payload)
 
     stop = time.time()
     print("time delta: %.3f" % (stop-start))
 
     print("LDPC Parity Bits (hex): %s" % ("".join("{:02x}".format(ord(c)) for c in parity)))
+
+    # Compare the per-packet path against the batch encoder, using a set of
+    # random packets roughly the size of a large SSDV image.
+    num_packets = 600
+    packets = np.random.randint(0, 256, size=(num_packets, LDPC_CODEWORD_BYTES)).astype(np.uint8)
+    packet_strings = [packets[x].tostring() for x in xrange(num_packets)]
+
+    start = time.time()
+    single_parity = [ldpc_encode_string(p) for p in packet_strings]
+    single_time = time.time() - start
+
+    start = time.time()
+    batch_parity = ldpc_encode_batch(packets)
+    batch_time = time.time() - start
+
+    if "".join(single_parity) != batch_parity.tostring():
+        print("ERROR: Batch encoder output does not match per-packet encoder!")
+
+    print("%d packets - Per-packet: %.3f s, Batch (%s): %.3f s (%.1fx speedup)" % (
+        num_packets, single_time, ldpc_backend_implementation(), batch_time, single_time/max(batch_time, 1e-6)))
+
+    # Check the NumPy encoder against the C encoder, and time it.
+    if _ldpc_enc is not None:
+        (_match, _implementation) = ldpc_compare_backends(1000)
+        if _match:
+            print("NumPy encoder matches C encoder (%s)." % _implementation)
+        else:
+            print("ERROR: NumPy encoder output does not match C encoder (%s)!" % _implementation)
+
+    start = time.time()
+    ldpc_encode_batch(packets, backend='numpy')
+    print("%d packets - NumPy batch: %.3f s" % (num_packets, time.time() - start))
+
     print("Done!")
 
 # Some basic test code.
@@ -22,6 +22,7 @@ import time
 import traceback
 import datetime
 import os
+import shutil
 from BNO055 import WenetBNO055
 from threading import Thread
 
@@ -163,11 +164,19 @@ try:
 			str(picam_capture_success)))
 
 		# If we have images, convert to SSDV.
+		# The SSDV images are moved out of the temporary files (which are overwritten by the next conversion),
+		# so they can be streamed from disk.
 		if picam_capture_success:
 			picam_ssdv_filename = picam.ssdvify(nir_capture_filename, image_id = image_id)
+			if picam_ssdv_filename != "FAIL":
+				shutil.move(picam_ssdv_filename, nir_capture_filename[:-4] + ".ssdv")
+				picam_ssdv_filename = nir_capture_filename[:-4] + ".ssdv"
 
 		if webcam_capture_success:
 			webcam_ssdv_filename = webcam.ssdvify(vis_capture_filename, image_id = image_id)
+			if webcam_ssdv_filename != "FAIL":
+				shutil.move(webcam_ssdv_filename, vis_capture_filename[:-4] + ".ssdv")
+				webcam_ssdv_filename = vis_capture_filename[:-4] + ".ssdv"
 
 		# Wait until the transmit queue is empty before pushing in packets.
 		tx.transmit_text_message("Waiting for SSDV TX queue to empty.")
@@ -180,7 +189,7 @@ try:
 
 			tx.transmit_text_message("Transmitting %d NIR SSDV Packets." % file_size)
 
-			tx.queue_image_file(picam_ssdv_filename)
+			tx.queue_image_file(picam_ssdv_filename, stream=True)
 
 		# Wait until the transmit queue is empty before pushing in packets.
 		tx.transmit_text_message("Waiting for SSDV TX queue to empty.")
@@ -193,7 +202,7 @@ try:
 
 			tx.transmit_text_message("Transmitting %d Visible SSDV Packets." % file_size)
 
-			tx.queue_image_file(webcam_ssdv_filename)
+			tx.queue_image_file(webcam_ssdv_filename, stream=True)
 
 		# Transmit Image telemetry packet
 		tx.transmit_image_telemetry(gps_data, orientation_data, image_id, callsign=global_callsign)
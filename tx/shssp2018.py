@@ -16,12 +16,14 @@
 import PacketTX
 import WenetPiCam
 import ublox
+import ImageStore
 import json
 import argparse
 import time
 import traceback
 import datetime
 import os
+import shutil
 from BNO055 import WenetBNO055
 from threading import Thread
 
@@ -123,6 +125,12 @@ picam = WenetPiCam.WenetPiCam(callsign=global_callsign,
 	vertical_flip=True, 
 	horizontal_flip=True)
 
+# Index the captured images, keeping every 10th image when the storage budget is reached.
+image_store = ImageStore.ImageStore(image_dir,
+	max_bytes = 8e9,
+	policy = ImageStore.KeepEveryNthEviction(10),
+	debug_ptr = tx.transmit_text_message)
+
 # SSDV Image ID.
 image_id = 0
 
@@ -164,6 +172,12 @@ try:
 		if picam_capture_success:
 			picam_ssdv_filename = picam.ssdvify(vis_capture_filename, image_id = image_id)
 
+			# Move the SSDV image out of the temporary file (which is overwritten by the next conversion),
+			# so it can be streamed from disk while the next image is captured.
+			if picam_ssdv_filename != "FAIL":
+				shutil.move(picam_ssdv_filename, vis_capture_filename[:-4] + ".ssdv")
+				picam_ssdv_filename = vis_capture_filename[:-4] + ".ssdv"
+
 		if picam_ssdv_filename == "FAIL":
 			tx.transmit_text_message("Error capturing image, continuing.")
 			continue
@@ -179,7 +193,7 @@ try:
 
 			tx.transmit_text_message("Transmitting %d SSDV Packets." % file_size)
 
-			tx.queue_image_file(picam_ssdv_filename)
+			tx.queue_image_file(picam_ssdv_filename, stream=True)
 
 		# Transmit Image telemetry packet
 		tx.transmit_image_telemetry(gps_data, orientation_data, image_id, callsign=global_callsign)
@@ -191,6 +205,9 @@ try:
 		f.write(json.dumps(metadata))
 		f.close()
 
+		if picam_capture_success:
+			image_store.add(image_id, [vis_capture_filename, picam_ssdv_filename, metadata_filename], gps_data=gps_data)
+
 		# Increment image ID and loop!
 		image_id = (image_id + 1) % 256
 
@@ -203,6 +220,7 @@ except KeyboardInterrupt:
 	gps.close()
 	picam.stop()
 	tx.close()
+	image_store.close()
 
 
 
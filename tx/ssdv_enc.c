@@ -0,0 +1,70 @@
+/*
+
+SSDV Encoder shim, allowing a JPEG image held in memory to be converted to SSDV
+packets via ctypes, without running the ssdv command-line utility.
+
+Uses the SSDV library by Philip Heron: https://github.com/fsphil/ssdv
+Compile with (where SSDV is the directory containing the ssdv source):
+gcc -O2 -fPIC -shared -I$SSDV -o ssdv_enc.so ssdv_enc.c $SSDV/ssdv.c $SSDV/rs8.c
+
+Older versions of the SSDV library (without a variable packet length) need -DSSDV_FIXED_PKT_SIZE
+
+*/
+
+#include<stdio.h>
+#include<string.h>
+#include<stdint.h>
+#include "ssdv.h"
+
+#define FEED_LENGTH 128
+
+/*
+  Encode a JPEG image into SSDV packets.
+
+  jpeg, jpeg_length: The JPEG image.
+  callsign: Callsign to encode into the packets. Max 6 characters.
+  image_id: SSDV image ID.
+  quality: SSDV quality level (0-7).
+  fec: Non-zero to generate packets with SSDV's own FEC (the 'normal' packet type), zero for
+       the 'no-FEC' packet type used by Wenet.
+  pkt_length: Length of each packet (256).
+  output: Buffer to write packets into, of at least max_packets*pkt_length bytes.
+  max_packets: Size of the output buffer, in packets.
+
+  Returns the number of packets written, -1 if the image could not be encoded, or -2 if
+  the output buffer was too small.
+*/
+int ssdv_encode(uint8_t *jpeg, int jpeg_length, char *callsign, int image_id, int quality, int fec, int pkt_length, uint8_t *output, int max_packets)   {
+  ssdv_t ssdv;
+  uint8_t pkt[SSDV_PKT_SIZE];
+  int offset = 0, packets = 0, feed;
+  char c;
+
+#ifdef SSDV_FIXED_PKT_SIZE
+  if (pkt_length != SSDV_PKT_SIZE) return -1;
+  ssdv_enc_init(&ssdv, fec ? SSDV_TYPE_NORMAL : SSDV_TYPE_NOFEC, callsign, (uint8_t)image_id, (int8_t)quality);
+#else
+  if (pkt_length > SSDV_PKT_SIZE) return -1;
+  ssdv_enc_init(&ssdv, fec ? SSDV_TYPE_NORMAL : SSDV_TYPE_NOFEC, callsign, (uint8_t)image_id, (int8_t)quality, pkt_length);
+#endif
+  ssdv_enc_set_buffer(&ssdv, pkt);
+
+  while (1)   {
+    while ((c = ssdv_enc_get_packet(&ssdv)) == SSDV_FEED_ME)   {
+      if (offset >= jpeg_length) return -1; // Premature end of image.
+      feed = jpeg_length - offset;
+      if (feed > FEED_LENGTH) feed = FEED_LENGTH;
+      ssdv_enc_feed(&ssdv, jpeg + offset, feed);
+      offset += feed;
+    }
+
+    if (c == SSDV_EOI) break;
+    if (c != SSDV_OK) return -1;
+
+    if (packets >= max_packets) return -2;
+    memcpy(output + packets*pkt_length, pkt, pkt_length);
+    packets++;
+  }
+
+  return packets;
+}
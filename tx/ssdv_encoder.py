@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+#
+#   In-process image resizing and SSDV encoding.
+#
+#   Images are resized with PIL, and converted to SSDV packets by calling the SSDV library
+#   via ctypes (refer ssdv_enc.c), all on in-memory buffers. This avoids forking the
+#   'convert' and 'ssdv' utilities for every image, and the fixed temporary filenames they use.
+#
+#   ssdv_enc.c should be compiled to a .so as described at the top of that file.
+#   If ssdv_enc.so or PIL is not available, ssdv_encoder_available() returns False, and
+#   the camera classes fall back to the command-line utilities.
+#
+#   Copyright (C) 2018  Mark Jessop <vk5qi@rfhead.net>
+#   Released under GNU GPL v3 or later
+#
+
+import ctypes
+import io
+import os
+import resource
+import shutil
+import tempfile
+import time
+import numpy as np
+from distutils.spawn import find_executable
+from numpy.ctypeslib import ndpointer
+import ImageOverlay
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+# Directory containing this file, which is where ssdv_enc.so is expected to live.
+_module_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Attempt to load in ssdv_enc.so on startup.
+# We look alongside this file first, then in the current directory.
+_ssdv_enc = None
+for _lib_path in [os.path.join(_module_dir, "ssdv_enc.so"), "./ssdv_enc.so"]:
+    try:
+        _ssdv_enc = ctypes.CDLL(_lib_path)
+        break
+    except OSError as e:
+        continue
+
+if _ssdv_enc is not None:
+    _ssdv_enc.ssdv_encode.restype = ctypes.c_int
+    _ssdv_enc.ssdv_encode.argtypes = (ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_int,
+        ctypes.c_int, ctypes.c_int, ndpointer(ctypes.c_ubyte, flags="C_CONTIGUOUS"), ctypes.c_int)
+
+
+def ssdv_encoder_available():
+    """ Returns True if images can be resized and SSDV-encoded in-process. """
+    return (_ssdv_enc is not None) and (Image is not None)
+
+
+def resize_image(source, resolution, jpeg_quality=92, stages=None):
+    """ Resize an image, returning it as a baseline JPEG (suitable for SSDV encoding), in a string.
+
+    Keyword Arguments:
+    source: Filename or file-like object (i.e. an io.BytesIO) containing the source image.
+    resolution: Tuple (x,y) of the output resolution. Both x and y must be multiples of 16 for SSDV.
+                The image is resized with NO REGARD FOR ASPECT RATIO.
+    jpeg_quality: Quality of the intermediate JPEG. SSDV re-quantises the image, so this
+                  only needs to be high enough not to add visible artefacts.
+    stages: Optional list of post-processing stages (refer ImageOverlay.py), which are run
+            on the decoded image before it is resized.
+    """
+    _img = Image.open(source)
+
+    # Let the JPEG decoder do as much of the down-scaling as it can (in 1/2, 1/4 or 1/8 steps),
+    # which is much faster and uses much less memory than decoding the full image.
+    _img.draft('RGB', resolution)
+    if _img.mode != 'RGB':
+        _img = _img.convert('RGB')
+
+    if stages:
+        _img = ImageOverlay.apply_stages(_img, stages)
+
+    _img = _img.resize(resolution, getattr(Image, 'LANCZOS', Image.ANTIALIAS))
+
+    _output = io.BytesIO()
+    # SSDV requires baseline JPEGs, with 2x2 (4:2:0) chroma subsampling.
+    _img.save(_output, format='JPEG', quality=jpeg_quality, subsampling=2, progressive=False, optimize=False)
+    return _output.getvalue()
+
+
+def ssdv_encode(jpeg_data, callsign, image_id=0, quality=6, packet_length=256, fec=False):
+    """ Convert a JPEG image (in a string) to SSDV packets.
+    Returns a (N, packet_length) uint8 array of packets, or None if the image could not be encoded.
+
+    Keyword Arguments:
+    jpeg_data: The JPEG image. Must be a baseline JPEG, with dimensions that are multiples of 16.
+    callsign: Payload callsign. Max 6 Alphanumeric characters.
+    image_id: Image ID number. Must be incremented between images.
+    quality: SSDV quality level: 4 - 7, where 7 is 'lossless' (not recommended).
+    packet_length: SSDV packet length.
+    fec: Use SSDV's own Reed-Solomon FEC. Wenet uses the 'no-FEC' packet type, as the
+         whole frame is protected by the LDPC code.
+    """
+    if _ssdv_enc is None:
+        raise IOError("ssdv_enc.so is not available, cannot encode SSDV in-process.")
+
+    if not isinstance(callsign, bytes):
+        callsign = callsign.encode('ascii')
+
+    # The SSDV image is usually smaller than the JPEG, but may not be at high quality levels.
+    # Grow the output buffer if it turns out to be too small.
+    _max_packets = max(64, 2*len(jpeg_data)//packet_length)
+    while True:
+        _output = np.zeros(_max_packets*packet_length, dtype=np.uint8)
+        _packets = _ssdv_enc.ssdv_encode(jpeg_data, len(jpeg_data), callsign, image_id % 256, quality,
+            1 if fec else 0, packet_length, _output, _max_packets)
+
+        if _packets == -2:
+            _max_packets *= 2
+            continue
+        elif _packets <= 0:
+            return None
+        else:
+            return _output[:_packets*packet_length].reshape((-1, packet_length))
+
+
+def encode_image(source, resolution, callsign, image_id=0, quality=6, stages=None):
+    """ Resize an image and convert it to SSDV packets, in-process.
+    Returns a (N, 256) uint8 array of packets, or None if the image could not be encoded.
+
+    Keyword Arguments:
+    source: Filename or file-like object containing the source image.
+    resolution: Tuple (x,y) of the transmit resolution.
+    callsign: Payload callsign.
+    image_id: Image ID number.
+    quality: SSDV quality level: 4 - 7.
+    stages: Optional list of post-processing stages, run before the image is resized.
+    """
+    return ssdv_encode(resize_image(source, resolution, stages=stages), callsign, image_id=image_id, quality=quality)
+
+
+def _shell_encode_image(filename, resolution, callsign, image_id=0, quality=6, temp_dir='.'):
+    """ Resize an image and convert it to SSDV packets, using the command-line utilities
+    (as the camera classes do when the in-process encoder is not available).
+    """
+    _temp_jpeg = os.path.join(temp_dir, "ssdv_temp.jpg")
+    _temp_ssdv = os.path.join(temp_dir, "ssdv_temp.ssdv")
+
+    if os.system("convert %s -resize %dx%d\! %s" % (filename, resolution[0], resolution[1], _temp_jpeg)) != 0:
+        return None
+
+    if os.system("ssdv -e -n -q %d -c %s -i %d %s %s > /dev/null 2>&1" % (quality, callsign, image_id, _temp_jpeg, _temp_ssdv)) != 0:
+        return None
+
+    _data = np.fromfile(_temp_ssdv, dtype=np.uint8)
+    return _data[:(len(_data)//256)*256].reshape((-1, 256))
+
+
+def _measure(function, args, runs):
+    """ Run function(*args) runs times in a forked child process, so its memory usage can be measured
+    in isolation. Returns a tuple of (mean wall time per run, peak RSS in kB, number of packets).
+    Peak RSS includes any processes the function runs (i.e. convert and ssdv).
+    The number of packets is the length of the function's result, or -1 if it returned None.
+    """
+    (_read, _write) = os.pipe()
+    _pid = os.fork()
+
+    if _pid == 0:
+        os.close(_read)
+        _start = time.time()
+        _packets = None
+        for i in range(runs):
+            _packets = function(*args)
+        _elapsed = (time.time() - _start)/runs
+        _rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        _count = -1 if _packets is None else len(_packets)
+        os.write(_write, ("%f %d %d" % (_elapsed, _rss, _count)).encode('ascii'))
+        os._exit(0)
+
+    os.close(_write)
+    _result = os.read(_read, 256).decode('ascii')
+    os.close(_read)
+    os.waitpid(_pid, 0)
+
+    (_elapsed, _rss, _count) = _result.split()
+    return (float(_elapsed), int(_rss), int(_count))
+
+
+def ssdv_benchmark(filename, resolution=(1488,1120), callsign="N0CALL", quality=6, runs=5):
+    """ Compare the per-image wall time and peak RSS of the in-process encoder with the command-line utilities.
+    The in-process resize step is also measured on its own. Steps whose utilities or libraries are not
+    available are skipped.
+    """
+    # Peak RSS of the forked process before it does anything, which is included in the figures below.
+    _baseline = _measure(str, ("",), 1)
+    print("Baseline (forked Python process): peak RSS %d kB" % _baseline[1])
+
+    _shell = None
+    if find_executable("convert") and find_executable("ssdv"):
+        _temp_dir = tempfile.mkdtemp()
+        try:
+            _shell = _measure(_shell_encode_image, (filename, resolution, callsign, 0, quality, _temp_dir), runs)
+            print("Shell (convert + ssdv): %.3f s/image, peak RSS %d kB, %d packets" % _shell)
+        finally:
+            shutil.rmtree(_temp_dir)
+    else:
+        print("Shell encoder not available (requires the convert and ssdv utilities).")
+
+    if Image is None:
+        print("In-process encoder not available (requires PIL).")
+        return
+
+    _resize = _measure(resize_image, (filename, resolution), runs)
+    print("In-process resize only (PIL): %.3f s/image, peak RSS %d kB, %d byte JPEG" % _resize)
+
+    if not ssdv_encoder_available():
+        print("In-process SSDV encoder not available (requires ssdv_enc.so).")
+        return
+
+    _inproc = _measure(encode_image, (filename, resolution, callsign, 0, quality), runs)
+    print("In-process (PIL + ssdv_enc.so): %.3f s/image, peak RSS %d kB, %d packets" % _inproc)
+
+    if _shell is not None and _inproc[0] > 0:
+        print("Speedup: %.1fx" % (_shell[0]/_inproc[0]))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("image", help="JPEG image to encode.")
+    parser.add_argument("--resolution", default="1488x1120", help="Transmit resolution, i.e. 1488x1120.")
+    parser.add_argument("--quality", type=int, default=6, help="SSDV quality level.")
+    parser.add_argument("--runs", type=int, default=5, help="Number of times to encode the image.")
+    args = parser.parse_args()
+
+    _resolution = tuple([int(x) for x in args.resolution.split('x')])
+    ssdv_benchmark(args.image, resolution=_resolution, quality=args.quality, runs=args.runs)
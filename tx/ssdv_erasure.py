@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+#
+#   SSDV Packet-Level Erasure Coding
+#
+#   A systematic Reed-Solomon erasure code (using a Cauchy generator matrix over GF(2^8))
+#   across groups of SSDV packets. For each group of k SSDV packets, m 'repair' packets
+#   are generated. Any k of the k+m packets in a group are enough to rebuild the whole group,
+#   so a receiver can fill holes in an image without needing an uplink.
+#
+#   This file is used by both the transmitter (tx/PacketTX.py) and the receiver (rx/rx_ssdv.py).
+#
+#   Copyright (C) 2018  Mark Jessop <vk5qi@rfhead.net>
+#   Released under GNU GPL v3 or later
+#
+#   Repair Packet Format (256 bytes):
+#   0:      Packet Type (0x57)
+#   1:      Image ID
+#   2-3:    Packet ID of the first SSDV packet in the group (big endian)
+#   4:      Number of SSDV packets in the group (k)
+#   5:      Number of repair packets for the group (m)
+#   6:      Repair packet index (0 to m-1)
+#   7-255:  Repair data, calculated over bytes 7-255 of each SSDV packet in the group.
+#
+#   Bytes 0-6 of a SSDV packet (sync byte, packet type, callsign and image ID) are the same
+#   for every packet in an image, so are not protected. Recovered packets take these bytes
+#   from any other received packet of the same image.
+#
+
+import numpy as np
+import random
+import time
+
+SSDV_REPAIR_PACKET_TYPE = 0x57
+SSDV_PACKET_LENGTH = 256
+# Offset of the protected section of each SSDV packet.
+SSDV_PROTECTED_OFFSET = 7
+SSDV_PROTECTED_LENGTH = SSDV_PACKET_LENGTH - SSDV_PROTECTED_OFFSET
+
+
+#
+#   GF(2^8) Arithmetic, using the 0x11d primitive polynomial.
+#
+
+def _gf_tables():
+    gf_exp = np.zeros(512, dtype=np.int32)
+    gf_log = np.zeros(256, dtype=np.int32)
+
+    x = 1
+    for i in range(255):
+        gf_exp[i] = x
+        gf_log[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= 0x11d
+
+    gf_exp[255:510] = gf_exp[0:255]
+    return (gf_exp, gf_log)
+
+GF_EXP, GF_LOG = _gf_tables()
+
+# Full multiplication table, so a vector can be multiplied by a scalar with a single lookup.
+GF_MUL = GF_EXP[GF_LOG[:, None] + GF_LOG[None, :]].astype(np.uint8)
+GF_MUL[0, :] = 0
+GF_MUL[:, 0] = 0
+
+
+def gf_inverse(a):
+    """ Multiplicative inverse of a (non-zero) GF(2^8) element, or array of elements. """
+    return GF_EXP[255 - GF_LOG[a]].astype(np.uint8)
+
+
+def gf_matmul(a, b):
+    """ Multiply a (rows x n) matrix by a (n x length) matrix over GF(2^8). """
+    return np.bitwise_xor.reduce(GF_MUL[a[:, :, None], b[None, :, :]], axis=1)
+
+
+def gf_matrix_inverse(m):
+    """ Invert a square matrix over GF(2^8), using Gauss-Jordan elimination. """
+    n = m.shape[0]
+    a = np.hstack((m.astype(np.uint8), np.eye(n, dtype=np.uint8)))
+
+    for col in range(n):
+        _pivots = np.nonzero(a[col:, col])[0]
+        if len(_pivots) == 0:
+            raise ValueError("Matrix is singular.")
+
+        _pivot = col + _pivots[0]
+        if _pivot != col:
+            a[[col, _pivot]] = a[[_pivot, col]]
+
+        a[col] = GF_MUL[gf_inverse(a[col, col]), a[col]]
+
+        for row in range(n):
+            if row != col and a[row, col] != 0:
+                a[row] ^= GF_MUL[a[row, col], a[col]]
+
+    return a[:, n:]
+
+
+def cauchy_matrix(repair_indexes, source_indexes):
+    """ Generate the rows of the Cauchy generator matrix for a set of repair packets,
+    covering a set of source packet positions within a group.
+    Element (r, i) is 1/(x_r + y_i), with x_r = 255-r and y_i = i, which requires k+m <= 256.
+    Every square sub-matrix of a Cauchy matrix is invertible, so any k packets can rebuild the group.
+    """
+    _x = 255 - np.array(repair_indexes, dtype=np.int32)
+    _y = np.array(source_indexes, dtype=np.int32)
+    return gf_inverse(_x[:, None] ^ _y[None, :])
+
+
+#
+#   Encoder
+#
+
+def encode_group(packets, num_repairs):
+    """ Generate the repair packets for a group of SSDV packets.
+
+    Keyword Arguments:
+    packets: A (k, 256) uint8 array of SSDV packets.
+    num_repairs: Number of repair packets (m) to generate.
+
+    Returns a (m, 256) uint8 array of repair packets.
+    """
+    _k = packets.shape[0]
+
+    if _k + num_repairs > 256:
+        raise ValueError("Group size plus number of repair packets must be <= 256.")
+
+    _group_start = (int(packets[0, 7]) << 8) + int(packets[0, 8])
+
+    repairs = np.zeros((num_repairs, SSDV_PACKET_LENGTH), dtype=np.uint8)
+    repairs[:, 0] = SSDV_REPAIR_PACKET_TYPE
+    repairs[:, 1] = packets[0, 6]
+    repairs[:, 2] = _group_start >> 8
+    repairs[:, 3] = _group_start & 0xFF
+    repairs[:, 4] = _k
+    repairs[:, 5] = num_repairs
+    repairs[:, 6] = np.arange(num_repairs)
+
+    _generator = cauchy_matrix(range(num_repairs), range(_k))
+    repairs[:, SSDV_PROTECTED_OFFSET:] = gf_matmul(_generator, packets[:, SSDV_PROTECTED_OFFSET:])
+
+    return repairs
+
+
+def add_repair_packets(packets, group_size=32, num_repairs=4):
+    """ Add repair packets to a SSDV image.
+
+    Keyword Arguments:
+    packets: A (N, 256) uint8 array of the SSDV packets of an image.
+    group_size: Number of SSDV packets per group (k). The last group may be shorter.
+    num_repairs: Number of repair packets (m) per group.
+
+    Returns a list of 256 byte uint8 arrays, in transmit order, with the repair packets
+    for each group following the packets of that group.
+    """
+    _output = []
+
+    for _start in range(0, packets.shape[0], group_size):
+        _group = packets[_start:_start+group_size]
+        _output.extend(list(_group))
+        if num_repairs > 0:
+            _output.extend(list(encode_group(_group, num_repairs)))
+
+    return _output
+
+
+#
+#   Decoder
+#
+
+def decode_repair_header(packet):
+    """ Extract the header fields of a repair packet, and return them as a dictionary. """
+    packet = bytearray(packet)
+    return {
+        'image_id': packet[1],
+        'group_start': (packet[2] << 8) + packet[3],
+        'group_size': packet[4],
+        'num_repairs': packet[5],
+        'repair_index': packet[6]
+    }
+
+
+def recover_packets(packets, repairs):
+    """ Rebuild missing SSDV packets of an image from the received repair packets.
+
+    Keyword Arguments:
+    packets: A dictionary of the received SSDV packets of a single image, keyed by packet ID.
+             Packets can be strings or lists of integers.
+    repairs: A list of received repair packets for the same image.
+
+    Returns a dictionary of the recovered packets (as strings), keyed by packet ID.
+    """
+    recovered = {}
+
+    if len(packets) == 0:
+        return recovered
+
+    # The unprotected header bytes are common to every packet in the image.
+    _header = np.frombuffer(bytes(bytearray(list(packets.values())[0])), dtype=np.uint8)[:SSDV_PROTECTED_OFFSET]
+
+    # Sort the repair packets into their groups.
+    _groups = {}
+    for _repair in repairs:
+        _info = decode_repair_header(_repair)
+        _key = (_info['group_start'], _info['group_size'])
+        if _key not in _groups:
+            _groups[_key] = {}
+        _groups[_key][_info['repair_index']] = np.frombuffer(bytes(bytearray(_repair)), dtype=np.uint8)
+
+    for ((_group_start, _group_size), _group_repairs) in _groups.items():
+        _ids = [(_group_start + x) % 65536 for x in range(_group_size)]
+        _received = [x for x in range(_group_size) if _ids[x] in packets]
+        _missing = [x for x in range(_group_size) if _ids[x] not in packets]
+
+        if len(_missing) == 0 or len(_group_repairs) < len(_missing):
+            # Nothing to do, or not enough repair packets to rebuild the group.
+            continue
+
+        # Use as many repair packets as there are missing packets.
+        _repair_indexes = sorted(_group_repairs.keys())[:len(_missing)]
+        _repair_data = np.array([_group_repairs[r][SSDV_PROTECTED_OFFSET:] for r in _repair_indexes], dtype=np.uint8)
+
+        # Remove the contribution of the packets we did receive.
+        if len(_received) > 0:
+            _received_data = np.array([np.frombuffer(bytes(bytearray(packets[_ids[x]])), dtype=np.uint8)[SSDV_PROTECTED_OFFSET:] for x in _received], dtype=np.uint8)
+            _repair_data ^= gf_matmul(cauchy_matrix(_repair_indexes, _received), _received_data)
+
+        # Solve for the missing packets.
+        _decoder = gf_matrix_inverse(cauchy_matrix(_repair_indexes, _missing))
+        _missing_data = gf_matmul(_decoder, _repair_data)
+
+        for x in range(len(_missing)):
+            recovered[_ids[_missing[x]]] = np.concatenate((_header, _missing_data[x])).tostring()
+
+    return recovered
+
+
+#
+#   Loss-simulation benchmark.
+#
+
+def generate_test_image(num_packets=400, image_id=0):
+    """ Generate a (N, 256) array of random data, with valid SSDV packet headers. """
+    packets = np.random.randint(0, 256, size=(num_packets, SSDV_PACKET_LENGTH)).astype(np.uint8)
+    packets[:, 0] = 0x55
+    packets[:, 1] = 0x67
+    packets[:, 2:6] = [0x00, 0x12, 0x34, 0x56]
+    packets[:, 6] = image_id
+    packets[:, 7] = np.arange(num_packets) >> 8
+    packets[:, 8] = np.arange(num_packets) & 0xFF
+    return packets
+
+
+def loss_simulation(num_packets=400, group_size=32, repair_counts=[0, 2, 4, 8], loss_rates=[0.01, 0.05, 0.1, 0.2], trials=20):
+    """ Simulate random packet loss, and report the average image completeness (fraction
+    of SSDV packets received or recovered) against the repair packet overhead.
+    """
+    image = generate_test_image(num_packets)
+
+    print("Image: %d packets, group size %d" % (num_packets, group_size))
+    print("Repairs  Overhead  " + "  ".join(["Loss %4.1f%%" % (100*p) for p in loss_rates]))
+
+    for _num_repairs in repair_counts:
+        _start = time.time()
+        _tx_packets = add_repair_packets(image, group_size, _num_repairs)
+        _encode_time = time.time() - _start
+
+        _results = []
+        _decode_time = 0.0
+        for _loss in loss_rates:
+            _completeness = []
+            for _trial in range(trials):
+                _packets = {}
+                _repairs = []
+                for _packet in _tx_packets:
+                    if random.random() < _loss:
+                        continue
+                    if _packet[0] == SSDV_REPAIR_PACKET_TYPE:
+                        _repairs.append(_packet.tostring())
+                    else:
+                        _packets[(int(_packet[7]) << 8) + int(_packet[8])] = _packet.tostring()
+
+                _start = time.time()
+                _recovered = recover_packets(_packets, _repairs)
+                _decode_time += time.time() - _start
+
+                # Check the recovered packets are correct.
+                for _id in _recovered:
+                    if _recovered[_id] != image[_id].tostring():
+                        print("ERROR: Packet %d recovered incorrectly!" % _id)
+
+                _completeness.append(float(len(_packets) + len(_recovered)) / num_packets)
+
+            _results.append(np.mean(_completeness))
+
+        print("%7d  %7.1f%%  " % (_num_repairs, 100.0*_num_repairs/group_size) + "  ".join(["%9.2f%%" % (100*r) for r in _results]) +
+            "   (encode %.3f s, decode %.3f s/image)" % (_encode_time, _decode_time/(trials*len(loss_rates))))
+
+
+if __name__ == "__main__":
+    loss_simulation()
@@ -9,6 +9,9 @@
 
 import PacketTX
 import WenetPiCam
+import ImageRateController
+import ImageStore
+import ImageOverlay
 import ublox
 import argparse
 import time
@@ -22,6 +25,11 @@ parser.add_argument("--gps", default="/dev/ttyACM0", help="uBlox GPS Serial port
 parser.add_argument("--logo", default="none", help="Optional logo to overlay on image.")
 parser.add_argument("--txport", default="/dev/ttyAMA0", type=str, help="Transmitter serial port. Defaults to /dev/ttyAMA0")
 parser.add_argument("--baudrate", default=115200, type=int, help="Transmitter baud rate. Defaults to 115200 baud.")
+parser.add_argument("--image_interval", default=0, type=float, help="If set, adjust the image resolution and SSDV quality to transmit one image every N seconds.")
+parser.add_argument("--thumbnail", action="store_true", default=False, help="Send a low resolution thumbnail of each image first, followed by the full resolution image.")
+parser.add_argument("--max_store", default=0, type=float, help="If set, limit the images stored in ./tx_images/ to this many MB, deleting the oldest images first.")
+parser.add_argument("--keep_every", default=0, type=int, help="When deleting stored images, keep every Nth image until all others have been deleted.")
+parser.add_argument("--gpstrack", action="store_true", default=False, help="Run the GPS at 10 Hz, and transmit the full-rate track as GPS Track packets.")
 args = parser.parse_args()
 
 callsign = args.callsign
@@ -42,6 +50,9 @@ time.sleep(1)
 # Initialise a couple of global variables.
 max_altitude = 0
 system_time_set = False
+# Time of the last GPS data access error sent over the radio, and the minimum interval between them.
+last_gps_error_time = 0
+gps_error_interval = 60.0
 
 # Disable Systemctl NTP synchronization so that we can set the system time on first GPS lock.
 # This is necessary as NTP will refuse to sync the system time to the information we feed it via ntpshm unless
@@ -56,8 +67,14 @@ def handle_gps_data(gps_data):
 	""" Handle GPS data passed to us from the UBloxGPS instance """
 	global max_altitude, tx, system_time_set
 
-	# Immediately generate and transmit a GPS packet.
-	tx.transmit_gps_telemetry(gps_data)
+	if args.gpstrack:
+		# Add the fix to the GPS track, and send a regular GPS packet once per second.
+		tx.transmit_gps_track(gps_data)
+		if int(round(gps_data['iTOW']*10)) % 10 == 0:
+			tx.transmit_gps_telemetry(gps_data)
+	else:
+		# Immediately generate and transmit a GPS packet.
+		tx.transmit_gps_telemetry(gps_data)
 
 	# If we have GPS fix, update the max altitude field.
 	if (gps_data['altitude'] > max_altitude) and (gps_data['gpsFix'] == 3):
@@ -90,7 +107,7 @@ def handle_gps_data(gps_data):
 try:
 	gps = ublox.UBloxGPS(port=args.gps, 
 		dynamic_model = ublox.DYNAMIC_MODEL_AIRBORNE1G, 
-		update_rate_ms = 1000,
+		update_rate_ms = 100 if args.gpstrack else 1000,
 		debug_ptr = tx.transmit_text_message,
 		callback = handle_gps_data,
 		log_file = 'gps_data.log'
@@ -99,11 +116,9 @@ except Exception as e:
 	tx.transmit_text_message("ERROR: Could not Open GPS - %s" % str(e), repeats=5)
 	gps = None
 
-# Define our post-processing callback function, which gets called by WenetPiCam
-# after an image has been captured.
-def post_process_image(filename):
-	""" Post-process the image, adding on Logo overlay and GPS data if requested. """
-	global gps, max_altitude, args, tx
+def gps_overlay_text():
+	""" Produce the line of GPS data which is overlaid on each image. """
+	global gps, max_altitude, tx, last_gps_error_time
 
 	# Try and grab current GPS data snapshot
 	try:
@@ -129,11 +144,28 @@ def post_process_image(filename):
 					gps_state['ascent_rate'])
 		else:
 			gps_string = ""
-	except:
-		error_str = traceback.format_exc()
-		self.debug_message("GPS Data Access Failed: %s" % error_str)
+	except Exception as e:
+		# This runs for every image, so only send a short, rate-limited, error over the radio.
+		# The full traceback is printed locally.
+		traceback.print_exc()
+		if time.time() - last_gps_error_time > gps_error_interval:
+			error_str = ("%s: %s" % (type(e).__name__, str(e))).replace("\n", " ")
+			tx.transmit_text_message("GPS Data Access Failed: %s" % error_str)
+			last_gps_error_time = time.time()
 		gps_string = ""
 
+	return gps_string
+
+
+# Define our post-processing callback function, which gets called by WenetPiCam
+# after an image has been captured. This is only used if the in-process overlays
+# (below) are not available.
+def post_process_image(filename):
+	""" Post-process the image, adding on Logo overlay and GPS data if requested. """
+	global args, tx
+
+	gps_string = gps_overlay_text()
+
 	# Build up our imagemagick 'convert' command line
 	overlay_str = "convert %s -gamma 0.8 -font Helvetica -pointsize 30 -gravity North " % filename 
 	overlay_str += "-strokewidth 2 -stroke '#000C' -annotate +0+5 \"%s\" " % gps_string
@@ -150,6 +182,18 @@ def post_process_image(filename):
 	return
 
 
+# The same overlays, applied in-process to the decoded image. The logo is scaled and
+# premultiplied once, and cached.
+if ImageOverlay.overlays_available():
+	post_process_stages = [ImageOverlay.GammaStage(0.8), ImageOverlay.TextOverlay(gps_overlay_text, reference_width=1920)]
+	if args.logo != "none":
+		post_process_stages.append(ImageOverlay.LogoOverlay(args.logo, gravity='SouthEast', reference_width=1920))
+	post_process_ptr = None
+else:
+	post_process_stages = None
+	post_process_ptr = post_process_image
+
+
 # Finally, initialise the PiCam capture object.
 picam = WenetPiCam.WenetPiCam(src_resolution=(1920,1088), 
 		tx_resolution=(1920,1088), 
@@ -157,11 +201,34 @@ picam = WenetPiCam.WenetPiCam(src_resolution=(1920,1088),
 		num_images=5, 
 		debug_ptr=tx.transmit_text_message, 
 		vertical_flip=False, 
-		horizontal_flip=False)
+		horizontal_flip=False,
+		thumbnail_resolution=(320,176) if args.thumbnail else None)
+# Optionally, pick the resolution and quality of each image to meet a target image interval.
+if args.image_interval > 0:
+	# Settings keep the 1920x1088 aspect ratio of the captured images.
+	image_settings = [((1920,1088),6), ((1920,1088),5), ((1440,816),5), ((1280,720),5), ((960,544),5), ((960,544),4), ((640,368),4)]
+	rate_controller = ImageRateController.ImageRateController(target_interval=args.image_interval, settings=image_settings, debug_ptr=tx.transmit_text_message)
+else:
+	rate_controller = None
+
+# Optionally, index the captured images, and keep them within the on-board storage budget.
+# Otherwise, captured images are never deleted.
+if args.max_store > 0 or args.keep_every > 0:
+	image_store = ImageStore.ImageStore("./tx_images/",
+		max_bytes = args.max_store*1e6 if args.max_store > 0 else float('inf'),
+		policy = ImageStore.KeepEveryNthEviction(args.keep_every) if args.keep_every > 0 else None,
+		gps_ptr = gps.read_state if gps != None else None,
+		debug_ptr = tx.transmit_text_message)
+else:
+	image_store = None
+
 # .. and start it capturing continuously.
 picam.run(destination_directory="./tx_images/", 
 	tx = tx,
-	post_process_ptr = post_process_image
+	post_process_ptr = post_process_ptr,
+	rate_controller = rate_controller,
+	image_store = image_store,
+	post_process_stages = post_process_stages
 	)
 
 
@@ -178,6 +245,8 @@ except KeyboardInterrupt:
 	picam.stop()
 	tx.close()
 	gps.close()
+	if image_store != None:
+		image_store.close()
 
 
 
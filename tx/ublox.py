@@ -12,6 +12,7 @@ Added UBloxGPS abstraction layer class for use with Wenet TX system.
 import struct
 import datetime
 from threading import Thread
+from StateSnapshot import StateSnapshot
 import time, os, json, calendar, math
 
 # protocol constants
@@ -903,7 +904,8 @@ class UBlox:
 class UBloxGPS(object):
     """ UBlox GPS Abstraction Layer Class """
 
-    # Internal state dictionary, which is updated on receipt of messages.
+    # Initial values of the internal state dictionary, which is updated on receipt of messages.
+    # The live state is held in a StateSnapshot (refer StateSnapshot.py), and is accessed via read_state().
     state = {
         # Basic Position Information
         'latitude':     0.0,
@@ -923,9 +925,6 @@ class UBloxGPS(object):
         'datetime': datetime.datetime.utcnow(),       # Fix time as a datetime object.
         'dynamic_model': 20      # Current dynamic model in use.
     }
-    # Lock files for writing and reading to the internal state dictionary.
-    state_writelock = False
-    state_readlock = False
 
     def __init__(self,port='/dev/ublox', baudrate=115200, timeout=2,
             callback=None,
@@ -976,6 +975,7 @@ class UBloxGPS(object):
         self.debug_ptr = debug_ptr
         self.callback = callback
         self.ntpd_shm = None
+        self.state_snapshot = StateSnapshot(self.state)
 
 
         # Open log file, if one has been given.
@@ -1044,26 +1044,12 @@ class UBloxGPS(object):
 
     # Thread-safe read/write access into the internal state dictionary
     def write_state(self, value, parameter):
-        """ (Hopefully) thread-safe state dictionary write access """
-        while self.state_readlock:
-            pass
-
-        self.state_writelock = True
-
-        self.state[value] = parameter
-
-        self.state_writelock = False
+        """ Thread-safe state dictionary write access """
+        self.state_snapshot.write(value, parameter)
 
     def read_state(self):
-        """ Thread-safe state dictionary read access. """
-        while self.state_writelock:
-            pass
-
-        self.state_readlock = True
-        state_copy = self.state.copy()
-        self.state_readlock = False
-
-        return state_copy
+        """ Thread-safe state dictionary read access. Never blocks. """
+        return self.state_snapshot.read()
 
     # Function called whenever we have a new GPS fix.
     def gps_callback(self):
@@ -1131,29 +1117,33 @@ class UBloxGPS(object):
             # If we have received a message we care about, unpack it and update our state dict.
             if msg.name() == "NAV_SOL":
                 msg.unpack()
-                self.write_state('numSV', msg.numSV)
-                self.write_state('gpsFix', msg.gpsFix)
+                with self.state_snapshot.block_write():
+                    self.write_state('numSV', msg.numSV)
+                    self.write_state('gpsFix', msg.gpsFix)
 
             elif msg.name() == "NAV_POSLLH":
                 msg.unpack()
-                self.write_state('latitude', msg.Latitude*1.0e-7)
-                self.write_state('longitude', msg.Longitude*1.0e-7)
-                self.write_state('altitude', msg.height*1.0e-3)
+                with self.state_snapshot.block_write():
+                    self.write_state('latitude', msg.Latitude*1.0e-7)
+                    self.write_state('longitude', msg.Longitude*1.0e-7)
+                    self.write_state('altitude', msg.height*1.0e-3)
 
             elif msg.name() == "NAV_VELNED":
                 msg.unpack()
-                self.write_state('ground_speed', msg.gSpeed*0.036) # Convert to kph
-                self.write_state('heading', msg.heading*1.0e-5)
-                self.write_state('ascent_rate', -1.0*msg.velD/100.0)
+                with self.state_snapshot.block_write():
+                    self.write_state('ground_speed', msg.gSpeed*0.036) # Convert to kph
+                    self.write_state('heading', msg.heading*1.0e-5)
+                    self.write_state('ascent_rate', -1.0*msg.velD/100.0)
 
             elif msg.name() == "NAV_TIMEGPS":
                 msg.unpack()
-                self.write_state('week',msg.week)
-                self.write_state('iTOW', msg.iTOW*1.0e-3)
-                self.write_state('leapS', msg.leapS)
                 (time_isotime, time_datetime) = self.weeksecondstoutc(msg.week, msg.iTOW*1.0e-3, msg.leapS)
-                self.write_state('timestamp', time_isotime)
-                self.write_state('datetime', time_datetime)
+                with self.state_snapshot.block_write():
+                    self.write_state('week',msg.week)
+                    self.write_state('iTOW', msg.iTOW*1.0e-3)
+                    self.write_state('leapS', msg.leapS)
+                    self.write_state('timestamp', time_isotime)
+                    self.write_state('datetime', time_datetime)
 
                 # Update the NTPD Interface, if it exists, and ONLY if we are on a whole-second boundary.
                 if self.ntpd_shm != None and ((msg.iTOW*1.0e-3 - math.floor(msg.iTOW*1.0e-3)) == 0.0):